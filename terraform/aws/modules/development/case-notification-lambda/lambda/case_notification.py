@@ -4,20 +4,29 @@ import pyodbc #NEEDS LAMBDA LAYER for library and ODBC driver
 import os
 import logging
 import json
+import io
 import math
+import time
 import xml.etree.ElementTree as ET
 import paramiko #NEEDS LAMBDA LAYER for library
 
 # Lambda Global Environment Variables (all env variables are strings)
 dry_run = os.environ['DRY_RUN'].lower()
 max_batch_size = int(os.environ["MAX_BATCH_SIZE"]) # max integer number of reports to pull at once
+claim_lease_seconds = int(os.environ.get("CLAIM_LEASE_SECONDS", "600")) # a claimed ('sending') row not marked done within this many seconds can be claimed again
+ack_commit_interval = max(int(os.environ.get("ACK_COMMIT_INTERVAL") or max_batch_size), 1) # sent rows marked done per UPDATE/commit (unset or empty = MAX_BATCH_SIZE); also flushed at the end of every batch
 reported_service_types = os.environ['REPORTED_SERVICE_TYPES'] # example, requires parenthesis, "('NNDM_1.1.3', 'NND_Case_Note', 'NBS_1.1.3_LDF', 'MVPS')"
 sftp_secret_name = os.environ["SECRET_MANAGER_SFTP_SECRET"]
 sftp_put_filepath = os.environ.get("SFTP_PUT_FILEPATH",'')
 db_secret_name = os.environ["SECRET_MANAGER_DB_SECRET"]
+secrets_cache_ttl_seconds = int(os.environ.get("SECRETS_CACHE_TTL_SECONDS", "300")) # how long secrets and the RDS endpoint are reused across warm invocations
+db_health_check_seconds = int(os.environ.get("DB_HEALTH_CHECK_SECONDS", "30")) # re-check the reused connection with SELECT 1 after this many idle seconds
+sftp_verify_uploads = os.environ.get("SFTP_VERIFY_UPLOADS", "true").lower() # "true" checks each upload's remote size with one stat, "false" skips the check
+sftp_keepalive_seconds = int(os.environ.get("SFTP_KEEPALIVE_SECONDS", "30")) # SSH keepalive interval for the reused SFTP session, 0 disables
 
 # Global Variables
 custom_database_header = "charPayloadContent"
+max_requeued_per_run = 1000 # failed uploads after which a run stops; keeps the claim's NOT IN list under SQL Server's 2100-parameter limit
 os.environ["ODBCSYSINI"] = "/opt/etc" # required environment variable updates to pick up ODBC driver in lambda layer
 os.environ["ODBCINI"] = "/opt/etc/odbc.ini" # required environment variable updates to pick up ODBC driver in lambda layer
 os.environ["LD_LIBRARY_PATH"] = "/opt/lib:" + os.environ.get("LD_LIBRARY_PATH", "") # required environment variable updates to pick up ODBC driver in lambda layer
@@ -37,8 +46,33 @@ secrets_config = Config(connect_timeout=10, read_timeout=60)
 rds_client = boto3.client('rds', config=rds_config)
 secrets_client = boto3.client("secretsmanager", config=secrets_config)
 
+# --- Warm-invocation cache ---
+# Secret values and RDS endpoints rarely change, and the lambda reinvokes itself back to back
+# while draining a backlog, so they are kept at module level for secrets_cache_ttl_seconds.
+# A failed database connect or SFTP login forces a reload.
+_cached_values = {} # key -> (expiry time.monotonic(), value)
+
+def _get_cached(key, load, force_refresh=False):
+    now = time.monotonic()
+    cached = _cached_values.get(key)
+    if force_refresh or cached is None or cached[0] <= now:
+        cached = (now + secrets_cache_ttl_seconds, load())
+        _cached_values[key] = cached
+    return cached[1]
+
+def _invalidate_cached(key):
+    _cached_values.pop(key, None)
+
+# Get server endpoint and port of an RDS instance
+def _get_db_endpoint(db_server_name, force_refresh=False):
+    def describe():
+        response = rds_client.describe_db_instances(DBInstanceIdentifier=db_server_name)
+        endpoint = response["DBInstances"][0]["Endpoint"]
+        return endpoint["Address"], endpoint["Port"]
+    return _get_cached(("endpoint", db_server_name), describe, force_refresh)
+
 # Create a connection to sql server
-def _create_sql_connection(db_secret_dict):
+def _create_sql_connection(db_secret_dict, force_refresh=False):
 
     # Get database variables
     db_server_name = db_secret_dict["server_name"]
@@ -46,9 +80,7 @@ def _create_sql_connection(db_secret_dict):
     db_user_pass = db_secret_dict["password"]
 
     # get server endpoint and port
-    response = rds_client.describe_db_instances(DBInstanceIdentifier=db_server_name)
-    db_server_endpoint = response["DBInstances"][0]["Endpoint"]["Address"]
-    db_server_port = response["DBInstances"][0]["Endpoint"]["Port"]
+    db_server_endpoint, db_server_port = _get_db_endpoint(db_server_name, force_refresh=force_refresh)
      
     database = "NBS_MSGOUTE" # always same DB for nnds
     logger.info(f"Connecting to Database: {db_server_name}")
@@ -62,111 +94,329 @@ def _create_sql_connection(db_secret_dict):
     )
     return conn
 
+class _ReusableSqlConnection:
+    # One SQL Server connection shared by the count, fetch and update steps of an invocation
+    # instead of a new ODBC/TLS handshake (and describe_db_instances call) per step and per row.
+    # get() reconnects when the connection was discarded after an error, or when a
+    # SELECT 1 health check fails after more than health_check_seconds idle.
+    # run() also retries a statement once on a fresh connection after a database error.
+    def __init__(self, db_secret_name, health_check_seconds=db_health_check_seconds):
+        self.db_secret_name = db_secret_name
+        self.health_check_seconds = health_check_seconds
+        self.conn = None
+        self.last_used = 0.0
+
+    def get(self):
+        if self.conn is not None and time.monotonic() - self.last_used > self.health_check_seconds and not self._is_healthy():
+            self.discard()
+        if self.conn is None:
+            try:
+                self.conn = _create_sql_connection(db_secret_dict=_get_secret(self.db_secret_name))
+            except pyodbc.Error as e:
+                # The password may have been rotated or the instance moved: reload both and try once more
+                logger.warning(f"Database connection failed, reloading credentials and endpoint: {e}")
+                db_secret_dict = _get_secret(self.db_secret_name, force_refresh=True)
+                self.conn = _create_sql_connection(db_secret_dict=db_secret_dict, force_refresh=True)
+        self.last_used = time.monotonic()
+        return self.conn
+
+    def run(self, work):
+        # work(conn) must be safe to repeat: it is run again on a new connection after a database error
+        try:
+            return work(self.get())
+        except pyodbc.Error as e:
+            logger.warning(f"Database error, reconnecting and retrying once: {e}")
+            self.discard()
+            return work(self.get())
+
+    def _is_healthy(self):
+        try:
+            with self.conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+                cursor.fetchone()
+            return True
+        except pyodbc.Error as e:
+            logger.warning(f"Database connection failed health check, reconnecting: {e}")
+            return False
+
+    def discard(self):
+        # Drop the connection after an error so the next get() opens a new one
+        if self.conn is not None:
+            try:
+                self.conn.close()
+            except pyodbc.Error:
+                pass
+            self.conn = None
+
+    def close(self):
+        self.discard()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+# Service names from a REPORTED_SERVICE_TYPES style list, e.g. "('NNDM_1.1.3', 'MVPS')" -> ['NNDM_1.1.3', 'MVPS']
+def _parse_service_types(service_types_text):
+    return [service.strip().strip("'\"") for service in service_types_text.strip().strip("()").split(",") if service.strip()]
+
+# Services this invocation drains: all of REPORTED_SERVICE_TYPES, or the shard named by the event's
+# "services" list (only services that are also in REPORTED_SERVICE_TYPES)
+def _service_types_for_event(event):
+    service_types = _parse_service_types(reported_service_types)
+    shard = (event or {}).get("services")
+    if not shard:
+        return service_types
+    unknown = [service for service in shard if service not in service_types]
+    if unknown:
+        logger.warning(f"Ignoring services not in REPORTED_SERVICE_TYPES: {unknown}")
+    return [service for service in service_types if service in shard]
+
+# Rows that may be sent: queued, or claimed ('sending') by a worker whose lease has expired, except
+# excluded_record_ids (rows this invocation already failed to send).
+# While a row is 'sending', messageSentTime holds the time it was claimed. Every way out of 'sending'
+# rewrites it: the send time when the row is marked done, the pre-claim value when it is put back
+# ('queued') or marked 'failed'. Only rows whose worker died keep the claim time until they are reclaimed.
+def _claimable_rows_filter(service_types, excluded_record_ids=()):
+    sql_filter = """
+        action='send' AND messageId<>'' AND service IN ({})
+        AND (processingStatus='queued'
+             OR (processingStatus='sending' AND messageSentTime < CONVERT(varchar(19), DATEADD(second, -?, GETDATE()), 126)))
+    """.format(", ".join("?" * len(service_types)))
+    if excluded_record_ids:
+        sql_filter += "    AND recordId NOT IN ({})\n".format(", ".join("?" * len(excluded_record_ids)))
+    return sql_filter, [*service_types, claim_lease_seconds, *excluded_record_ids]
+
 # Get count of items to transmit from TransportQ_out
-def _get_msg_count_transportq_out(db_secret_dict,reported_service_types):
+def _get_msg_count_transportq_out(sql_connection,service_types):
     count = 0
-    conn = _create_sql_connection(db_secret_dict=db_secret_dict)
-    try:
+    sql_filter, params = _claimable_rows_filter(service_types)
+    sql_query = """
+            SELECT COUNT(*) 
+                FROM TransportQ_out 
+                WHERE {};                    
+        """.format(sql_filter)
+
+    def count_rows(conn):
         with conn.cursor() as cursor: 
-            
-            cursor = conn.cursor()
-            sql_query = """
-                    SELECT COUNT(*) 
-                        FROM TransportQ_out 
-                        WHERE processingStatus='queued' AND action='send' AND messageId<>'' AND service IN {};                    
-                """.format(reported_service_types)
-            cursor.execute(sql_query)
-            count = cursor.fetchone()[0]            
+            cursor.execute(sql_query, *params)
+            return cursor.fetchone()[0]
+
+    try:
+        count = sql_connection.run(count_rows)
     except Exception as e:
         logger.error(f"An error occurred getting counts from TransportQ_out in function _get_msg_count_transportq_out: {e}")
-    finally:
-        conn.close()
+        sql_connection.discard()
 
     return count
 
-def _get_msg_payload_transportq_out(db_secret_dict, max_batch_size, reported_service_types):
+# Read the next rows without claiming them (dry run: the database is not changed)
+def _get_msg_payload_transportq_out(sql_connection, max_batch_size, service_types):
     transportq_out_rows_to_process = []
-    conn = _create_sql_connection(db_secret_dict=db_secret_dict)
-    try:        
+    sql_filter, params = _claimable_rows_filter(service_types)
+    sql_query = """
+        SELECT TOP (?) cast(cast(payloadContent as varbinary(max)) as varchar(max)) AS {}, * 
+            FROM TransportQ_out 
+            WHERE {}
+            ORDER BY priority asc, messageCreationTime asc;
+    """.format(custom_database_header,sql_filter)
+
+    def fetch_rows(conn):
         with conn.cursor() as cursor: 
-            sql_query = """
-                SELECT TOP ({}) cast(cast(payloadContent as varbinary(max)) as varchar(max)) AS {}, * 
-                    FROM TransportQ_out 
-                    WHERE processingStatus='queued' AND action='send' AND messageId<>'' AND service IN {}
-                    ORDER BY priority asc, messageCreationTime asc;
-            """.format(max_batch_size,custom_database_header,reported_service_types)
-            
-            cursor.execute(sql_query)
-            transportq_out_rows_to_process = cursor.fetchall()        
+            cursor.execute(sql_query, max_batch_size, *params)
+            return cursor.fetchall()        
+
+    try:        
+        transportq_out_rows_to_process = sql_connection.run(fetch_rows)
     except Exception as e:
         logger.error(f"An error occurred getting payload from TransportQ_out in function _get_msg_payload_transportq_out: {e}")
-    finally:
-        conn.close()
+        sql_connection.discard()
+    return transportq_out_rows_to_process
+
+# Atomically claim the next rows for this worker: they are set to 'sending' with a lease start in
+# messageSentTime and returned in one statement. READPAST skips rows another worker has locked and
+# UPDLOCK stops two workers claiming the same row, so concurrent invocations never send the same
+# message. The claim is committed straight away. Rows that cannot be sent are put back or marked
+# 'failed' by _SentRowAcknowledger; only rows of a worker that crashed or timed out wait for the
+# lease to expire before they are claimed again. The pre-claim messageSentTime is returned as
+# claimedFromMessageSentTime so it can be restored.
+def _claim_msg_payload_transportq_out(sql_connection, max_batch_size, service_types, excluded_record_ids=()):
+    transportq_out_rows_to_process = []
+    sql_filter, params = _claimable_rows_filter(service_types, excluded_record_ids)
+    sql_query = """
+        WITH claimable AS (
+            SELECT TOP (?) * 
+                FROM TransportQ_out WITH (READPAST, UPDLOCK, ROWLOCK)
+                WHERE {}
+                ORDER BY priority asc, messageCreationTime asc
+        )
+        UPDATE claimable
+            SET processingStatus='sending', messageSentTime=CONVERT(varchar(19), GETDATE(), 126)
+            OUTPUT cast(cast(inserted.payloadContent as varbinary(max)) as varchar(max)) AS {},
+                deleted.messageSentTime AS claimedFromMessageSentTime, inserted.*;
+    """.format(sql_filter,custom_database_header)
+
+    # Not retried on a new connection: if the claim committed before the error, retrying would claim
+    # a second set; the first is recovered when its lease expires.
+    try:
+        conn = sql_connection.get()
+        # Leaving the cursor block commits the claim
+        with conn.cursor() as cursor:
+            cursor.execute(sql_query, max_batch_size, *params)
+            transportq_out_rows_to_process = cursor.fetchall()
+    except Exception as e:
+        logger.error(f"An error occurred claiming payload from TransportQ_out in function _claim_msg_payload_transportq_out: {e}")
+        sql_connection.discard()
     return transportq_out_rows_to_process
 
-def _send_msg_payload_transportq_out(db_secret_dict, transportq_out_row_to_process, sftp_put_filepath, sftp_hostname, sftp_username, sftp_password, dry_run="false"):
+class _SentRowAcknowledger:
+    # Collects the claimed rows of a batch and writes their outcome to TransportQ_out in bulk, with one
+    # parameterized UPDATE per outcome keyed on recordId, sent with fast_executemany and committed
+    # every commit_interval rows:
+    # - add(): the file was sent; the row is marked 'done' with the send time.
+    # - requeue(): the upload failed; the row goes back to 'queued' for the next run (this invocation
+    #   does not claim it again, see requeued_record_ids).
+    # - fail(): the payload cannot be turned into a file (invalid XML); the row is marked 'failed' and
+    #   never claimed again. Set it back to 'queued' to resend it.
+    # Requeued and failed rows get their pre-claim messageSentTime back. A crash loses at most one
+    # chunk of updates, and those rows are resent once their claim lease expires. In dry run flush()
+    # only logs; the database is not changed.
+    sql_query = """
+        UPDATE TransportQ_out
+            SET processingStatus='done', messageSentTime=(SELECT CONVERT(varchar(19), GETDATE(), 126) AS [ISO8601DateTime])
+            WHERE recordId=?
+    """
+    requeue_sql_query = """
+        UPDATE TransportQ_out
+            SET processingStatus='queued', messageSentTime=?
+            WHERE recordId=? AND processingStatus='sending'
+    """
+    fail_sql_query = """
+        UPDATE TransportQ_out
+            SET processingStatus='failed', messageSentTime=?
+            WHERE recordId=? AND processingStatus='sending'
+    """
+
+    def __init__(self, sql_connection, commit_interval=ack_commit_interval, dry_run="false"):
+        self.sql_connection = sql_connection
+        self.commit_interval = commit_interval
+        self.dry_run = dry_run
+        self.pending = []
+        self.pending_requeued = []
+        self.pending_failed = []
+        self.requeued_record_ids = [] # every row requeued by this invocation, so it is not claimed again
+        self.failed = False # set once an update fails; those rows stay 'sending' and are resent once their claim lease expires
+
+    def add(self, transportq_out_row):
+        self.pending.append(transportq_out_row)
+        self._flush_if_full()
+
+    def requeue(self, transportq_out_row):
+        self.pending_requeued.append(transportq_out_row)
+        self.requeued_record_ids.append(transportq_out_row.recordId)
+        self._flush_if_full()
+
+    def fail(self, transportq_out_row):
+        self.pending_failed.append(transportq_out_row)
+        self._flush_if_full()
+
+    def _flush_if_full(self):
+        if len(self.pending) + len(self.pending_requeued) + len(self.pending_failed) >= self.commit_interval:
+            self.flush()
+
+    def flush(self):
+        rows, self.pending = self.pending, []
+        requeued, self.pending_requeued = self.pending_requeued, []
+        failed, self.pending_failed = self.pending_failed, []
+        if not (rows or requeued or failed):
+            return True
+        if self.dry_run != "false":
+            logger.info(f"Dry run enabled, database not updated for {len(rows)} sent message(s)! Continuing as if update occured...")
+            return True
+        updates = [
+            (self.sql_query, [(row.recordId,) for row in rows]),
+            (self.requeue_sql_query, [(getattr(row, "claimedFromMessageSentTime", None), row.recordId) for row in requeued]),
+            (self.fail_sql_query, [(getattr(row, "claimedFromMessageSentTime", None), row.recordId) for row in failed]),
+        ]
+
+        def update_rows(conn):
+            # Leaving the cursor block commits the chunk
+            with conn.cursor() as cursor:
+                cursor.fast_executemany = True
+                for sql_query, params in updates:
+                    if params:
+                        cursor.executemany(sql_query, params)
+
+        try:
+            self.sql_connection.run(update_rows)
+        except Exception as e:
+            logger.error(
+                f"Unable to update database TransportQ_out for {len(rows)} sent, {len(requeued)} requeued and {len(failed)} failed message(s) "
+                f"with destinationFilename {', '.join(row.destinationFilename for row in rows + requeued + failed)}: {e}"
+            )
+            self.sql_connection.discard()
+            self.failed = True
+            return False
+        logger.info(f"Updated Database with processingStatus=done for {len(rows)} sent message(s)")
+        if requeued:
+            logger.warning(f"Updated Database with processingStatus=queued for {len(requeued)} message(s) that could not be sent")
+        if failed:
+            logger.error(f"Updated Database with processingStatus=failed for {len(failed)} message(s) with an invalid payload")
+        return True
+
+def _send_msg_payload_transportq_out(sent_rows, transportq_out_row_to_process, sftp_put_filepath, sftp_session, dry_run="false"):
     success_status = False    
-    conn = _create_sql_connection(db_secret_dict=db_secret_dict)
     try:
-        filename = None
-        # transform file to xml and print as xml if type 
-        if transportq_out_row_to_process.service == "NNDM_1.1.3":
-            # Create xml files to send            
-            try:        
-                root = ET.fromstring(getattr(transportq_out_row_to_process, custom_database_header))        
-                tree = ET.ElementTree(root)
-                _strip_ns(root)
-                _indent_xml(root)
-                tree.write(f"/tmp/{transportq_out_row_to_process.destinationFilename}.xml", encoding="utf-8", xml_declaration=False)
-                filename = f"{transportq_out_row_to_process.destinationFilename}.xml"   
-            except ET.ParseError as e:
-                print("Invalid XML:", e)           
-        else:
-            # Create hl7 files to send
-            with open(f"/tmp/{transportq_out_row_to_process.destinationFilename}.hl7", 'w') as file_object:
-                print(getattr(transportq_out_row_to_process, custom_database_header), file=file_object)
-            filename = f"{transportq_out_row_to_process.destinationFilename}.hl7"
+        filename, payload = _serialize_payload(transportq_out_row_to_process)
+        if filename is None:
+            # Resending cannot fix the payload, so the row is taken out of the queue
+            logger.error(f"Unable to create file for messageId {transportq_out_row_to_process.messageId} and destinationFilename {transportq_out_row_to_process.destinationFilename}, marking it failed")
+            sent_rows.fail(transportq_out_row_to_process)
+            return success_status
 
-        # Connect to SFTP and send file
+        # Send the file over the invocation's SFTP session
         success_status = _write_to_sftp(
             file=filename, 
+            payload=payload,
             sftp_put_filepath=sftp_put_filepath, 
-            sftp_hostname=sftp_hostname, 
-            sftp_username=sftp_username, 
-            sftp_password=sftp_password, 
+            sftp_session=sftp_session, 
             dry_run=dry_run
         )
 
-        # Update Database with send status
-        db_success_status = False
+        # Queue the database update; sent rows are marked done in bulk
         if success_status:
-            with conn.cursor() as cursor:            
-                logger.info("Updating Database with processingStatus=done")
-                if dry_run == "false": 
-                    sql_query = """
-                        UPDATE TransportQ_out
-                            SET processingStatus='done', messageSentTime=(SELECT CONVERT(varchar(19), GETDATE(), 126) AS [ISO8601DateTime])
-                            WHERE destinationFilename='{}'                    
-                    """.format(transportq_out_row_to_process.destinationFilename)               
-                    cursor.execute(sql_query)
-                else:
-                    logger.info("Dry run enabled, database not updated! Continuing as if update occured...")
-                db_success_status = True        
-
-        if db_success_status and success_status:            
             logger.info(f"Successfully sent notification for message with messageId {transportq_out_row_to_process.messageId} and destinationFilename {transportq_out_row_to_process.destinationFilename}")
-        elif success_status and db_success_status == False:
-            logger.info(f"Unable to update database TransportQ_out with processingStatus='done'. Successfully sent notification for message with messageId {transportq_out_row_to_process.messageId} and destinationFilename {transportq_out_row_to_process.destinationFilename}")
-   
-        if filename is None:
-            raise Exception(f"Unable to create file for messageId {transportq_out_row_to_process.messageId} and destinationFilename {transportq_out_row_to_process.destinationFilename}")
+            sent_rows.add(transportq_out_row_to_process)
+        else:
+            sent_rows.requeue(transportq_out_row_to_process)
         
     except Exception as e:
         logger.error(f"An error occurred getting processing message from TransportQ_out: {e}")
-    finally:
-        conn.close()
+        sent_rows.requeue(transportq_out_row_to_process)
     return success_status    
 
+# Serialize a TransportQ_out row to the file that is sent, in memory: (filename, bytes),
+# or (None, None) if an NNDM payload is not valid XML. The bytes match what used to be
+# written to /tmp (ElementTree output, or the HL7 text plus the newline print added).
+def _serialize_payload(transportq_out_row_to_process):
+    payload_content = getattr(transportq_out_row_to_process, custom_database_header)
+    # transform file to xml and print as xml if type 
+    if transportq_out_row_to_process.service == "NNDM_1.1.3":
+        try:        
+            root = ET.fromstring(payload_content)        
+        except ET.ParseError as e:
+            print("Invalid XML:", e)           
+            return None, None
+        tree = ET.ElementTree(root)
+        _strip_ns(root)
+        _indent_xml(root)
+        buffer = io.BytesIO()
+        tree.write(buffer, encoding="utf-8", xml_declaration=False)
+        return f"{transportq_out_row_to_process.destinationFilename}.xml", buffer.getvalue()
+    # hl7 files
+    return f"{transportq_out_row_to_process.destinationFilename}.hl7", f"{payload_content}\n".encode("utf-8")
+
 def _strip_ns(elem):
     # Remove namespace from tag
     elem.tag = elem.tag.split('}', 1)[-1]
@@ -186,11 +436,81 @@ def _indent_xml(elem, level=0):
         if level and (not elem.tail or not elem.tail.strip()):
             elem.tail = i
 
-def _write_to_sftp(file, sftp_put_filepath, sftp_hostname, sftp_username, sftp_password, dry_run="false"):
+class _SftpSession:
+    # One authenticated SSH transport and SFTP channel kept for the whole invocation instead of a
+    # key exchange and password login per file. Keepalive packets stop the partner server from
+    # dropping it while the database is queried; a dead session is replaced on the next get(),
+    # and put() retries once on a new session if the channel fails mid-upload.
+    def __init__(self, sftp_secret_name, keepalive_seconds=sftp_keepalive_seconds):
+        self.sftp_secret_name = sftp_secret_name
+        self.keepalive_seconds = keepalive_seconds
+        self.transport = None
+        self.sftp = None
+
+    def _connect(self):
+        # Credentials come from the warm-invocation cache
+        sftp_secret_dict = _get_secret(self.sftp_secret_name)
+        transport = paramiko.Transport((sftp_secret_dict["sftp_hostname"], 22))
+        try:
+            transport.connect(username=sftp_secret_dict["sftp_username"], password=sftp_secret_dict["sftp_password"])
+        except paramiko.AuthenticationException:
+            # The password may have been rotated: reload the secret on the next connect
+            _invalidate_cached(("secret", self.sftp_secret_name))
+            transport.close()
+            raise
+        except Exception:
+            transport.close()
+            raise
+        if self.keepalive_seconds > 0:
+            transport.set_keepalive(self.keepalive_seconds)
+        self.transport = transport
+        self.sftp = paramiko.SFTPClient.from_transport(transport)
+        logger.info("Opened SFTP session")
+
+    def get(self):
+        if self.transport is not None and not self.transport.is_active():
+            logger.warning("SFTP session is no longer active, reconnecting")
+            self.discard()
+        if self.sftp is None:
+            self._connect()
+        return self.sftp
+
+    def put(self, payload, remote_file_path, confirm=True):
+        # Stream the payload bytes with SFTPClient.putfo, which writes with pipelining (no wait for
+        # each write acknowledgement). confirm=True stats the remote file and checks its size.
+        try:
+            self.get().putfo(io.BytesIO(payload), remote_file_path, file_size=len(payload), confirm=confirm)
+        except (paramiko.SSHException, EOFError, OSError) as e:
+            logger.warning(f"SFTP upload failed, reconnecting and retrying once: {e}")
+            self.discard()
+            self.get().putfo(io.BytesIO(payload), remote_file_path, file_size=len(payload), confirm=confirm)
+
+    def discard(self):
+        if self.sftp is not None:
+            try:
+                self.sftp.close()
+            except Exception:
+                pass
+        if self.transport is not None:
+            self.transport.close()
+        self.sftp = None
+        self.transport = None
+
+    def close(self):
+        self.discard()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def _write_to_sftp(file, payload, sftp_put_filepath, sftp_session, dry_run="false"):
     # Function
-    # Take a local file and send it to client via sftp endpoint and credentials
+    # Send an in-memory file to client via the invocation's sftp session
     # Variables
-    # file =  filename (always on /tmp path for lambda)
+    # file =  remote filename
+    # payload = file content (bytes)
     # dry_run = True/False
 
     success_status = False 
@@ -199,37 +519,33 @@ def _write_to_sftp(file, sftp_put_filepath, sftp_hostname, sftp_username, sftp_p
         sftp_put_filepath += "/"   
         
     remote_file_path = f"{sftp_put_filepath}{file}"
-    local_file_path = f"/tmp/{file}"  # Lambda allows writes only to /tmp    
     
-    # Connect with username + password
-    transport = paramiko.Transport((sftp_hostname, 22))
-    transport.connect(username=sftp_username, password=sftp_password)
     try:
-        with paramiko.SFTPClient.from_transport(transport) as sftp:  
-            if dry_run == "false":  
-                sftp.put(local_file_path, remote_file_path)
-                sftp.stat(remote_file_path)
-                logger.info(f"Uploaded {local_file_path} → {remote_file_path}")
-            else:
-                logger.info(f"Dry run enabled, files {local_file_path} → {remote_file_path} not sent!")            
+        if dry_run == "false":  
+            sftp_session.put(payload, remote_file_path, confirm=sftp_verify_uploads != "false")
+            logger.info(f"Uploaded {len(payload)} bytes → {remote_file_path}")
+        else:
+            # Still log in, so a dry run checks the credentials
+            sftp_session.get()
+            logger.info(f"Dry run enabled, file {remote_file_path} not sent!")            
         success_status = True
     except Exception as e:
-        logger.error(f"Unable to upload {local_file_path} → {remote_file_path}: {e}")
-    finally:
-        transport.close()    
+        logger.error(f"Unable to upload {remote_file_path}: {e}")
 
     return success_status
 
-def _get_secret(secret_name):     
+def _get_secret(secret_name, force_refresh=False):     
 
-    # Get secret value
-    response = secrets_client.get_secret_value(SecretId=secret_name)
+    def load():
+        # Get secret value
+        response = secrets_client.get_secret_value(SecretId=secret_name)
 
-    # The secret is stored as a string; parse JSON
-    secret_string = response["SecretString"]
-    secret_dict = json.loads(secret_string)
+        # The secret is stored as a string; parse JSON
+        secret_string = response["SecretString"]
+        return json.loads(secret_string)
 
-    return secret_dict
+    # Callers get their own copy so the cached value cannot be modified
+    return dict(_get_cached(("secret", secret_name), load, force_refresh))
 
 # Check remaining lambda time and reinvoke lambda if less than 30 seconds remaining
 # This must be called for every send to prevent situations where a message is sent but commit to DB does not occur
@@ -242,7 +558,8 @@ def _restart_lambda_check(context, total_time):
         restart_lambda = True
     return restart_lambda
 
-def _reinvoke_lambda(context,total_time):
+# The event is passed on so a sharded invocation ("services") continues with the same shard
+def _reinvoke_lambda(context,total_time,event=None):
         read_timeout = total_time - 20000 #total time - 20 sec (20000ms)
         lambda_config = Config(connect_timeout=10, read_timeout=read_timeout) # needs to be slightly less than the 5 minute timeout
         lambda_client = boto3.client("lambda", config=lambda_config)
@@ -250,7 +567,7 @@ def _reinvoke_lambda(context,total_time):
         lambda_client.invoke(
             FunctionName=context.function_name,
             InvocationType="Event",  # async
-            Payload=json.dumps({})
+            Payload=json.dumps({"services": event["services"]} if event and event.get("services") else {})
         )
 
 def lambda_handler(event, context):
@@ -258,45 +575,68 @@ def lambda_handler(event, context):
     # Lambda Environment Variables
     total_time = context.get_remaining_time_in_millis()
 
-    # Get database credentials
-    db_secret_dict = _get_secret(db_secret_name)    
-    
-    # Get sftp credentials
-    sftp_secret_dict = _get_secret(sftp_secret_name)
-    sftp_hostname = sftp_secret_dict["sftp_hostname"]
-    sftp_username = sftp_secret_dict["sftp_username"]
-    sftp_password = sftp_secret_dict["sftp_password"]
-
-    total_messages = _get_msg_count_transportq_out(db_secret_dict=db_secret_dict,reported_service_types=reported_service_types)    
-    total_batches = math.ceil(total_messages/max_batch_size)
- 
-    # Process in batches to reduce the chance of timeout. Small batches = less of a chance of timeout but more queries run against db
-    messages_sent = 0 
-    for i in range(total_batches):
-        logger.info(f"Processing batch {i+1}/{total_batches}. Max Batch Size = {max_batch_size}")
-        transportq_out_rows_to_process = _get_msg_payload_transportq_out(db_secret_dict=db_secret_dict, max_batch_size=max_batch_size, reported_service_types=reported_service_types)
-        return_report_number = len(transportq_out_rows_to_process)               
-        for j in range(return_report_number):
-            success_status = _send_msg_payload_transportq_out(
-                db_secret_dict=db_secret_dict, 
-                transportq_out_row_to_process=transportq_out_rows_to_process[j],
-                sftp_put_filepath = sftp_put_filepath, 
-                sftp_hostname=sftp_hostname, 
-                sftp_username=sftp_username, 
-                sftp_password=sftp_password, 
-                dry_run=dry_run
-                )
-            if success_status:
-                messages_sent+=1
-
-        # after each batch check if there is enough time to proceed to next batch, if not reinvoke lambda until finished. Assuming at most 30 seconds required for a single batch.
-        # reduce MAX_BATCH_SIZE environment variable if taking longer than 30 seconds for each batch
-        restart_lambda = _restart_lambda_check(context=context, total_time=total_time)
-        # if we have to restart lambda check and exit lambda
-        if restart_lambda:
-            _reinvoke_lambda(context, total_time=total_time)
-            logger.info(f"Lambda timeout imminent, restarting Lambda! Sucessfully Sent {messages_sent} message(s)!")
+    # One database connection for the whole invocation, shared by the count, fetch and update steps,
+    # and one SFTP session, opened on the first upload. Both read their credentials from the
+    # warm-invocation cache when they connect.
+    with _ReusableSqlConnection(db_secret_name) as sql_connection, _SftpSession(sftp_secret_name) as sftp_session:
+        service_types = _service_types_for_event(event)
+        if not service_types:
+            logger.warning("No services to process for this invocation")
             return
+        total_messages = _get_msg_count_transportq_out(sql_connection=sql_connection,service_types=service_types)    
+        total_batches = math.ceil(total_messages/max_batch_size)
+ 
+        # Process in batches to reduce the chance of timeout. Small batches = less of a chance of timeout but more queries run against db
+        messages_sent = 0 
+        sent_rows = _SentRowAcknowledger(sql_connection, dry_run=dry_run)
+        try:
+            for i in range(total_batches):
+                logger.info(f"Processing batch {i+1}/{total_batches}. Max Batch Size = {max_batch_size}")
+
+                if dry_run == "false":
+                    transportq_out_rows_to_process = _claim_msg_payload_transportq_out(sql_connection=sql_connection, max_batch_size=max_batch_size, service_types=service_types, excluded_record_ids=sent_rows.requeued_record_ids)
+                else:
+                    transportq_out_rows_to_process = _get_msg_payload_transportq_out(sql_connection=sql_connection, max_batch_size=max_batch_size, service_types=service_types)
+                return_report_number = len(transportq_out_rows_to_process)               
+                # Other workers may have claimed the remaining rows since they were counted
+                if not return_report_number:
+                    break
+                for j in range(return_report_number):
+                    success_status = _send_msg_payload_transportq_out(
+                        sent_rows=sent_rows, 
+                        transportq_out_row_to_process=transportq_out_rows_to_process[j],
+                        sftp_put_filepath = sftp_put_filepath, 
+                        sftp_session=sftp_session, 
+                        dry_run=dry_run
+                        )
+                    if success_status:
+                        messages_sent+=1
+
+                # Every claimed row is marked done, requeued or failed before the next batch is claimed
+                sent_rows.flush()
+                if sent_rows.failed:
+                    logger.error("Stopping: sent messages could not be marked done. They will be resent once their claim lease expires.")
+                    break
+                # A batch worth of failed uploads points at the SFTP server rather than single files
+                if len(sent_rows.requeued_record_ids) >= min(max_batch_size, max_requeued_per_run):
+                    logger.error(f"Stopping: {len(sent_rows.requeued_record_ids)} message(s) could not be sent in this run. They are queued for the next run.")
+                    break
+                # Dry run changes nothing, so every later batch would select the same rows again
+                if dry_run != "false":
+                    logger.info("Dry run enabled, stopping after one batch.")
+                    break
+
+                # after each batch check if there is enough time to proceed to next batch, if not reinvoke lambda until finished. Assuming at most 30 seconds required for a single batch.
+                # reduce MAX_BATCH_SIZE environment variable if taking longer than 30 seconds for each batch
+                restart_lambda = _restart_lambda_check(context=context, total_time=total_time)
+                # if we have to restart lambda check and exit lambda
+                if restart_lambda:
+                    _reinvoke_lambda(context, total_time=total_time, event=event)
+                    logger.info(f"Lambda timeout imminent, restarting Lambda! Sucessfully Sent {messages_sent} message(s)!")
+                    return
+        finally:
+            # Acknowledge whatever was sent before an unexpected error
+            sent_rows.flush()
 
     if messages_sent == 0:
         logger.info("No messages found to send!")
@@ -148,6 +148,12 @@ resource "aws_lambda_function" "this" {
       REPORTED_SERVICE_TYPES     = "${var.lambda_env_reported_service_types}"
       SFTP_PUT_FILEPATH          = "${var.lambda_env_sftp_put_filepath}"
       LOG_LEVEL                  = "${var.lambda_env_log_level}"
+      DB_HEALTH_CHECK_SECONDS    = "${var.lambda_env_db_health_check_seconds}"
+      SECRETS_CACHE_TTL_SECONDS  = "${var.lambda_env_secrets_cache_ttl_seconds}"
+      SFTP_KEEPALIVE_SECONDS     = "${var.lambda_env_sftp_keepalive_seconds}"
+      SFTP_VERIFY_UPLOADS        = "${var.lambda_env_sftp_verify_uploads}"
+      ACK_COMMIT_INTERVAL        = "${var.lambda_env_ack_commit_interval}"
+      CLAIM_LEASE_SECONDS        = "${var.lambda_env_claim_lease_seconds}"
       SECRET_MANAGER_SFTP_SECRET = "${aws_secretsmanager_secret.case_notification_sftp.name}"
       SECRET_MANAGER_DB_SECRET   = "${aws_secretsmanager_secret.case_notification_db.name}"
     }
@@ -138,4 +138,40 @@ variable "lambda_env_log_level" {
   description = "LOG_LEVEL lambda environment variable. Accepted values = INFO, ERROR, DEBUG, WARN"
   type        = string
   default     = "INFO"
-} 
\ No newline at end of file
+} 
+
+variable "lambda_env_db_health_check_seconds" {
+  description = "DB_HEALTH_CHECK_SECONDS lambda environment variable. Idle seconds after which the reused database connection is checked with SELECT 1 before use. Accepted values = integer numbers"
+  type        = string
+  default     = "30"
+}
+
+variable "lambda_env_secrets_cache_ttl_seconds" {
+  description = "SECRETS_CACHE_TTL_SECONDS lambda environment variable. Seconds that secret values and the RDS endpoint are reused across warm invocations. Accepted values = integer numbers"
+  type        = string
+  default     = "300"
+}
+
+variable "lambda_env_sftp_keepalive_seconds" {
+  description = "SFTP_KEEPALIVE_SECONDS lambda environment variable. SSH keepalive interval for the SFTP session reused across an invocation, 0 disables. Accepted values = integer numbers"
+  type        = string
+  default     = "30"
+}
+
+variable "lambda_env_sftp_verify_uploads" {
+  description = "SFTP_VERIFY_UPLOADS lambda environment variable. True checks each upload's remote size with one stat; False skips the check. Accepted values = True/False"
+  type        = string
+  default     = "True"
+}
+
+variable "lambda_env_ack_commit_interval" {
+  description = "ACK_COMMIT_INTERVAL lambda environment variable. Sent messages marked done per bulk UPDATE and commit (also flushed at the end of every batch); a crash resends at most this many. Accepted values = integer numbers, or empty to use MAX_BATCH_SIZE"
+  type        = string
+  default     = ""
+}
+
+variable "lambda_env_claim_lease_seconds" {
+  description = "CLAIM_LEASE_SECONDS lambda environment variable. Seconds a message claimed by one invocation ('sending') is reserved for it; if that invocation crashes or times out before the message is marked done, requeued or failed, any invocation can claim and resend it after this long. Must exceed the time to send one batch. Accepted values = integer numbers"
+  type        = string
+  default     = "600"
+}
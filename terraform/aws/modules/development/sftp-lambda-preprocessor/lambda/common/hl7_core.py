@@ -0,0 +1,333 @@
+"""
+hl7_core.py
+
+Shared HL7 v2 tokenizer used by the SFTP preprocessor lambdas
+(lambda_add_hl7_ext, lambda_split_dat, lambda_split_obr and sftp/copy_to_inbox).
+
+Segments and fields are indexed as offsets into one shared buffer instead of
+being split into per-field string lists:
+  - a Segment only records where its '|' separators are, and only scans as far
+    as the highest field index that has been asked for
+  - field values are sliced out of the buffer when they are read
+  - field replacements are recorded on the segment and applied in a single
+    pass when the segment is rendered
+
+Field indexes follow `line.split("|")` numbering, which is what the lambdas
+have always used: index 0 is the segment ID and index n is field n for every
+segment except MSH, where index n is MSH-(n+1) because MSH-1 is the field
+separator itself (so MSH-10, the message control ID, is index 9).
+
+This file lives in lambda/common/ and is symlinked into each lambda directory
+so it is packaged alongside the handler (`zip -r` follows symlinks).
+"""
+import re
+
+FIELD_SEPARATOR = "|"
+COMPONENT_SEPARATOR = "^"
+REPETITION_SEPARATOR = "~"
+SEGMENT_SEPARATOR = "\r"
+
+# A segment is any non-empty run of characters between \r, \n or \r\n.
+_SEGMENT_RE = re.compile(r"[^\r\n]+")
+_NON_SPACE_RE = re.compile(r"\S")
+# The same patterns for raw (undecoded) bytes buffers
+_SEGMENT_BYTES_RE = re.compile(rb"[^\r\n]+")
+# Raw buffers are trimmed with the whitespace of str.isspace(), UTF-8 encoded, so
+# bytes and decoded text give the same bounds. bytes.isspace() and rb"\s" would
+# miss \x1c-\x1f (\x1c is the MLLP end-of-block byte) and the multi-byte spaces.
+# Every str whitespace character is below U+3001.
+_ASCII_SPACE_BYTES = frozenset(c for c in range(0x80) if chr(c).isspace())
+_MULTIBYTE_SPACE_BYTES = tuple(chr(c).encode("utf-8") for c in range(0x80, 0x3001) if chr(c).isspace())
+# First bytes of the whitespace above; a buffer starting with any other byte is not blank
+_SPACE_LEAD_BYTES = _ASCII_SPACE_BYTES | frozenset(space[0] for space in _MULTIBYTE_SPACE_BYTES)
+_LEADING_SPACE_BYTES_RE = re.compile(
+    rb"(?:[" + re.escape(bytes(sorted(_ASCII_SPACE_BYTES))) + rb"]|"
+    + rb"|".join(re.escape(space) for space in _MULTIBYTE_SPACE_BYTES) + rb")*"
+)
+# A message starts with "MSH|" at the start of the buffer or of a line, after
+# any spaces or tabs (hand-edited or transcoded files indent it; a leading
+# byte-order mark is also allowed); "MSH" inside field data is not a boundary.
+# Group 1 is the "MSH|" itself, so the indentation stays with the text before it.
+_MESSAGE_START_RE = re.compile(r"(?<![^\r\n\ufeff])[ \t]*(MSH\|)")
+
+
+def strip_bounds(buffer: str, start: int = 0, end: int = None) -> tuple:
+    """
+    Return (start, end) of buffer[start:end] with leading and trailing
+    whitespace excluded, without copying the buffer. buffer may be str or
+    bytes; both use the whitespace of str.isspace().
+    """
+    if end is None:
+        end = len(buffer)
+    if not isinstance(buffer, str):
+        return _strip_bytes_bounds(buffer, start, end)
+    match = _NON_SPACE_RE.search(buffer, start, end)
+    if match is None:
+        return start, start
+    start = match.start()
+    while end > start and buffer[end - 1].isspace():
+        end -= 1
+    return start, end
+
+
+def _strip_bytes_bounds(buffer: bytes, start: int, end: int) -> tuple:
+    start = _LEADING_SPACE_BYTES_RE.match(buffer, start, end).end()
+    while end > start:
+        if buffer[end - 1] in _ASCII_SPACE_BYTES:
+            end -= 1
+            continue
+        for space in _MULTIBYTE_SPACE_BYTES:
+            if buffer.endswith(space, start, end):
+                end -= len(space)
+                break
+        else:
+            break
+    return start, end
+
+
+def is_blank(buffer: str, start: int = 0, end: int = None) -> bool:
+    """True if buffer[start:end] is empty or whitespace only (str.isspace() rules, also for bytes)."""
+    if end is None:
+        end = len(buffer)
+    if start >= end:
+        return True
+    if isinstance(buffer, str):
+        return buffer[start].isspace() and _NON_SPACE_RE.search(buffer, start, end) is None
+    return buffer[start] in _SPACE_LEAD_BYTES and _LEADING_SPACE_BYTES_RE.match(buffer, start, end).end() == end
+
+
+def iter_segment_bounds(buffer: str, start: int = 0, end: int = None):
+    """
+    Yield (start, end) offsets of every non-empty segment in buffer[start:end].
+    Segments may be terminated by \\r, \\n or \\r\\n. buffer may be str or
+    bytes.
+    """
+    if end is None:
+        end = len(buffer)
+    segment_re = _SEGMENT_RE if isinstance(buffer, str) else _SEGMENT_BYTES_RE
+    for match in segment_re.finditer(buffer, start, end):
+        yield match.span()
+
+
+def iter_message_bounds(buffer: str, start: int = 0, end: int = None):
+    """
+    Yield (start, end) offsets of every message in buffer[start:end] in one
+    pass. A message runs from an "MSH|" that begins a line (after optional
+    spaces or tabs) up to the next one (or the end), so its trailing line
+    breaks are included; use strip_bounds() to trim them. Text before the
+    first MSH is not yielded.
+    """
+    if end is None:
+        end = len(buffer)
+    message_start = None
+    for match in _MESSAGE_START_RE.finditer(buffer, start, end):
+        if message_start is not None:
+            yield message_start, match.start(1)
+        message_start = match.start(1)
+    if message_start is not None:
+        yield message_start, end
+
+
+def iter_segments(buffer: str, start: int = 0, end: int = None):
+    """Yield a Segment view for every non-empty segment in buffer[start:end]."""
+    for seg_start, seg_end in iter_segment_bounds(buffer, start, end):
+        yield Segment(buffer, seg_start, seg_end)
+
+
+def iter_stream_segments(chunks):
+    """
+    Yield a Segment for every non-empty segment in an iterable of text chunks
+    (e.g. an incrementally decoded S3 StreamingBody). Only the current chunk,
+    plus the partial segment carried over from the previous one, is held in
+    memory; each Segment references the chunk it was found in.
+    """
+    carry = ""
+    for chunk in chunks:
+        if not chunk:
+            continue
+        buffer = carry + chunk if carry else chunk
+        last_terminator = max(buffer.rfind("\r"), buffer.rfind("\n"))
+        if last_terminator < 0:
+            carry = buffer
+            continue
+        yield from iter_segments(buffer, 0, last_terminator)
+        carry = buffer[last_terminator + 1:]
+    if carry:
+        yield from iter_segments(carry)
+
+
+class Segment:
+    """
+    A view of one HL7 segment inside a shared buffer.
+    """
+    __slots__ = ("buffer", "start", "end", "_separators", "_complete", "_edits")
+
+    def __init__(self, buffer: str, start: int = 0, end: int = None):
+        self.buffer = buffer
+        self.start = start
+        self.end = len(buffer) if end is None else end
+        self._separators = []
+        self._complete = False
+        self._edits = None
+
+    def __repr__(self) -> str:
+        return f"Segment({self.text()[:50]!r})"
+
+    @property
+    def name(self) -> str:
+        """The three character segment ID (MSH, PID, OBR, ...)."""
+        return self.buffer[self.start:min(self.start + 3, self.end)]
+
+    def startswith(self, prefix) -> bool:
+        """str.startswith() against the segment text; prefix may be a tuple."""
+        return self.buffer.startswith(prefix, self.start, self.end)
+
+    def text(self) -> str:
+        """The original segment text, ignoring any pending edits."""
+        return self.buffer[self.start:self.end]
+
+    def _scan(self, count: int) -> None:
+        """Locate field separators until `count` are known or the segment ends."""
+        separators = self._separators
+        buffer, end = self.buffer, self.end
+        while len(separators) < count and not self._complete:
+            pos = buffer.find(FIELD_SEPARATOR, separators[-1] + 1 if separators else self.start, end)
+            if pos < 0:
+                self._complete = True
+            else:
+                separators.append(pos)
+
+    def field_span(self, index: int):
+        """
+        Return (start, end) offsets of field `index` in the original buffer,
+        or None if the segment has fewer fields.
+        """
+        self._scan(index + 1)
+        separators = self._separators
+        if index > len(separators):
+            return None
+        field_start = self.start if index == 0 else separators[index - 1] + 1
+        field_end = separators[index] if index < len(separators) else self.end
+        return field_start, field_end
+
+    def has_field(self, index: int) -> bool:
+        """Equivalent to `len(line.split('|')) > index`."""
+        if self._edits and index in self._edits:
+            return True
+        return self.field_span(index) is not None
+
+    def field_count(self) -> int:
+        """Equivalent to `len(line.split('|'))`, including pending edits."""
+        self._scan(self.end)
+        count = len(self._separators) + 1
+        if self._edits:
+            count = max(count, max(self._edits) + 1)
+        return count
+
+    def field(self, index: int) -> str:
+        """Return field `index`, or '' if the segment has fewer fields."""
+        if self._edits and index in self._edits:
+            return self._edits[index]
+        span = self.field_span(index)
+        if span is None:
+            return ""
+        return self.buffer[span[0]:span[1]]
+
+    def component(self, index: int, component: int) -> str:
+        """
+        Return component `component` (0-based) of the first repetition of field
+        `index`, i.e. `field.split('^')[component]`, or '' if absent.
+        """
+        value = self.field(index)
+        if component == 0:
+            pos = value.find(COMPONENT_SEPARATOR)
+            return value if pos < 0 else value[:pos]
+        parts = value.split(COMPONENT_SEPARATOR, component + 1)
+        return parts[component] if len(parts) > component else ""
+
+    def set_field(self, index: int, value: str) -> None:
+        """
+        Replace field `index` with `value`. The buffer is not touched; the edit
+        is applied when the segment is rendered. Setting a field past the end
+        of the segment pads it with empty fields, as python-hl7 does.
+        """
+        if self._edits is None:
+            self._edits = {}
+        self._edits[index] = value
+
+    @property
+    def modified(self) -> bool:
+        return bool(self._edits)
+
+    def render(self) -> str:
+        """Return the segment text with any pending field edits applied."""
+        buffer = self.buffer
+        if not self._edits:
+            return buffer[self.start:self.end]
+
+        self._scan(self.end)
+        original_count = len(self._separators) + 1
+        parts = []
+        pos = self.start
+        count = original_count
+        for index in sorted(self._edits):
+            if index < original_count:
+                field_start, field_end = self.field_span(index)
+                parts.append(buffer[pos:field_start])
+                pos = field_end
+            else:
+                parts.append(buffer[pos:self.end])
+                pos = self.end
+                parts.append(FIELD_SEPARATOR * (index - count + 1))
+                count = index + 1
+            parts.append(self._edits[index])
+        parts.append(buffer[pos:self.end])
+        return "".join(parts)
+
+
+class Message:
+    """
+    An ordered group of segments (normally MSH up to the next MSH) that share
+    one buffer, plus any segments appended while cleaning.
+    """
+    __slots__ = ("segments", "_appended")
+
+    def __init__(self, segments: list = None):
+        self.segments = segments if segments is not None else []
+        self._appended = None
+
+    @classmethod
+    def parse(cls, buffer: str, start: int = 0, end: int = None) -> "Message":
+        """Index every segment in buffer[start:end] as one message."""
+        return cls(list(iter_segments(buffer, start, end)))
+
+    def first(self, name: str):
+        """Return the first segment with the given ID, or None."""
+        prefix = name + FIELD_SEPARATOR
+        for segment in self.segments:
+            if segment.startswith(prefix):
+                return segment
+        return None
+
+    def all(self, name: str) -> list:
+        """Return every segment with the given ID."""
+        prefix = name + FIELD_SEPARATOR
+        return [segment for segment in self.segments if segment.startswith(prefix)]
+
+    def count(self, name: str) -> int:
+        """Return the number of segments with the given ID."""
+        prefix = name + FIELD_SEPARATOR
+        return sum(1 for segment in self.segments if segment.startswith(prefix))
+
+    def append_segment(self, text: str) -> None:
+        """Append a new segment (given as text) after the existing ones."""
+        if self._appended is None:
+            self._appended = []
+        self._appended.append(text)
+
+    def render(self, separator: str = SEGMENT_SEPARATOR) -> str:
+        """Return the message with edits applied, segments joined by separator."""
+        lines = [segment.render() for segment in self.segments]
+        if self._appended:
+            lines.extend(self._appended)
+        return separator.join(lines)
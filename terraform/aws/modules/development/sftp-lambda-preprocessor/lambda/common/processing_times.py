@@ -0,0 +1,109 @@
+"""
+processing_times.py
+
+Per-file timing records written by the SFTP preprocessor lambdas
+(lambda_split_csv, lambda_split_dat, lambda_split_obr) and sftp/copy_to_inbox,
+and read by sftp/summary_report for its latency and throughput report.
+
+Each processed object becomes one item in the hl7-processing-times DynamoDB
+table, keyed by the UTC day it finished ("Day") and
+"<finished timestamp>#<stage>#<object key>" ("Slot"), so a report reads the
+last 24h with one Query per day.
+
+This file lives in lambda/common/ and is symlinked into each lambda directory
+so it is packaged alongside the handler (`zip -r` follows symlinks).
+"""
+import logging
+import os
+from datetime import datetime, timedelta, timezone
+
+import boto3
+
+TIMING_RETENTION_DAYS = max(int(os.environ.get("TIMING_RETENTION_DAYS", "30")), 1)  # TTL on timing records
+
+logger = logging.getLogger(__name__)
+
+
+def utc_now() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+def _utc_iso(moment: datetime) -> str:
+    # Naive UTC with fixed microseconds, matching datetime.utcnow().isoformat() and sorting as text
+    return moment.astimezone(timezone.utc).replace(tzinfo=None).isoformat(timespec="microseconds")
+
+
+def parse_event_time(s3_record: dict):
+    """Return the S3 event record's eventTime as an aware UTC datetime, or None if missing or malformed."""
+    event_time = s3_record.get("eventTime")
+    if not event_time:
+        return None
+    try:
+        parsed = datetime.fromisoformat(event_time.replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+
+def incoming_site_and_publisher(object_key: str) -> tuple:
+    """Site and publisher of a "sites/<site>/<publisher>/<dir>/<file>" key (the two components above the file's directory)."""
+    parts = object_key.split("/")
+    site = parts[-4] if len(parts) >= 4 else "unknown"
+    publisher = parts[-3] if len(parts) >= 3 else "unknown"
+    return site, publisher
+
+
+def timing_item(stage: str, object_key: str, site: str, publisher: str, event_time, started: datetime,
+                finished: datetime, byte_count: int, message_count: int) -> dict:
+    """
+    Build the hl7-processing-times item for one object. LatencyMs runs from the
+    S3 event time (when the object was written) to finished, or from started
+    when the event carries no time; DurationMs is the lambda's own share.
+    """
+    finished_iso = _utc_iso(finished)
+    item = {
+        "Day": finished_iso[:10],
+        "Slot": f"{finished_iso}#{stage}#{object_key}",
+        "Stage": stage,
+        "ObjectKey": object_key,
+        "Site": site,
+        "Publisher": publisher,
+        "Started": _utc_iso(started),
+        "Finished": finished_iso,
+        "LatencyMs": max(int((finished - (event_time or started)).total_seconds() * 1000), 0),
+        "DurationMs": max(int((finished - started).total_seconds() * 1000), 0),
+        "Bytes": int(byte_count or 0),
+        "Messages": int(message_count or 0),
+        "TTL": int((finished + timedelta(days=TIMING_RETENTION_DAYS)).timestamp()),
+    }
+    if event_time is not None:
+        item["EventTime"] = _utc_iso(event_time)
+    return item
+
+
+class ProcessingTimes:
+    """
+    Writes timing records to a DynamoDB table. With no table name every call is a
+    no-op, so a lambda deployed without the table keeps working unchanged.
+    Write failures are logged and never raised: timing must not fail a file.
+    """
+
+    def __init__(self, table_name: str, dynamodb=None):
+        self.table = (dynamodb or boto3.resource("dynamodb")).Table(table_name) if table_name else None
+
+    def record(self, stage: str, s3_record: dict, object_key: str, site: str, publisher: str,
+               started: datetime, message_count: int, byte_count: int = None) -> None:
+        """
+        Record one successfully processed object. byte_count defaults to the
+        object size in the S3 event record.
+        """
+        if self.table is None:
+            return
+        if byte_count is None:
+            byte_count = s3_record.get("s3", {}).get("object", {}).get("size", 0)
+        item = timing_item(stage, object_key, site, publisher, parse_event_time(s3_record), started,
+                           utc_now(), byte_count, message_count)
+        try:
+            self.table.put_item(Item=item)
+        except Exception as e:
+            logger.warning(f"Failed to write timing record for {object_key}: {e}")
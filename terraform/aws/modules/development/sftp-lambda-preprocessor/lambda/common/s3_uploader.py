@@ -0,0 +1,77 @@
+"""
+s3_uploader.py
+
+Bounded concurrent S3 writer shared by the SFTP preprocessor lambdas
+(lambda_split_csv, lambda_split_obr and sftp/copy_to_inbox).
+
+This file lives in lambda/common/ and is symlinked into each lambda directory
+so it is packaged alongside the handler (`zip -r` follows symlinks).
+"""
+import logging
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import boto3
+
+logger = logging.getLogger(__name__)
+
+
+class BoundedS3Uploader:
+    """
+    Uploads objects from a thread pool with at most max_in_flight put_object calls
+    outstanding; submit() blocks while the limit is reached. Results are handed to
+    on_success(tag, key) / on_error(tag, key, exception) on the submitting thread,
+    so callers can keep their accounting without locks.
+
+    Leaving the with block waits for every upload. If the block (or a callback)
+    raised, the uploads still in flight are reported as well; a callback that
+    raises then is logged, so the original exception is the one propagated.
+    """
+
+    def __init__(self, s3_client: boto3.client, bucket_name: str, max_in_flight: int, on_success, on_error):
+        self.s3_client = s3_client
+        self.bucket_name = bucket_name
+        self.max_in_flight = max_in_flight
+        self.on_success = on_success
+        self.on_error = on_error
+        self._executor = ThreadPoolExecutor(max_workers=max_in_flight)
+        self._pending = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            if exc_type is None:
+                self.drain()
+        finally:
+            self._drain_after_error()
+            self._executor.shutdown(wait=True)
+        return False
+
+    def submit(self, key: str, body: bytes, tag=None) -> None:
+        while len(self._pending) >= self.max_in_flight:
+            self._collect(wait(self._pending, return_when=FIRST_COMPLETED).done)
+        future = self._executor.submit(self.s3_client.put_object, Bucket=self.bucket_name, Key=key, Body=body)
+        self._pending[future] = (key, tag)
+
+    def drain(self) -> None:
+        """Wait for every outstanding upload and report its result."""
+        while self._pending:
+            self._collect(wait(self._pending).done)
+
+    def _drain_after_error(self) -> None:
+        while self._pending:
+            for future in wait(self._pending).done:
+                try:
+                    self._collect([future])
+                except Exception as e:
+                    logger.warning(f"Upload callback failed while finishing after an earlier error: {e}")
+
+    def _collect(self, done_futures) -> None:
+        for future in done_futures:
+            key, tag = self._pending.pop(future)
+            error = future.exception()
+            if error is None:
+                self.on_success(tag, key)
+            else:
+                self.on_error(tag, key, error)
@@ -0,0 +1 @@
+../common/hl7_core.py
\ No newline at end of file
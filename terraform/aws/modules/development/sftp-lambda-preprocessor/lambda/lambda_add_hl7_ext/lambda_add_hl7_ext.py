@@ -1,4 +1,5 @@
 import boto3
+import codecs
 import os
 import logging
 import json
@@ -9,6 +10,8 @@ from datetime import datetime
 from botocore.exceptions import ClientError
 from botocore.config import Config
 
+import hl7_core  # shared HL7 tokenizer, symlinked from ../common/
+
 # Optional: if you package the 'hl7' library with your Lambda, you can set USE_HL7_LIB=True to
 # rely on it for parsing. This script uses string parsing so it can run without that dependency.
 USE_HL7_LIB = False
@@ -34,6 +37,13 @@ PROCESSED_SUBDIRS = [OUTPUT_SUBDIR]
 MAX_S3_RETRIES = 3
 RETRYABLE_S3_ERRORS = {"NoSuchKey", "SlowDown", "InternalError", "RequestTimeout", "ThrottlingException"}
 
+# Streaming mode: source objects at least this large are cleaned message by message
+# and written with an S3 multipart upload, so memory does not grow with file size.
+STREAMING_THRESHOLD_BYTES = int(os.environ.get("STREAMING_THRESHOLD_BYTES", str(16 * 1024 * 1024)))
+STREAM_READ_CHUNK_BYTES = 1024 * 1024
+# S3 requires every multipart part except the last to be at least 5 MiB
+MULTIPART_PART_SIZE_BYTES = max(int(os.environ.get("MULTIPART_PART_SIZE_BYTES", str(8 * 1024 * 1024))), 5 * 1024 * 1024)
+
 
 # CDC/HL7 common code systems for race/ethnicity
 ALLOWED_CODE_SYSTEMS = {"CDCREC", "HL70005"}
@@ -81,17 +91,17 @@ def report_error(error_msg: str, context) -> None:
         logger.warning("SNS publish failed: %s", str(e))
 
 
-def get_s3_object_content(bucket: str, key: str) -> str:
+def open_s3_object(bucket: str, key: str) -> dict:
     """
-    Read S3 object with retries on common transient errors.
+    Call GetObject with retries on common transient errors. The body is not read;
+    callers either read it whole or stream it.
     """
     last_err = None
     for attempt in range(1, MAX_S3_RETRIES + 1):
         try:
             obj = s3_client.get_object(Bucket=bucket, Key=key)
-            body = obj["Body"].read().decode("utf-8", errors="replace")
-            logger.info("Successfully retrieved s3://%s/%s on attempt %d", bucket, key, attempt)
-            return body
+            logger.info("Successfully opened s3://%s/%s on attempt %d", bucket, key, attempt)
+            return obj
         except ClientError as e:
             code = e.response.get("Error", {}).get("Code")
             if code in RETRYABLE_S3_ERRORS:
@@ -109,16 +119,19 @@ def get_s3_object_content(bucket: str, key: str) -> str:
     raise RuntimeError(f"Failed to read s3://{bucket}/{key} for unknown reasons")
 
 
-def normalize_hl7_line_endings(text: str) -> str:
+def iter_s3_text_chunks(body, chunk_size: int = STREAM_READ_CHUNK_BYTES):
     """
-    Convert any \r\n or \n to HL7-standard \r; ensure message ends with \r.
+    Yield decoded text chunks from an S3 StreamingBody. Multi-byte UTF-8 sequences
+    split across chunk boundaries are handled by the incremental decoder.
     """
-    # Normalize first to \n, then to \r
-    text = text.replace("\r\n", "\n").replace("\r", "\n")
-    text = text.replace("\n", "\r")
-    if not text.endswith("\r"):
-        text += "\r"
-    return text
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    for chunk in body.iter_chunks(chunk_size):
+        text = decoder.decode(chunk)
+        if text:
+            yield text
+    tail = decoder.decode(b"", final=True)
+    if tail:
+        yield tail
 
 
 def valid_ts(value: str) -> bool:
@@ -146,22 +159,6 @@ def valid_ts(value: str) -> bool:
     return False
 
 
-def _split_fields(segment_line: str) -> list:
-    """
-    Split an HL7 segment line into fields by '|' preserving trailing empties.
-    """
-    # Keep trailing empties by manual split
-    parts = segment_line.rstrip("\r").split("|")
-    return parts
-
-
-def _join_fields(parts: list) -> str:
-    """
-    Rejoin fields with '|', ensure trailing empties preserved by simple join.
-    """
-    return "|".join(parts)
-
-
 def scrub_repeat_field(field_val: str, allowed_codes: set) -> str:
     """
     For PID-10 (Race) and PID-22 (Ethnic Group):
@@ -181,133 +178,130 @@ def scrub_repeat_field(field_val: str, allowed_codes: set) -> str:
             kept.append(rep)
     return "~".join(kept)
 
-def _is_batch_wrapper(line: str) -> bool:
-    """Return True if line is a batch wrapper segment (FHS, BHS, FTS, BTS)."""
-    return line.startswith(("FHS|", "BHS|", "FTS|", "BTS|"))
+def _is_batch_wrapper(segment: hl7_core.Segment) -> bool:
+    """Return True if segment is a batch wrapper segment (FHS, BHS, FTS, BTS)."""
+    return segment.startswith(("FHS|", "BHS|", "FTS|", "BTS|"))
 
 
-def _process_single_message(lines: list[str]) -> list[str]:
-    """Apply validation rules to a single HL7 message."""
-    if not lines or not any(ln.startswith("MSH|") for ln in lines):
+def _process_single_message(message: hl7_core.Message) -> str:
+    """Apply validation rules to a single HL7 message and return its cleaned text."""
+    if message.first("MSH") is None:
         logger.warning("Skipping message without MSH.")
-        return lines[:]
+        return message.render()
 
-    lines = lines[:]  # copy
-    _validate_msh(lines)
-    _validate_pid(lines)
-    return _process_orc(lines)
+    _validate_msh(message)
+    _validate_pid(message)
+    _process_orc(message)
+    return message.render()
 
 
-def _validate_msh(lines: list[str]) -> None:
-    msh_idx = next((i for i, ln in enumerate(lines) if ln.startswith("MSH|")), None)
-    if msh_idx is None:
+def _validate_msh(message: hl7_core.Message) -> None:
+    msh = message.first("MSH")
+    if msh is None:
         logger.warning("MSH segment not found.")
         return
 
-    msh_fields = _split_fields(lines[msh_idx])
-    if len(msh_fields) > 6 and not valid_ts(msh_fields[6]):
-        logger.warning("MSH-7 appears malformed: '%s'", msh_fields[6])
+    if msh.has_field(6) and not valid_ts(msh.field(6)):
+        logger.warning("MSH-7 appears malformed: '%s'", msh.field(6))
 
 
-def _validate_pid(lines: list[str]) -> None:
-    pid_idx = next((i for i, ln in enumerate(lines) if ln.startswith("PID|")), None)
-    if pid_idx is None:
+def _validate_pid(message: hl7_core.Message) -> None:
+    pid = message.first("PID")
+    if pid is None:
         logger.warning("PID segment not found.")
         return
 
-    pid_fields = _split_fields(lines[pid_idx])
-
     # PID-3 Identifier
-    if len(pid_fields) > 3 and not pid_fields[3]:
+    if pid.has_field(3) and not pid.field(3):
         logger.warning("PID-3 (Patient Identifier List) is empty or missing.")
 
     # PID-5 Name
-    if len(pid_fields) > 5 and not pid_fields[5]:
+    if pid.has_field(5) and not pid.field(5):
         logger.warning("PID-5 (Patient Name) is empty or missing.")
 
     # PID-7 DOB
-    if len(pid_fields) > 7 and pid_fields[7] and not valid_ts(pid_fields[7]):
-        logger.warning("PID-7 (DOB) appears malformed: '%s'", pid_fields[7])
+    if pid.has_field(7) and pid.field(7) and not valid_ts(pid.field(7)):
+        logger.warning("PID-7 (DOB) appears malformed: '%s'", pid.field(7))
 
     # PID-33 Last Update
-    if len(pid_fields) > 33 and pid_fields[33] and not valid_ts(pid_fields[33]):
-        logger.warning("PID-33 invalid. Clearing value: '%s'", pid_fields[33])
-        pid_fields[33] = ""
-        lines[pid_idx] = _join_fields(pid_fields)
+    if pid.has_field(33) and pid.field(33) and not valid_ts(pid.field(33)):
+        logger.warning("PID-33 invalid. Clearing value: '%s'", pid.field(33))
+        pid.set_field(33, "")
 
     # PID-10 Race
-    if len(pid_fields) > 10:
-        cleaned = scrub_repeat_field(pid_fields[10], ALLOWED_RACE_CODES)
-        if cleaned != pid_fields[10]:
-            logger.info("Cleaned PID-10 (Race) from '%s' to '%s'", pid_fields[10], cleaned)
-            pid_fields[10] = cleaned
-            lines[pid_idx] = _join_fields(pid_fields)
+    if pid.has_field(10):
+        original = pid.field(10)
+        cleaned = scrub_repeat_field(original, ALLOWED_RACE_CODES)
+        if cleaned != original:
+            logger.info("Cleaned PID-10 (Race) from '%s' to '%s'", original, cleaned)
+            pid.set_field(10, cleaned)
 
     # PID-22 Ethnicity
-    if len(pid_fields) > 22:
-        cleaned = scrub_repeat_field(pid_fields[22], ALLOWED_ETHNICITY_CODES)
-        if cleaned != pid_fields[22]:
-            logger.info("Cleaned PID-22 (Ethnic Group) from '%s' to '%s'", pid_fields[22], cleaned)
-            pid_fields[22] = cleaned
-            lines[pid_idx] = _join_fields(pid_fields)
-
-
-def _process_orc(lines: list[str]) -> list[str]:
-    """Extract ORC-23.9 notes and append them as NTE segments."""
-    new_lines, orc_note = [], None
-
-    for ln in lines:
-        new_lines.append(ln)
-        if ln.startswith("ORC|"):
-            fields = _split_fields(ln)
-            if len(fields) > 23 and fields[23]:
-                comps = fields[23].split("^")
-                if len(comps) >= 9 and comps[8].strip():
-                    orc_note = comps[8].strip()
-                    comps[8] = ""
-                    fields[23] = "^".join(comps)
-                    new_lines[-1] = _join_fields(fields)
+    if pid.has_field(22):
+        original = pid.field(22)
+        cleaned = scrub_repeat_field(original, ALLOWED_ETHNICITY_CODES)
+        if cleaned != original:
+            logger.info("Cleaned PID-22 (Ethnic Group) from '%s' to '%s'", original, cleaned)
+            pid.set_field(22, cleaned)
+
+
+def _process_orc(message: hl7_core.Message) -> None:
+    """Extract ORC-23.9 notes and append them as an NTE segment."""
+    orc_note = None
+
+    for orc in message.all("ORC"):
+        if orc.has_field(23) and orc.field(23):
+            comps = orc.field(23).split("^")
+            if len(comps) >= 9 and comps[8].strip():
+                orc_note = comps[8].strip()
+                comps[8] = ""
+                orc.set_field(23, "^".join(comps))
 
     if orc_note:
         logger.info("Appending NTE at end of message from ORC-23.9.")
-        new_lines.append(f"NTE|1|L|{orc_note}")
-
-    return new_lines
+        message.append_segment(f"NTE|1|L|{orc_note}")
 
-def validate_and_clean_hl7(message_text: str) -> str:
+def iter_cleaned_hl7(segments):
     """
-    Clean and validate HL7 messages:
-      - normalize line endings
-      - validate MSH-7, PID fields, and scrub race/ethnicity
-      - move ORC-23.9 notes to NTE segments
-      - handle batch wrappers (FHS, BHS, FTS, BTS)
-    Returns cleaned HL7 content.
+    Group segments into messages and yield the cleaned output one piece at a time:
+    each cleaned message, batch wrapper segment, or line found before the first MSH.
+    Consumes segments lazily, so it works the same over a whole buffer or a stream.
     """
-    text = normalize_hl7_line_endings(message_text)
-    all_lines = [ln for ln in text.split("\r") if ln]
-
-    output_lines, current_msg = [], []
+    current_msg = None
 
-    for ln in all_lines:
-        if _is_batch_wrapper(ln):
-            output_lines.append(ln)
+    for segment in segments:
+        if _is_batch_wrapper(segment):
+            # A wrapper ends the current message, so flush it first to keep file order
+            if current_msg:
+                yield _process_single_message(current_msg)
+                current_msg = None
+            yield segment.text()
             continue
 
-        if ln.startswith("MSH|"):
+        if segment.startswith("MSH|"):
             if current_msg:
-                output_lines.extend(_process_single_message(current_msg))
-                current_msg = []
-            current_msg.append(ln)
+                yield _process_single_message(current_msg)
+            current_msg = hl7_core.Message([segment])
         elif current_msg:
-            current_msg.append(ln)
+            current_msg.segments.append(segment)
         else:
             # pass through lines before first MSH
-            output_lines.append(ln)
+            yield segment.text()
 
     if current_msg:
-        output_lines.extend(_process_single_message(current_msg))
+        yield _process_single_message(current_msg)
 
-    cleaned = "\r".join(output_lines)
+
+def validate_and_clean_hl7(message_text: str) -> str:
+    """
+    Clean and validate HL7 messages:
+      - normalize line endings
+      - validate MSH-7, PID fields, and scrub race/ethnicity
+      - move ORC-23.9 notes to NTE segments
+      - handle batch wrappers (FHS, BHS, FTS, BTS)
+    Returns cleaned HL7 content.
+    """
+    cleaned = "\r".join(iter_cleaned_hl7(hl7_core.iter_segments(message_text)))
     return cleaned if cleaned.endswith("\r") else cleaned + "\r"
 
 
@@ -353,6 +347,96 @@ def write_s3_object(bucket: str, key: str, body: str) -> None:
     logger.info("Wrote object to s3://%s/%s (bytes=%d)", bucket, key, len(body.encode("utf-8")))
 
 
+class S3MultipartWriter:
+    """
+    Buffers encoded output and uploads it as multipart parts of part_size bytes.
+    The multipart upload is only started once a full part is buffered; smaller
+    outputs are written with a single put_object on close().
+    """
+
+    def __init__(self, bucket: str, key: str, part_size: int = MULTIPART_PART_SIZE_BYTES):
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.bytes_written = 0
+        self.has_content = False
+        self._buffer = []
+        self._buffered = 0
+        self._upload_id = None
+        self._parts = []
+
+    def write(self, text: str) -> None:
+        if not self.has_content and text and not text.isspace():
+            self.has_content = True
+        data = text.encode("utf-8")
+        self._buffer.append(data)
+        self._buffered += len(data)
+        self.bytes_written += len(data)
+        if self._buffered >= self.part_size:
+            self._upload_part()
+
+    def _upload_part(self) -> None:
+        if self._upload_id is None:
+            response = s3_client.create_multipart_upload(Bucket=self.bucket, Key=self.key)
+            self._upload_id = response["UploadId"]
+            logger.info("Started multipart upload to s3://%s/%s", self.bucket, self.key)
+        part_number = len(self._parts) + 1
+        body = b"".join(self._buffer)
+        self._buffer, self._buffered = [], 0
+        response = s3_client.upload_part(
+            Bucket=self.bucket, Key=self.key, UploadId=self._upload_id,
+            PartNumber=part_number, Body=body,
+        )
+        self._parts.append({"ETag": response["ETag"], "PartNumber": part_number})
+        logger.info("Uploaded part %d (bytes=%d) to s3://%s/%s", part_number, len(body), self.bucket, self.key)
+
+    def close(self) -> None:
+        """Write any buffered output and complete the upload."""
+        if self._upload_id is None:
+            s3_client.put_object(Bucket=self.bucket, Key=self.key, Body=b"".join(self._buffer))
+            self._buffer, self._buffered = [], 0
+        else:
+            if self._buffer:
+                self._upload_part()
+            s3_client.complete_multipart_upload(
+                Bucket=self.bucket, Key=self.key, UploadId=self._upload_id,
+                MultipartUpload={"Parts": self._parts},
+            )
+        logger.info("Wrote object to s3://%s/%s (bytes=%d)", self.bucket, self.key, self.bytes_written)
+
+    def abort(self) -> None:
+        """Discard buffered output and abort the multipart upload, if one was started."""
+        self._buffer, self._buffered = [], 0
+        if self._upload_id is not None:
+            try:
+                s3_client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self._upload_id)
+            except Exception as e:
+                logger.warning("Failed to abort multipart upload for s3://%s/%s: %s", self.bucket, self.key, str(e))
+            self._upload_id = None
+
+
+def stream_clean_hl7_to_s3(body, bucket: str, output_key: str) -> int:
+    """
+    Streaming mode: clean the HL7 in an S3 StreamingBody message by message and
+    write the result to output_key. Returns the number of output bytes, or 0 if
+    the cleaned content was empty and nothing was written.
+    """
+    writer = S3MultipartWriter(bucket, output_key)
+    segments = hl7_core.iter_stream_segments(iter_s3_text_chunks(body))
+    try:
+        for piece in iter_cleaned_hl7(segments):
+            writer.write(piece)
+            writer.write("\r")
+        if not writer.has_content:
+            writer.abort()
+            return 0
+        writer.close()
+    except Exception:
+        writer.abort()
+        raise
+    return writer.bytes_written
+
+
 def _process_record(record: dict, context) -> None:
     s3_info = record.get("s3", {})
     bucket = s3_info.get("bucket", {}).get("name")
@@ -381,13 +465,21 @@ def _process_record(record: dict, context) -> None:
 
     # Read, validate/clean, and write single file
     try:
-        content = get_s3_object_content(bucket, decoded_key)
-        logger.info("Read %d bytes from source file.", len(content))
-        cleaned = validate_and_clean_hl7(content)
-        if not cleaned.strip():
-            logger.warning("Cleaned content is empty; skipping write for %s", decoded_key)
-            return
-        write_s3_object(bucket, output_key, cleaned)
+        obj = open_s3_object(bucket, decoded_key)
+        content_length = obj.get("ContentLength") or 0
+        if content_length >= STREAMING_THRESHOLD_BYTES:
+            logger.info("Streaming %d byte source file.", content_length)
+            if not stream_clean_hl7_to_s3(obj["Body"], bucket, output_key):
+                logger.warning("Cleaned content is empty; skipping write for %s", decoded_key)
+                return
+        else:
+            content = obj["Body"].read().decode("utf-8", errors="replace")
+            logger.info("Read %d bytes from source file.", len(content))
+            cleaned = validate_and_clean_hl7(content)
+            if not cleaned.strip():
+                logger.warning("Cleaned content is empty; skipping write for %s", decoded_key)
+                return
+            write_s3_object(bucket, output_key, cleaned)
         logger.info("Successfully processed and renamed file to %s", output_key)
     except Exception as e:
         err = f"Failed processing s3://{bucket}/{decoded_key}: {str(e)}\n{traceback.format_exc()}"
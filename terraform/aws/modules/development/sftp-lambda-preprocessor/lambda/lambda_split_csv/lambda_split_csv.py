@@ -1,15 +1,23 @@
 
 import boto3
+import codecs
 import os
 import time
 import logging
 import json
 import traceback
 import csv
+import functools
 import io
+import operator
+import re
 from datetime import datetime
 import urllib.parse
 import sys
+from botocore.config import Config
+
+from s3_uploader import BoundedS3Uploader  # shared uploader, symlinked from ../common/
+from processing_times import ProcessingTimes, utc_now  # per-file timing records, symlinked from ../common/
 
 # --- Configuration Constants ---
 PROCESSED_SUBDIRS = ["splitcsv", "splitdat", "splitobr"]
@@ -18,6 +26,45 @@ INCOMING_DIR_NAME = "incoming"
 OUTPUT_FILE_EXTENSION = "hl7"
 ERROR_TOPIC_ENV_VAR = 'ERROR_TOPIC_ARN'
 CSV_FILE_EXTENSION = '.csv'
+CSV_STREAM_CHUNK_BYTES = 64 * 1024 # S3 body is decoded and fed to the CSV reader in chunks of this size
+UPLOAD_CONCURRENCY = max(int(os.environ.get('UPLOAD_CONCURRENCY', '16')), 1) # max in-flight HL7 put_object calls per file
+TIMING_TABLE = os.environ.get('TIMING_TABLE', '') # hl7-processing-times table for per-file timing records; empty disables them
+TIMING_STAGE = "split_csv"
+
+# --- CSV Conversion Engine ---
+# 'row' (default) converts one csv.DictReader row at a time; 'columnar' converts chunks of
+# CSV_CHUNK_ROWS rows column by column. Both produce identical output.
+CSV_ENGINE = os.environ.get('CSV_ENGINE', 'row').strip().lower()
+CSV_CHUNK_ROWS = max(int(os.environ.get('CSV_CHUNK_ROWS', '200')), 1)
+
+# --- HL7 Batch Output ---
+# 1 (default) writes one HL7 message per CSV row. N > 1 packs up to N messages into one
+# FHS/BHS ... BTS/FTS batch file. HL7_BATCH_SIZE_BY_SITE overrides it per site, e.g. '{"siteA": 500}'.
+HL7_BATCH_SIZE = max(int(os.environ.get('HL7_BATCH_SIZE', '1')), 1)
+
+def _parse_batch_sizes_by_site(value: str) -> dict:
+    """Parses HL7_BATCH_SIZE_BY_SITE; anything but a JSON object is logged and ignored (HL7_BATCH_SIZE applies)."""
+    try:
+        sizes = json.loads(value or '{}')
+    except ValueError:
+        sizes = None
+    if not isinstance(sizes, dict):
+        logging.getLogger().warning(f"Invalid HL7_BATCH_SIZE_BY_SITE {value!r}, expected a JSON object. Using {HL7_BATCH_SIZE} for every site.")
+        return {}
+    return sizes
+
+HL7_BATCH_SIZE_BY_SITE = _parse_batch_sizes_by_site(os.environ.get('HL7_BATCH_SIZE_BY_SITE', ''))
+# --- Accession Grouping ---
+# 1 (default) writes one ORU message per CSV row. N > 1 collapses up to N consecutive rows with
+# the same AccessionNumber and Patient_ID into one message with one OBR and one OBX per row.
+ACCESSION_GROUP_SIZE = max(int(os.environ.get('ACCESSION_GROUP_SIZE', '1')), 1)
+
+RECEIVING_APPLICATION = "VIDOH"
+RECEIVING_FACILITY = "VI"
+
+# --- Date Normalization ---
+# Converted dates are memoized per value (TestDate/SpecimenCollectionDate repeat heavily)
+DATE_CACHE_SIZE = max(int(os.environ.get('DATE_CACHE_SIZE', '4096')), 1)
 
 # --- HL7 Delimiters (Standard) ---
 FIELD_DELIMITER = "|"
@@ -46,16 +93,27 @@ logger.setLevel(logging.INFO)
 # --- GLOBAL DEBUG MODE VARIABLE ---
 GLOBAL_DEBUG_MODE = int(os.environ.get('DEBUG_MODE', '0')) # Default to 0 (off).
 
+# --- Per-file timing records (no-op when TIMING_TABLE is empty) ---
+processing_times = ProcessingTimes(TIMING_TABLE)
+
 # --- Helper Dictionaries and Functions ---
 
+_sns_client = None
+
+def _get_sns_client():
+    """Returns the SNS client, creating it once per container on first use."""
+    global _sns_client
+    if _sns_client is None:
+        _sns_client = boto3.client('sns')
+    return _sns_client
+
 def report_error(error_msg: str, context) -> None:
     """Reports an error by logging it and attempting to publish to an SNS topic."""
     logger.error(error_msg)
     try:
-        sns = boto3.client('sns')
         topic_arn = os.environ.get(ERROR_TOPIC_ENV_VAR)
         if topic_arn:
-            sns.publish(
+            _get_sns_client().publish(
                 TopicArn=topic_arn,
                 Subject=f"Lambda Error in {context.function_name if context else 'lambda_split_csv'}",
                 Message=error_msg
@@ -101,6 +159,40 @@ def datetime_format_check(date_string, debug_mode: int, include_offset=False):
         
     return hl7_date
 
+# Canonical 'mm/dd/yyyy' or 'mm/dd/yyyy HH:MM:SS' (ASCII digits, zero padded). Anything
+# else, including values this pattern matches but datetime rejects, goes to strptime.
+_US_DATE_RE = re.compile(r"([0-9]{2})/([0-9]{2})/([0-9]{4})(?: ([0-9]{2}):([0-9]{2}):([0-9]{2}))?")
+
+@functools.lru_cache(maxsize=DATE_CACHE_SIZE)
+def _normalize_date(date_string: str) -> str:
+    """datetime_format_check() without the offset, with a regex fast path."""
+    match = _US_DATE_RE.fullmatch(date_string.strip())
+    if match is not None:
+        month, day, year, hour, minute, second = match.groups()
+        # strftime('%Y') does not zero pad years before 1000
+        if int(year) >= 1000:
+            try:
+                datetime(int(year), int(month), int(day), int(hour or 0), int(minute or 0), int(second or 0))
+            except ValueError:
+                pass
+            else:
+                if hour is None:
+                    return year + month + day
+                return year + month + day + hour + minute + second
+    return datetime_format_check(date_string, GLOBAL_DEBUG_MODE)
+
+def normalize_hl7_date(date_string, include_offset=False) -> str:
+    """
+    Memoized equivalent of datetime_format_check(date_string, GLOBAL_DEBUG_MODE, include_offset).
+    Each distinct value is parsed once and shared by every segment that uses it.
+    """
+    if not date_string:
+        return ""
+    hl7_date = _normalize_date(date_string)
+    if include_offset and hl7_date:
+        return hl7_date + "-0500"
+    return hl7_date
+
 def get_ethnicity_cwe(code: str) -> str:
     """Returns a formatted CWE string for a given ethnicity code."""
     ethnicity_map = {"H": "H^Hispanic or Latino^HL70189", "N": "N^Not Hispanic or Latino^HL70189", "U": "U^Unknown^HL70189"}
@@ -176,8 +268,8 @@ def generate_msh(row, message_id_for_msh, debug_mode):
     
     message_datetime = datetime_format_check(row.get('TestDate', ''), debug_mode, include_offset=True)
     
-    receiving_application = "VIDOH"
-    receiving_facility = "VI"
+    receiving_application = RECEIVING_APPLICATION
+    receiving_facility = RECEIVING_FACILITY
     message_type = "ORU^R01^ORU_R01"
     processing_id = "P"
     version_id = "2.5.1"
@@ -288,15 +380,443 @@ def generate_hl7_message_from_csv_row(row: dict, message_id_for_msh: str, sendin
     
     return "\r".join(filter(None, hl7_message_parts))
 
+# --- Precompiled HL7 Message Template ---
+# The generate_* functions above are the reference implementation. The template below
+# produces byte-for-byte the same message, but the segment layouts are parsed once at
+# cold start, every escaped column of a row is escaped in one pass, and each distinct
+# (transform, column) pair is evaluated once per row.
+
+# Single-pass equivalent of escape_hl7(): each special character maps to exactly what
+# the chained str.replace() calls turn it into (including the re-escaped backslashes).
+_HL7_ESCAPE_TABLE = str.maketrans({char: escape_hl7(char) for char in "\r\n|^~\\&"})
+_TEMPLATE_VALUE_SEPARATOR = "\x00"
+
+def _needs_hl7_escape(text: str) -> bool:
+    """True if text contains any character escape_hl7() would change."""
+    return ("|" in text or "^" in text or "~" in text or "\\" in text
+            or "&" in text or "\n" in text or "\r" in text)
+
+def escape_hl7_fast(text):
+    """Same output as escape_hl7(), returning clean values without copying them."""
+    if text is None:
+        return ""
+    if not isinstance(text, str):
+        text = str(text)
+    if not _needs_hl7_escape(text):
+        return text
+    return text.translate(_HL7_ESCAPE_TABLE)
+
+def escape_hl7_values(values: tuple):
+    """
+    escape_hl7_fast() applied to every value, using a single scan (and, if needed,
+    a single translate) over all of them joined together.
+    """
+    try:
+        joined = _TEMPLATE_VALUE_SEPARATOR.join(values)
+    except TypeError:
+        # None or non-string values
+        return [escape_hl7_fast(value) for value in values]
+    if not _needs_hl7_escape(joined):
+        return values
+    if joined.count(_TEMPLATE_VALUE_SEPARATOR) != len(values) - 1:
+        return [escape_hl7_fast(value) for value in values]
+    return joined.translate(_HL7_ESCAPE_TABLE).split(_TEMPLATE_VALUE_SEPARATOR)
+
+# Coded-value lookups are pure functions of a handful of distinct values, so the
+# template memoizes them (exceptions, e.g. for a missing value, are not cached).
+_cached_ethnicity_cwe = functools.lru_cache(maxsize=256)(get_ethnicity_cwe)
+_cached_test_result_cwe = functools.lru_cache(maxsize=256)(get_test_result_cwe)
+_cached_specimen_type_cwe = functools.lru_cache(maxsize=256)(get_specimen_type_cwe)
+
+# Value transforms available to the template as {name:Column}. Each takes one column
+# value and must match what the reference generators do with it.
+HL7_TEMPLATE_TRANSFORMS = {
+    "esc": escape_hl7_fast,
+    "date": normalize_hl7_date,
+    "date_tz": lambda value: normalize_hl7_date(value, include_offset=True),
+    "zip": lambda value: str(value).zfill(5),
+    "phone": lambda value: escape_hl7_fast(value).replace('-', ''),
+    "ethnicity": _cached_ethnicity_cwe,
+    "result": lambda value: _cached_test_result_cwe(value)[0],
+    "abnormal": lambda value: _cached_test_result_cwe(value)[1],
+    "specimen": _cached_specimen_type_cwe,
+}
+
+# Columns the template reads, by index, and the default used when the row lacks one
+TEMPLATE_COLUMNS = CSV_HEADERS + ["SendingApplication"]
+TEMPLATE_COLUMN_DEFAULTS = [
+    (column, {"SendingApplication": "UnknownApp", "SendingFacility": "UnknownFacility"}.get(column, ""))
+    for column in TEMPLATE_COLUMNS
+]
+_csv_header_getter = operator.itemgetter(*CSV_HEADERS)
+
+_PROVIDER_XCN_LAYOUT = "9999999999^{esc:OrderingProviderLastName}^{esc:OrderingProviderFirstName}^^^^NPI&2.16.840.1.113883.4.6&ISO^^^^NPI"
+
+# One layout per segment, in message order; see generate_msh() ... generate_spm()
+HL7_SEGMENT_LAYOUTS = [
+    "MSH|^~\\&|{esc:SendingApplication}^^2.16.840.1.113883.3.362.90.100^ISO|{esc:SendingFacility}^^34D0655059^CLIA|"
+    f"{RECEIVING_APPLICATION}|{RECEIVING_FACILITY}|{{date_tz:TestDate}}|VI001|ORU^R01^ORU_R01|{{message_id}}|P|2.5.1|"
+    "||AL|USA||||PHLabReport-NoAck^^2.16.840.1.113883.9.11^ISO|PHLabReport-NoAck^^2.16.840.1.113883.9.11^ISO",
+
+    "PID|1||{esc:Patient_ID}^^^PI^PI|{esc:MRN}^^^MR^MR|{esc:PtLastName}^{esc:PtFirstName}^{esc:PtMI}||"
+    "{date:DateOfBirth}|{esc:Sex}||{esc:Race}|{esc:PatientStreet}^{esc:PatientStreet2}^{esc:PatientCity}^{esc:PatientState}^{zip:PatientZipcode}||"
+    "{esc:PatientPhoneNumber}|||||||||{ethnicity:Ethnicity}",
+
+    f"PV1|1|O|||||{_PROVIDER_XCN_LAYOUT}|||||||||||||||||||||||||||||||||||{{date_tz:SpecimenCollectionDate}}",
+
+    "ORC|RE|{esc:AccessionNumber}|{esc:AccessionNumber}||||||||"
+    f"|{_PROVIDER_XCN_LAYOUT}|||||||||{{esc:OrderingFacilityName}}|"
+    "{esc:OrderingFacilityAddress}^^{esc:OrderingFacilityCity}^{esc:OrderingFacilityState}^{zip:OrderingFacilityZip}|"
+    "^WPN^PH^^^^{phone:OrderingFacilityPhone}",
+
+    "OBR|1|{esc:AccessionNumber}|{esc:AccessionNumber}|{esc:OrderedTest_ID}^{esc:OrderedTest_name}^LN|||"
+    "{date:SpecimenCollectionDate}|||||||{date:SpecimenCollectionDate}|{esc:SpecimenSite}||||||||||F",
+
+    "OBX|1|CWE|{esc:ResultedTestID}^{esc:ResultedTestName}^LN^|1|{result:TestResult}|||{abnormal:TestResult}"
+    "|||F|||{date:TestDate}|{esc:PerformingLab}^^^^^CLIA&2.16.840.1.113883.4.7&ISO^XX^^^34D0655059||"
+    "0128^Nucleic acid probe with amplification^OBSMETHOD||{date:TestDate}",
+
+    "SPM|1|{esc:AccessionNumber}||{specimen:SpecimenSite}|||{date:SpecimenCollectionDate}",
+]
+
+# Segments only written when the column holds non-blank text; see generate_nte_for_notes()
+HL7_OPTIONAL_SEGMENT_LAYOUTS = [
+    ("Notes", "NTE|1|L|{esc:Notes}"),
+]
+
+_TEMPLATE_PLACEHOLDER_RE = re.compile(r"\{(?:(\w+):(\w+)|message_id)\}")
+
+
+def _tuple_getter(indexes: list):
+    """operator.itemgetter() that always returns a tuple, even for one index."""
+    if len(indexes) == 1:
+        index = indexes[0]
+        return lambda sequence: (sequence[index],)
+    return operator.itemgetter(*indexes)
+
+
+class HL7MessageTemplate:
+    """
+    HL7 segment layouts compiled into literal pieces and value slots over a row of
+    column values (ordered as TEMPLATE_COLUMNS). A placeholder is either {message_id}
+    or {transform:Column}; every distinct {transform:Column} becomes one slot that is
+    computed once per row no matter how many times the layouts repeat it.
+
+    Per row the template:
+      - escapes all {esc:...} columns together with escape_hl7_values()
+      - calls the remaining transforms once per slot
+      - fills the slots into a copy of the literal pieces and joins them
+    """
+
+    def __init__(self, segment_layouts: list, optional_segment_layouts: list = (), columns: list = TEMPLATE_COLUMNS):
+        self.column_index = {column: index for index, column in enumerate(columns)}
+        main_tokens = self._tokenize("\r".join(segment_layouts))
+        optional_tokens = [
+            (self.column_index[column], self._tokenize("\r" + layout))
+            for column, layout in optional_segment_layouts
+        ]
+
+        # Slot argument numbers: 0 is the message ID, then escaped columns, then other transforms
+        slots = []
+        for tokens in [main_tokens] + [tokens for _, tokens in optional_tokens]:
+            for token in tokens[1::2]:
+                if token is not None and token not in slots:
+                    slots.append(token)
+        self.escaped_columns = [index for name, index in slots if name == "esc"]
+        self.transformed_slots = [(name, index) for name, index in slots if name != "esc"]
+        self._slot_numbers = {None: 0}
+        for number, slot in enumerate([("esc", index) for index in self.escaped_columns] + self.transformed_slots, start=1):
+            self._slot_numbers[slot] = number
+
+        self._escaped_getter = _tuple_getter(self.escaped_columns) if self.escaped_columns else (lambda values: ())
+        self._transforms = [(HL7_TEMPLATE_TRANSFORMS[name], index) for name, index in self.transformed_slots]
+        self._main = self._compile(main_tokens)
+        self._optional = [(column_index, self._compile(tokens)) for column_index, tokens in optional_tokens]
+
+    def _tokenize(self, layout: str) -> list:
+        """
+        Split a layout into alternating [literal, slot, literal, ..., literal] where a
+        slot is (transform name, column index), or None for {message_id}.
+        """
+        tokens = []
+        pos = 0
+        for match in _TEMPLATE_PLACEHOLDER_RE.finditer(layout):
+            tokens.append(layout[pos:match.start()])
+            pos = match.end()
+            transform, column = match.groups()
+            if transform is None:
+                tokens.append(None)
+                continue
+            if transform not in HL7_TEMPLATE_TRANSFORMS:
+                raise ValueError(f"Unknown HL7 template transform '{transform}' in layout: {layout}")
+            if column not in self.column_index:
+                raise ValueError(f"Unknown HL7 template column '{column}' in layout: {layout}")
+            tokens.append((transform, self.column_index[column]))
+        tokens.append(layout[pos:])
+        return tokens
+
+    def _compile(self, tokens: list) -> tuple:
+        """Return (literal pieces with slot positions blank, getter for the slot arguments)."""
+        pieces = [token if i % 2 == 0 else "" for i, token in enumerate(tokens)]
+        numbers = [self._slot_numbers[token] for token in tokens[1::2]]
+        return pieces, (_tuple_getter(numbers) if numbers else None)
+
+    @staticmethod
+    def _assemble(compiled: tuple, args: list) -> str:
+        pieces, getter = compiled
+        if getter is None:
+            return pieces[0]
+        pieces = pieces.copy()
+        pieces[1::2] = getter(args)
+        return "".join(pieces)
+
+    def render(self, values: list, message_id: str) -> str:
+        """Build the message for one row of column values (str or None)."""
+        args = [message_id]
+        args.extend(escape_hl7_values(self._escaped_getter(values)))
+        args.extend([transform(values[index]) for transform, index in self._transforms])
+        message = self._assemble(self._main, args)
+        for column_index, compiled in self._optional:
+            value = values[column_index]
+            if value and value.strip():
+                message += self._assemble(compiled, args)
+        return message
+
+    def render_columns(self, columns: list, message_ids: list) -> list:
+        """
+        Build the messages for a chunk of rows given column-major values: columns[i]
+        holds TEMPLATE_COLUMNS[i] for every row. Each distinct value of a column is
+        transformed once for the whole chunk. Returns one entry per row, either the
+        message or the exception render() would have raised for that row.
+        """
+        errors = [None] * len(message_ids)
+        slot_columns = [self._escape_column(columns[index]) for index in self.escaped_columns]
+        slot_columns.extend(self._transform_column(transform, columns[index], errors) for transform, index in self._transforms)
+
+        results = []
+        optional = [(columns[column_index], compiled) for column_index, compiled in self._optional]
+        for row, args in enumerate(zip(message_ids, *slot_columns)):
+            if errors[row] is not None:
+                results.append(errors[row])
+                continue
+            message = self._assemble(self._main, args)
+            for column, compiled in optional:
+                value = column[row]
+                if value and value.strip():
+                    message += self._assemble(compiled, args)
+            results.append(message)
+        return results
+
+    @staticmethod
+    def _escape_column(column: tuple):
+        # One scan over the whole column; a column with special characters is escaped
+        # once per distinct value (translating the joined column costs more)
+        if None in column:
+            column = ["" if value is None else value for value in column]
+        if not _needs_hl7_escape(_TEMPLATE_VALUE_SEPARATOR.join(column)):
+            return column
+        escaped = {value: escape_hl7_fast(value) for value in set(column)}
+        return [escaped[value] for value in column]
+
+    @staticmethod
+    def _transform_column(transform, column: tuple, errors: list) -> list:
+        transformed = {}
+        failed = {}
+        for value in set(column):
+            try:
+                transformed[value] = transform(value)
+            except Exception as e:
+                transformed[value] = ""
+                failed[value] = e
+        if failed:
+            for row, value in enumerate(column):
+                if value in failed and errors[row] is None:
+                    errors[row] = failed[value]
+        return [transformed[value] for value in column]
+
+
+HL7_MESSAGE_TEMPLATE = HL7MessageTemplate(HL7_SEGMENT_LAYOUTS, HL7_OPTIONAL_SEGMENT_LAYOUTS)
+
+def render_hl7_message_from_csv_row(row: dict, message_id_for_msh: str) -> str:
+    """
+    Generates the same HL7 ORU^R01 message as generate_hl7_message_from_csv_row()
+    using the precompiled HL7_MESSAGE_TEMPLATE.
+    """
+    try:
+        # DictReader rows that passed perform_basic_sanity_checks() have every CSV_HEADERS key
+        values = list(_csv_header_getter(row))
+        values.append(row.get("SendingApplication", "UnknownApp"))
+    except KeyError:
+        values = [row.get(column, default) for column, default in TEMPLATE_COLUMN_DEFAULTS]
+    return HL7_MESSAGE_TEMPLATE.render(values, message_id_for_msh)
+
+def _csv_message_id(patient_id, accession_number, row_number: int) -> str:
+    return f"{patient_id}_{accession_number}_{row_number}_{int(time.time())}"
+
+def iter_hl7_messages_by_row(csv_reader: csv.DictReader):
+    """
+    Row engine: yields (row_number, row, hl7_message, error) for each CSV row, with
+    exactly one of hl7_message / error set.
+    """
+    for i, row in enumerate(csv_reader):
+        row_number = i + 1
+        try:
+            message_id = _csv_message_id(row.get('Patient_ID', 'NA'), row.get('AccessionNumber', 'NA'), row_number)
+            hl7_message = render_hl7_message_from_csv_row(row, message_id)
+        except Exception as e:
+            yield row_number, row, None, e
+            continue
+        yield row_number, row, hl7_message, None
+
+def csv_row_to_dict(fieldnames: list, values: list) -> dict:
+    """The dict csv.DictReader would have produced for one row of values."""
+    row = dict(zip(fieldnames, values))
+    if len(values) > len(fieldnames):
+        row[None] = values[len(fieldnames):]
+    else:
+        for name in fieldnames[len(values):]:
+            row[name] = None
+    return row
+
+def iter_hl7_messages_by_column(csv_reader: csv.DictReader, chunk_rows: int = CSV_CHUNK_ROWS):
+    """
+    Columnar engine: reads up to chunk_rows rows at a time from the underlying
+    csv.reader (no per-row dicts), transposes them into per-column tuples and
+    renders the chunk with HL7_MESSAGE_TEMPLATE.render_columns().
+
+    Yields the same (row_number, row, hl7_message, error) tuples, in the same order,
+    as iter_hl7_messages_by_row(), except that row is the list of field values;
+    use csv_row_to_dict() to get the row engine's dict. Headers must already have
+    passed perform_basic_sanity_checks().
+    """
+    fieldnames = csv_reader.fieldnames
+    field_count = len(fieldnames)
+    # dict(zip(fieldnames, row)) keeps the last of any duplicated header
+    field_index = {name: index for index, name in enumerate(fieldnames)}
+    column_sources = [(field_index.get(column), default) for column, default in TEMPLATE_COLUMN_DEFAULTS]
+    patient_id_column = TEMPLATE_COLUMNS.index('Patient_ID')
+    accession_column = TEMPLATE_COLUMNS.index('AccessionNumber')
+
+    def convert(chunk, first_row_number):
+        # Short rows are padded with None and long rows truncated, as DictReader would see them
+        padded = [
+            row if len(row) == field_count else (row + [None] * (field_count - len(row)))[:field_count]
+            for row in chunk
+        ]
+        file_columns = list(zip(*padded))
+        columns = [
+            file_columns[source] if source is not None else (default,) * len(chunk)
+            for source, default in column_sources
+        ]
+        message_ids = [
+            _csv_message_id(patient_id, accession_number, row_number)
+            for row_number, patient_id, accession_number in zip(
+                range(first_row_number, first_row_number + len(chunk)), columns[patient_id_column], columns[accession_column]
+            )
+        ]
+        results = HL7_MESSAGE_TEMPLATE.render_columns(columns, message_ids)
+        for offset, (row, result) in enumerate(zip(chunk, results)):
+            if isinstance(result, Exception):
+                yield first_row_number + offset, row, None, result
+            else:
+                yield first_row_number + offset, row, result, None
+
+    chunk = []
+    row_number = 1
+    for row in csv_reader.reader:
+        if not row:
+            # DictReader skips blank lines
+            continue
+        chunk.append(row)
+        if len(chunk) >= chunk_rows:
+            yield from convert(chunk, row_number)
+            row_number += len(chunk)
+            chunk = []
+    if chunk:
+        yield from convert(chunk, row_number)
+
+def merge_accession_messages(hl7_messages: list) -> str:
+    """
+    Collapses the single-row messages of one accession into one ORU^R01 message:
+    the first row's MSH, PID, PV1, ORC and OBR, then each row's OBX (renumbered),
+    then the first row's SPM, then each row's NTE (renumbered). Segments keep the
+    order of a single-row message, where the NTE follows the SPM.
+    """
+    if len(hl7_messages) == 1:
+        return hl7_messages[0]
+    # Escaped values never contain '\r', so splitting on it only splits segments
+    order_segments, observation_segments, specimen_segments, note_segments = [], [], [], []
+    for message_number, hl7_message in enumerate(hl7_messages):
+        for segment in hl7_message.split("\r"):
+            if segment.startswith("OBX|"):
+                observation_segments.append(f"OBX|{len(observation_segments) + 1}|{segment.split(FIELD_DELIMITER, 2)[2]}")
+            elif segment.startswith("NTE|"):
+                note_segments.append(f"NTE|{len(note_segments) + 1}|{segment.split(FIELD_DELIMITER, 2)[2]}")
+            elif message_number == 0:
+                (specimen_segments if segment.startswith("SPM|") else order_segments).append(segment)
+    return "\r".join(order_segments + observation_segments + specimen_segments + note_segments)
+
+def group_messages_by_accession(converted_rows, accession_key, max_group_rows: int):
+    """
+    Streams (row_number, row, hl7_message, error) tuples into (rows, hl7_message, error)
+    groups, rows being a list of (row_number, row). Consecutive rows whose
+    accession_key(row) (AccessionNumber, Patient_ID) match are merged with
+    merge_accession_messages(), up to max_group_rows per message; a group is flushed
+    as soon as the accession changes. Rows without an AccessionNumber, and failed
+    rows, are never grouped.
+    """
+    group_rows, group_messages, group_key = [], [], None
+    for row_number, row, hl7_message, error in converted_rows:
+        if error is not None:
+            yield [(row_number, row)], None, error
+            continue
+        key = accession_key(row)
+        if group_rows and (key != group_key or not key[0] or len(group_rows) >= max_group_rows):
+            yield group_rows, merge_accession_messages(group_messages), None
+            group_rows, group_messages = [], []
+        group_rows.append((row_number, row))
+        group_messages.append(hl7_message)
+        group_key = key
+    if group_rows:
+        yield group_rows, merge_accession_messages(group_messages), None
+
+def generate_hl7_batch(hl7_messages: list, sending_application: str, batch_control_id: str) -> str:
+    """
+    Wraps complete HL7 messages in a single-batch HL7 file (FHS/BHS ... BTS/FTS).
+    """
+    created = datetime.now().strftime("%Y%m%d%H%M%S")
+    # FHS-2 .. FHS-11 (BHS uses the same layout): encoding characters, sending application and
+    # facility, receiving application and facility, creation time, security, name, comment, control ID
+    header = FIELD_DELIMITER.join([
+        f"{COMPONENT_DELIMITER}{REPETITION_DELIMITER}{ESCAPE_CHARACTER}{SUBCOMPONENT_DELIMITER}",
+        escape_hl7(sending_application), "",
+        RECEIVING_APPLICATION, RECEIVING_FACILITY,
+        created, "", "", "",
+        escape_hl7(batch_control_id),
+    ])
+    batch_parts = [f"FHS{FIELD_DELIMITER}{header}", f"BHS{FIELD_DELIMITER}{header}"]
+    batch_parts.extend(hl7_messages)
+    batch_parts.append(f"BTS{FIELD_DELIMITER}{len(hl7_messages)}")
+    batch_parts.append(f"FTS{FIELD_DELIMITER}1")
+    return "\r".join(batch_parts)
+
+def get_batch_size_for_site(site: str) -> int:
+    """Returns the number of messages per output file for a site (1 = one message per file)."""
+    try:
+        return max(int(HL7_BATCH_SIZE_BY_SITE.get(site, HL7_BATCH_SIZE)), 1)
+    except (TypeError, ValueError):
+        logger.warning(f"Invalid HL7_BATCH_SIZE_BY_SITE value for site '{site}'. Using {HL7_BATCH_SIZE}.")
+        return HL7_BATCH_SIZE
+
 
-def get_s3_object_content(s3_client: boto3.client, bucket_name: str, key: str, context) -> str:
+def get_s3_object_stream(s3_client: boto3.client, bucket_name: str, key: str, context):
     """
-    Retrieves the content of an S3 object with retries.
+    Opens an S3 object with retries and returns its StreamingBody without reading it.
     """
     for attempt in range(3):
         try:
             obj = s3_client.get_object(Bucket=bucket_name, Key=key)
-            return obj['Body'].read().decode('utf-8-sig')
+            return obj['Body']
         except s3_client.exceptions.NoSuchKey:
             logger.warning(f"Attempt {attempt+1}: Key not found: {key}. Retrying...")
             time.sleep(1)
@@ -307,15 +827,113 @@ def get_s3_object_content(s3_client: boto3.client, bucket_name: str, key: str, c
     raise RuntimeError(f"Failed to retrieve S3 object after 3 attempts: {key}")
 
 
+def iter_csv_lines(body, chunk_size: int = CSV_STREAM_CHUNK_BYTES):
+    """
+    Yields lines (with their trailing newline) from an S3 StreamingBody, decoding
+    'utf-8-sig' incrementally so that only one chunk is held in memory at a time.
+    Lines are split on '\n' only, matching how io.StringIO fed csv.DictReader.
+    """
+    decoder = codecs.getincrementaldecoder('utf-8-sig')()
+    pending = ""
+    for chunk in body.iter_chunks(chunk_size):
+        text = decoder.decode(chunk)
+        if pending:
+            text = pending + text
+        start = 0
+        while True:
+            newline = text.find("\n", start)
+            if newline < 0:
+                break
+            yield text[start:newline + 1]
+            start = newline + 1
+        pending = text[start:]
+    pending += decoder.decode(b"", final=True)
+    if pending:
+        yield pending
+
+
+class CsvRejectCollector:
+    """
+    Collects the CSV rows of one file that could not be converted or uploaded, so
+    they are written as a single reject CSV (the original columns plus RowNumber and
+    ErrorReason) and reported with one notification, instead of one S3 object and
+    one SNS message per row.
+    """
+
+    def __init__(self, fieldnames: list):
+        self.fieldnames = list(fieldnames)
+        self.rejected = []  # (row_number, values, reason)
+        self.first_error = None
+
+    def __len__(self) -> int:
+        return len(self.rejected)
+
+    def add(self, row_number: int, row: dict, error: Exception) -> None:
+        reason = f"{type(error).__name__}: {error}"
+        if self.first_error is None:
+            # Only the first traceback is logged; the rest are usually the same problem
+            self.first_error = f"row {row_number}: {reason}"
+            formatted_traceback = ''.join(traceback.format_exception(type(error), error, error.__traceback__))
+            logger.error(f"Failed to process CSV row {row_number}: {error}\n{formatted_traceback}")
+        else:
+            logger.error(f"Failed to process CSV row {row_number}: {reason}")
+        self.rejected.append((row_number, [row.get(name) for name in self.fieldnames], reason))
+
+    def to_csv(self) -> str:
+        output = io.StringIO()
+        writer = csv.writer(output)
+        writer.writerow(self.fieldnames + ["RowNumber", "ErrorReason"])
+        # Upload failures are reported out of order
+        for row_number, values, reason in sorted(self.rejected, key=lambda rejected: rejected[0]):
+            writer.writerow(values + [row_number, reason])
+        return output.getvalue()
+
+
+def _write_rejects(
+    s3_client: boto3.client, s3_bucket_name: str, error_file_output_dir: str, error_file_base_name: str,
+    rejects: CsvRejectCollector, processed_count: int, context
+) -> None:
+    """Writes the reject CSV for a file and sends one summary notification."""
+    reject_key = f"{error_file_output_dir}{error_file_base_name}_rejects.csv"
+    try:
+        s3_client.put_object(Bucket=s3_bucket_name, Key=reject_key, Body=rejects.to_csv().encode('utf-8'))
+        location = f"s3://{s3_bucket_name}/{reject_key}"
+    except Exception as e:
+        location = f"not written ({reject_key}: {e})"
+    report_error(
+        f"{len(rejects)} of {len(rejects) + processed_count} CSV rows failed for {error_file_base_name}. "
+        f"Rejected rows: {location}. First error: {rejects.first_error}",
+        context
+    )
+
+
 def process_csv_content_and_upload_hl7(
     s3_client: boto3.client, s3_bucket_name: str, success_key_template: str, error_file_output_dir: str,
-    error_file_base_name: str, csv_content: str, sending_application: str, context
+    error_file_base_name: str, csv_content, sending_application: str, context, batch_size: int = 1,
+    engine: str = 'row', accession_group_size: int = 1
 ) -> int:
     """
     Processes the content of a CSV file, generates HL7 messages for each row, 
     and uploads them to S3.
+
+    csv_content is either the whole CSV as a string or an iterable of lines
+    (see iter_csv_lines); rows are converted and uploaded as they are read.
+    Uploads run concurrently, up to UPLOAD_CONCURRENCY at a time.
+
+    With batch_size > 1, up to batch_size messages are written per HL7 batch
+    file named with "batch_<n>" in place of the row number.
+
+    engine selects iter_hl7_messages_by_row() ('row') or
+    iter_hl7_messages_by_column() ('columnar'); the output is the same.
+
+    With accession_group_size > 1, consecutive rows of the same accession are
+    merged into one message (see group_messages_by_accession) written under the
+    first row's number.
+
+    Rows that fail to convert or upload are collected and written once, at the
+    end, to <error_file_base_name>_rejects.csv in error_file_output_dir.
     """
-    csv_file = io.StringIO(csv_content)
+    csv_file = io.StringIO(csv_content) if isinstance(csv_content, str) else csv_content
     
     try:
         csv_reader = csv.DictReader(csv_file)
@@ -328,28 +946,75 @@ def process_csv_content_and_upload_hl7(
     if not perform_basic_sanity_checks(csv_reader, context):
         return 0
 
+    if engine == 'columnar':
+        converted_rows = iter_hl7_messages_by_column(csv_reader, CSV_CHUNK_ROWS)
+        row_to_dict = functools.partial(csv_row_to_dict, csv_reader.fieldnames)
+        field_index = {name: index for index, name in enumerate(csv_reader.fieldnames)}
+        accession_index, patient_index = field_index['AccessionNumber'], field_index['Patient_ID']
+        accession_key = lambda row: (
+            row[accession_index] if accession_index < len(row) else None,
+            row[patient_index] if patient_index < len(row) else None,
+        )
+    else:
+        converted_rows = iter_hl7_messages_by_row(csv_reader)
+        row_to_dict = lambda row: row
+        accession_key = lambda row: (row.get('AccessionNumber'), row.get('Patient_ID'))
+
+    if accession_group_size > 1:
+        message_groups = group_messages_by_accession(converted_rows, accession_key, accession_group_size)
+    else:
+        message_groups = (([(row_number, row)], hl7_message, error) for row_number, row, hl7_message, error in converted_rows)
+
     processed_count = 0
-    for i, row in enumerate(csv_reader):
-        row_number = i + 1
-        try:
-            message_id = f"{row.get('Patient_ID', 'NA')}_{row.get('AccessionNumber', 'NA')}_{row_number}_{int(time.time())}"
-            
-            hl7_message = generate_hl7_message_from_csv_row(row, message_id, sending_application, GLOBAL_DEBUG_MODE)
-            
-            output_key = success_key_template.format(row_number)
-            
-            s3_client.put_object(Bucket=s3_bucket_name, Key=output_key, Body=hl7_message.encode('utf-8'))
-            processed_count += 1
-            logger.info(f"Successfully generated and uploaded HL7 for row {row_number} to {output_key}")
+    rejects = CsvRejectCollector(csv_reader.fieldnames)
+
+    # Upload tags are lists of (row_number, row) so a batch can be accounted per row
+    def on_uploaded(tag, output_key):
+        nonlocal processed_count
+        processed_count += len(tag)
+        if len(tag) == 1:
+            logger.info(f"Successfully generated and uploaded HL7 for row {tag[0][0]} to {output_key}")
+        else:
+            logger.info(f"Successfully generated and uploaded HL7 for rows {tag[0][0]}-{tag[-1][0]} to {output_key}")
+
+    def on_upload_failed(tag, output_key, error):
+        for row_number, row in tag:
+            rejects.add(row_number, row_to_dict(row), error)
+
+    batch_messages, batch_rows = [], []
+    batch_number = 0
+
+    def submit_batch(uploader):
+        nonlocal batch_messages, batch_rows, batch_number
+        batch_number += 1
+        batch_content = generate_hl7_batch(batch_messages, sending_application, f"{error_file_base_name}_batch_{batch_number}")
+        uploader.submit(success_key_template.format(f"batch_{batch_number}"), batch_content.encode('utf-8'), tag=batch_rows)
+        batch_messages, batch_rows = [], []
+
+    try:
+        with BoundedS3Uploader(s3_client, s3_bucket_name, UPLOAD_CONCURRENCY, on_uploaded, on_upload_failed) as uploader:
+            for rows, hl7_message, error in message_groups:
+                if error is not None:
+                    row_number, row = rows[0]
+                    rejects.add(row_number, row_to_dict(row), error)
+                    continue
+
+                if batch_size <= 1:
+                    uploader.submit(success_key_template.format(rows[0][0]), hl7_message.encode('utf-8'), tag=rows)
+                    continue
+
+                batch_messages.append(hl7_message)
+                batch_rows.extend(rows)
+                if len(batch_messages) >= batch_size:
+                    submit_batch(uploader)
+
+            if batch_messages:
+                submit_batch(uploader)
+    finally:
+        # Rows rejected before an unexpected failure are still written
+        if rejects:
+            _write_rejects(s3_client, s3_bucket_name, error_file_output_dir, error_file_base_name, rejects, processed_count, context)
 
-        except Exception as e:
-            error_message = f"Failed to process CSV row {row_number}: {e}\n{traceback.format_exc()}"
-            report_error(error_message, context)
-            
-            error_key = f"{error_file_output_dir}{error_file_base_name}_{row_number}_error.txt"
-            error_content = f"Error: {error_message}\nRow Data: {json.dumps(row)}"
-            s3_client.put_object(Bucket=s3_bucket_name, Key=error_key, Body=error_content.encode('utf-8'))
-            
     return processed_count
 
 def lambda_handler(event, context):
@@ -358,9 +1023,11 @@ def lambda_handler(event, context):
     """
     logger.info("Received event: %s", json.dumps(event, indent=2))
     
-    s3_client = boto3.client('s3')
+    # botocore clients are thread safe; size the connection pool for the upload threads
+    s3_client = boto3.client('s3', config=Config(max_pool_connections=UPLOAD_CONCURRENCY))
 
     for record in event['Records']:
+        started = utc_now()
         s3_bucket_name = record['s3']['bucket']['name']
         s3_object_key = urllib.parse.unquote_plus(record['s3']['object']['key'])
         
@@ -387,14 +1054,19 @@ def lambda_handler(event, context):
             success_key_template = f"{success_output_dir}{base_filename}_{{}}.{OUTPUT_FILE_EXTENSION}"
             error_output_dir = f"{base_output_path}/{SPLITCSV_ERROR_SUBDIR}/"
 
-            csv_content = get_s3_object_content(s3_client, s3_bucket_name, s3_object_key, context)
+            site = key_parts[-4] if len(key_parts) >= 4 else ''
+            batch_size = get_batch_size_for_site(site)
+
+            csv_body = get_s3_object_stream(s3_client, s3_bucket_name, s3_object_key, context)
             
             message_count = process_csv_content_and_upload_hl7(
                 s3_client, s3_bucket_name, success_key_template, error_output_dir,
-                base_filename, csv_content, sending_application, context
+                base_filename, iter_csv_lines(csv_body), sending_application, context,
+                batch_size=batch_size, engine=CSV_ENGINE, accession_group_size=ACCESSION_GROUP_SIZE
             )
             
             logger.info(f"Processed {message_count} messages from {s3_object_key}")
+            processing_times.record(TIMING_STAGE, record, s3_object_key, site, key_parts[-3], started, message_count)
 
         except Exception as e:
             report_error(f"Unhandled error for {s3_object_key}: {e}\n{traceback.format_exc()}", context)
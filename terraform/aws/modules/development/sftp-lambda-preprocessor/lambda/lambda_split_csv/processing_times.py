@@ -0,0 +1 @@
+../common/processing_times.py
\ No newline at end of file
@@ -0,0 +1 @@
+../common/s3_uploader.py
\ No newline at end of file
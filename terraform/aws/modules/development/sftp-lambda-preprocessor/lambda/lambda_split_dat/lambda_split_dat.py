@@ -5,6 +5,7 @@ import os
 import time
 import logging
 import json
+import itertools
 import traceback
 import re
 import hl7 # Make sure this library is included in your Lambda deployment package
@@ -13,6 +14,9 @@ import urllib.parse
 from datetime import datetime
 from botocore.exceptions import ClientError
 
+import hl7_core  # shared HL7 tokenizer, symlinked from ../common/
+from processing_times import ProcessingTimes, incoming_site_and_publisher, utc_now  # symlinked from ../common/
+
 # --- Configuration Constants ---
 DEFAULT_SPLIT_SUBDIR = "splitdat"
 MULTI_OBR_OUTPUT_SUBDIR = "splitdat_multi_obr"
@@ -21,14 +25,19 @@ INCOMING_DIR_NAME = "incoming"
 OUTPUT_FILE_EXTENSION = "hl7"
 ERROR_TOPIC_ENV_VAR = 'ERROR_TOPIC_ARN'
 DAT_FILE_EXTENSION = '.dat'
-HL7_MESSAGE_SEPARATOR = 'MSH'
 HL7_FIELD_DELIMITER = '|'
 HL7_COMPONENT_DELIMITER = '^'
 MAX_S3_RETRIES = 3
 S3_RETRY_DELAY_SECONDS = 2
+# Clean messages with the hl7_core fast path where it is safe; '0' always uses python-hl7
+HL7_FAST_PATH_ENABLED = os.environ.get('HL7_FAST_PATH', '1') != '0'
+HL7_STANDARD_MSH_PREFIX = 'MSH|^~\\&|'
+HL7_BATCH_HEADER_PREFIXES = ('FHS|', 'BHS|', '\ufeffFHS|', '\ufeffBHS|')
+TIMING_TABLE = os.environ.get('TIMING_TABLE', '') # hl7-processing-times table for per-file timing records; empty disables them
+TIMING_STAGE = "split_dat"
 
 # --- HL7 Field Indices ---
-MSH_MESSAGE_CONTROL_ID_IDX = 9
+MSH_MESSAGE_CONTROL_ID_IDX = 9 # read via hl7_core (split('|') numbering, i.e. MSH-10)
 MSH_DATE_TIME_OF_MESSAGE_IDX = 6
 PID_PATIENT_IDENTIFIER_LIST_IDX = 2
 PID_PATIENT_NAME_IDX = 4
@@ -51,6 +60,7 @@ logger.setLevel(logging.INFO)
 s3_client = boto3.client('s3')
 sns_client = boto3.client('sns')
 cloudwatch_client = boto3.client('cloudwatch')
+processing_times = ProcessingTimes(TIMING_TABLE)
 
 def report_error(error_msg: str, context) -> None:
     logger.error(error_msg)
@@ -169,82 +179,147 @@ def set_field_value(segment: hl7.Segment, index: int, value: str):
         segment.append('')
     segment[index] = value
 
+def _check_msh_fields(get_field, msg_id: str) -> None:
+    """MSH checks shared by both cleaning paths; get_field(index) uses python-hl7 MSH numbering."""
+    msh_7_value = get_field(MSH_DATE_TIME_OF_MESSAGE_IDX)
+    if msh_7_value and not is_valid_hl7_datetime(msh_7_value):
+        logger.warning(f"HL7 Validation Warning (Msg ID: {msg_id}): MSH-7 malformed: '{msh_7_value}'.")
+
+def _clean_pid_fields(get_field, set_field, msg_id: str) -> None:
+    """PID checks and rewrites shared by both cleaning paths."""
+    pid_33_value = get_field(PID_LAST_UPDATE_DATE_TIME_IDX)
+    if pid_33_value and not is_valid_hl7_datetime(pid_33_value):
+        logger.warning(f"HL7 Validation Warning (Msg ID: {msg_id}): PID-33 invalid: '{pid_33_value}'. Clearing.")
+        set_field(PID_LAST_UPDATE_DATE_TIME_IDX, '')
+    if not get_field(PID_PATIENT_IDENTIFIER_LIST_IDX):
+         logger.warning(f"HL7 Validation Warning (Msg ID: {msg_id}): PID-3 is empty.")
+    if not get_field(PID_PATIENT_NAME_IDX):
+         logger.warning(f"HL7 Validation Warning (Msg ID: {msg_id}): PID-5 is empty.")
+    pid_7_value = get_field(PID_DATE_OF_BIRTH_IDX)
+    if pid_7_value and not is_valid_hl7_datetime(pid_7_value):
+         logger.warning(f"HL7 Validation Warning (Msg ID: {msg_id}): PID-7 malformed: '{pid_7_value}'.")
+
+    raw_pid_10 = get_field(PID_RACE_IDX)
+    if raw_pid_10:
+        cleaned_pid_10 = validate_and_clean_hl7_coded_field(raw_pid_10, VALID_RACE_CODES, VALID_RACE_SYSTEMS, "PID-10 (Race)", msg_id)
+        set_field(PID_RACE_IDX, cleaned_pid_10)
+    raw_pid_22 = get_field(PID_ETHNIC_GROUP_IDX)
+    if raw_pid_22:
+        cleaned_pid_22 = validate_and_clean_hl7_coded_field(raw_pid_22, VALID_ETHNIC_CODES, VALID_ETHNIC_SYSTEMS, "PID-22 (Ethnic Group)", msg_id)
+        set_field(PID_ETHNIC_GROUP_IDX, cleaned_pid_22)
+
 def clean_hl7_message(msg: hl7.Message, msg_id: str) -> hl7.Message:
     try:
         msh = msg.segment('MSH')
-        msh_7_value = get_field_value(msh, MSH_DATE_TIME_OF_MESSAGE_IDX)
-        if msh_7_value and not is_valid_hl7_datetime(msh_7_value):
-            logger.warning(f"HL7 Validation Warning (Msg ID: {msg_id}): MSH-7 malformed: '{msh_7_value}'.")
+        _check_msh_fields(lambda index: get_field_value(msh, index), msg_id)
     except KeyError:
         logger.warning(f"[{msg_id}]: MSH segment not found for cleaning.")
 
     try:
         pid = msg.segment('PID')
-        pid_33_value = get_field_value(pid, PID_LAST_UPDATE_DATE_TIME_IDX)
-        if pid_33_value and not is_valid_hl7_datetime(pid_33_value):
-            logger.warning(f"HL7 Validation Warning (Msg ID: {msg_id}): PID-33 invalid: '{pid_33_value}'. Clearing.")
-            set_field_value(pid, PID_LAST_UPDATE_DATE_TIME_IDX, '')
-        if not get_field_value(pid, PID_PATIENT_IDENTIFIER_LIST_IDX):
-             logger.warning(f"HL7 Validation Warning (Msg ID: {msg_id}): PID-3 is empty.")
-        if not get_field_value(pid, PID_PATIENT_NAME_IDX):
-             logger.warning(f"HL7 Validation Warning (Msg ID: {msg_id}): PID-5 is empty.")
-        pid_7_value = get_field_value(pid, PID_DATE_OF_BIRTH_IDX)
-        if pid_7_value and not is_valid_hl7_datetime(pid_7_value):
-             logger.warning(f"HL7 Validation Warning (Msg ID: {msg_id}): PID-7 malformed: '{pid_7_value}'.")
-
-        raw_pid_10 = get_field_value(pid, PID_RACE_IDX)
-        if raw_pid_10:
-            cleaned_pid_10 = validate_and_clean_hl7_coded_field(raw_pid_10, VALID_RACE_CODES, VALID_RACE_SYSTEMS, "PID-10 (Race)", msg_id)
-            set_field_value(pid, PID_RACE_IDX, cleaned_pid_10)
-        raw_pid_22 = get_field_value(pid, PID_ETHNIC_GROUP_IDX)
-        if raw_pid_22:
-            cleaned_pid_22 = validate_and_clean_hl7_coded_field(raw_pid_22, VALID_ETHNIC_CODES, VALID_ETHNIC_SYSTEMS, "PID-22 (Ethnic Group)", msg_id)
-            set_field_value(pid, PID_ETHNIC_GROUP_IDX, cleaned_pid_22)
+        _clean_pid_fields(
+            lambda index: get_field_value(pid, index),
+            lambda index, value: set_field_value(pid, index, value),
+            msg_id
+        )
     except KeyError:
         logger.warning(f"[{msg_id}]: PID segment not found for cleaning.")
     return msg
 
+def clean_hl7_message_fast(hl7_message_str: str, segment_index: hl7_core.Message, msg_id: str):
+    """
+    Returns the same text as str(clean_hl7_message(hl7.parse(hl7_message_str), msg_id))
+    without building the python-hl7 object tree: only the MSH and PID segments are
+    read, only the PID fields cleaning changes are rewritten, and the rest of the
+    message is sliced from the original string.
+
+    hl7_message_str must already be stripped with '\r' segment separators, and
+    segment_index must be hl7_core.Message.parse(hl7_message_str). Returns None
+    for messages only python-hl7 handles the same way (non-standard encoding
+    characters, an empty segment python-hl7 fails on, or a bare 'PID' segment
+    python-hl7 would pick up).
+    """
+    if not hl7_message_str.startswith(HL7_STANDARD_MSH_PREFIX) or '\r\r' in hl7_message_str:
+        return None
+    if '\rPID\r' in hl7_message_str or hl7_message_str.endswith('\rPID'):
+        return None
+
+    msh = segment_index.segments[0]
+    # python-hl7 counts MSH-1 (the field separator) as a field; split('|') does not
+    _check_msh_fields(lambda index: msh.field(index - 1), msg_id)
+
+    pid = segment_index.first('PID')
+    if pid is None:
+        logger.warning(f"[{msg_id}]: PID segment not found for cleaning.")
+        return hl7_message_str + '\r'
+    _clean_pid_fields(pid.field, pid.set_field, msg_id)
+    if not pid.modified:
+        return hl7_message_str + '\r'
+    # python-hl7 ends every message with the segment separator
+    return hl7_message_str[:pid.start] + pid.render() + hl7_message_str[pid.end:] + '\r'
+
 def process_dat_content(
     s3_bucket_name: str,
     output_key_template_single_obr: str,
     output_key_template_multi_obr: str,
     content: str,
     context
-) -> None:
+) -> int:
+    """Clean and write each HL7 message in the DAT content; returns the number of messages written."""
     logger.info("Starting to process DAT file content with HL7 library.")
-    raw_message_parts = content.split(HL7_MESSAGE_SEPARATOR)
     message_write_sequence = 0
 
-    for i, msg_body_part in enumerate(raw_message_parts):
-        if i == 0 and not msg_body_part.strip():
-            logger.debug("Skipping empty part before first MSH.")
-            continue
-        if not msg_body_part.strip():
-            logger.info(f"Skipping empty message part at index {i} (after MSH split).")
-            continue
-
-        hl7_message_str = HL7_MESSAGE_SEPARATOR + msg_body_part.strip()
-        hl7_message_str = hl7_message_str.replace('\r\n', '\r').replace('\n', '\r')
+    # Messages start only where a line begins with "MSH|", found in one pass; each
+    # message is sliced out of the content once, when it is processed.
+    message_bounds = hl7_core.iter_message_bounds(content)
+    first_bounds = next(message_bounds, None)
+    preamble_end = first_bounds[0] if first_bounds is not None else len(content)
+    preamble_segments = [segment for segment in hl7_core.iter_segments(content, 0, preamble_end) if segment.text().strip('\ufeff \t')]
+    if all(segment.startswith(HL7_BATCH_HEADER_PREFIXES) for segment in preamble_segments):
+        if preamble_segments:
+            logger.info(f"Skipping {len(preamble_segments)} batch header segment(s) before the first MSH.")
+    else:
+        report_error(
+            f"Skipping text before the first MSH segment: '{content[:min(preamble_end, 100)]}...'",
+            context
+        )
+    if first_bounds is None:
+        logger.warning("No MSH segment found at the start of any line. Nothing to process.")
+        return 0
+    message_bounds = itertools.chain([first_bounds], message_bounds)
+
+    for i, (message_start, message_end) in enumerate(message_bounds, start=1):
+        message_start, message_end = hl7_core.strip_bounds(content, message_start, message_end)
+        hl7_message_str = content[message_start:message_end]
+        if '\n' in hl7_message_str:
+            hl7_message_str = hl7_message_str.replace('\r\n', '\r').replace('\n', '\r')
         logger.debug(f"Processing raw HL7 message part starting with: '{hl7_message_str[:100]}...'")
 
         try:
-            parsed_message = hl7.parse(hl7_message_str)
-            try:
-                 message_id_for_log = str(parsed_message.segment('MSH')[MSH_MESSAGE_CONTROL_ID_IDX]) or f"Part_{i}"
-            except (KeyError, IndexError):
-                 message_id_for_log = f"Part_{i}_(MSHErr)"
-            logger.info(f"Successfully parsed. Cleaning HL7 message with ID: {message_id_for_log}")
+            # Read the message ID and OBR count from the segment index; only the
+            # cleaning step needs the full python-hl7 object model.
+            segment_index = hl7_core.Message.parse(hl7_message_str)
+            msh_segment = segment_index.first('MSH')
+            if msh_segment is not None and msh_segment.has_field(MSH_MESSAGE_CONTROL_ID_IDX):
+                message_id_for_log = msh_segment.field(MSH_MESSAGE_CONTROL_ID_IDX) or f"Part_{i}"
+            else:
+                message_id_for_log = f"Part_{i}_(MSHErr)"
 
-            cleaned_message = clean_hl7_message(parsed_message, message_id_for_log)
-            final_hl7_message = str(cleaned_message).replace('\r', '\n')
+            cleaned_message = None
+            if HL7_FAST_PATH_ENABLED:
+                cleaned_message = clean_hl7_message_fast(hl7_message_str, segment_index, message_id_for_log)
+            if cleaned_message is None:
+                parsed_message = hl7.parse(hl7_message_str)
+                logger.info(f"Successfully parsed. Cleaning HL7 message with ID: {message_id_for_log}")
+                cleaned_message = str(clean_hl7_message(parsed_message, message_id_for_log))
+            final_hl7_message = cleaned_message.replace('\r', '\n')
 
             if not final_hl7_message.strip():
                 logger.warning(f"[{message_id_for_log}]: Message became empty after cleaning. Skipping write.")
                 continue
 
             # OBR Counting Logic
-            obr_segments = parsed_message.segments('OBR')
-            obr_count = len(obr_segments)
+            obr_count = segment_index.count('OBR')
             logger.info(f"Message ID {message_id_for_log} contains {obr_count} OBR segments.")
 
             selected_output_key_template = output_key_template_single_obr
@@ -267,7 +342,7 @@ def process_dat_content(
 
         except hl7.exceptions.HL7Exception as e:
             error_message = (
-                f"HL7 Parsing FAILED for message part starting with MSH then: '{msg_body_part[:100]}...'. Error: {e}\n"
+                f"HL7 Parsing FAILED for message part starting with: '{hl7_message_str[:100]}...'. Error: {e}\n"
                 f"{traceback.format_exc()}"
             )
             report_error(error_message, context)
@@ -275,7 +350,7 @@ def process_dat_content(
             continue
         except Exception as e:
             error_message = (
-                f"Generic FAILED for message part starting with MSH then: '{msg_body_part[:100]}...'. Error: {e}\n"
+                f"Generic FAILED for message part starting with: '{hl7_message_str[:100]}...'. Error: {e}\n"
                 f"{traceback.format_exc()}"
             )
             report_error(error_message, context)
@@ -283,6 +358,7 @@ def process_dat_content(
             continue
 
     logger.info(f"Finished processing DAT file content. {message_write_sequence} messages written.")
+    return message_write_sequence
 
 def _is_valid_s3_key_for_processing(s3_object_key: str) -> bool:
     if any(f"/{subdir}/" in s3_object_key for subdir in PROCESSED_SUBDIRS):
@@ -322,6 +398,7 @@ def _determine_output_paths(s3_object_key: str) -> tuple[str, str, str, str]:
     return base_user_path, extracted_username, output_key_template_single_obr, output_key_template_multi_obr
 
 def _process_s3_record(record: dict, context) -> None:
+    started = utc_now()
     s3_bucket_name = record['s3']['bucket']['name']
     s3_object_key_encoded = record['s3']['object']['key']
     s3_object_key = urllib.parse.unquote_plus(s3_object_key_encoded)
@@ -342,7 +419,7 @@ def _process_s3_record(record: dict, context) -> None:
     s3_object_content = get_s3_object_content(s3_bucket_name, s3_object_key, context)
     logger.info(f"Retrieved content for {s3_object_key}. Content length: {len(s3_object_content)} bytes.")
 
-    process_dat_content(
+    message_count = process_dat_content(
         s3_bucket_name,
         output_key_template_single_obr,
         output_key_template_multi_obr,
@@ -350,6 +427,8 @@ def _process_s3_record(record: dict, context) -> None:
         context
     )
     logger.info(f"Successfully processed DAT content for {s3_object_key}.")
+    site, publisher = incoming_site_and_publisher(s3_object_key)
+    processing_times.record(TIMING_STAGE, record, s3_object_key, site, publisher, started, message_count)
 
 def lambda_handler(event, context):
     logger.info("Received event: %s", json.dumps(event))
@@ -7,7 +7,11 @@ import logging
 import json
 import traceback
 import urllib.parse
-import uuid
+from botocore.config import Config
+
+import hl7_core  # shared HL7 tokenizer, symlinked from ../common/
+from s3_uploader import BoundedS3Uploader  # shared uploader, symlinked from ../common/
+from processing_times import ProcessingTimes, incoming_site_and_publisher, utc_now  # symlinked from ../common/
 
 # --- Configuration Constants ---
 #PROCESSED_SUBDIRS = ["splitcsv", "splitdat", "splitobr"]
@@ -17,11 +21,18 @@ OUTPUT_FILE_EXTENSION = "hl7"
 ERROR_TOPIC_ENV_VAR = 'ERROR_TOPIC_ARN'
 HL7_FILE_EXTENSION = '.hl7'
 HL7_BASE_SEGMENTS_PREFIXES = ['MSH', 'PID', 'ORC']
+UPLOAD_CONCURRENCY = max(int(os.environ.get('UPLOAD_CONCURRENCY', '16')), 1) # max in-flight put_object calls per file
+# Split the raw S3 bytes without decoding the file; '0' decodes it to str first
+BYTES_MODE_ENABLED = os.environ.get('BYTES_MODE', '1') != '0'
+TIMING_TABLE = os.environ.get('TIMING_TABLE', '') # hl7-processing-times table for per-file timing records; empty disables them
+TIMING_STAGE = "split_obr"
 
 # --- Logging Setup ---
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+processing_times = ProcessingTimes(TIMING_TABLE)
+
 def report_error(error_msg: str, context) -> None:
     logger.error(error_msg)
     try:
@@ -36,12 +47,15 @@ def report_error(error_msg: str, context) -> None:
     except Exception as sns_error:
         logger.warning("SNS publish failed: %s", str(sns_error))
 
-def get_s3_object_content(s3_client: boto3.client, bucket_name: str, key: str, context) -> str:
+def get_s3_object_content(s3_client: boto3.client, bucket_name: str, key: str, context, decode: bool = True):
+    """Returns the object as str, or as the raw bytes when decode is False."""
     s3_object_content = None
     for attempt_num in range(3):
         try:
             obj = s3_client.get_object(Bucket=bucket_name, Key=key)
-            s3_object_content = obj['Body'].read().decode('utf-8')
+            s3_object_content = obj['Body'].read()
+            if decode:
+                s3_object_content = s3_object_content.decode('utf-8')
             logger.info(f"Successfully retrieved S3 object {key} on attempt {attempt_num+1}.")
             break
         except s3_client.exceptions.NoSuchKey:
@@ -57,179 +71,222 @@ def get_s3_object_content(s3_client: boto3.client, bucket_name: str, key: str, c
         raise RuntimeError(error_message)
     return s3_object_content
 
-def update_msh10(hl7_message_parts, new_control_id):
+def split_msh_control_id(content, start: int, end: int):
     """
-    Replace the value in MSH-10 (the 10th |-delimited field) with new_control_id.
+    Split the MSH segment at content[start:end] around MSH-10 (index 9) so it
+    can be rewritten by concatenation. Returns (prefix, control_id, suffix),
+    or None if the segment has no MSH-10. content may be str or bytes; the
+    control ID is always returned as str.
     """
-    new_parts = []
-    for segment in hl7_message_parts:
-        if segment.startswith('MSH'):
-            fields = segment.split('|')
-            if len(fields) > 9:
-                fields[9] = new_control_id
-                segment = '|'.join(fields)
-        new_parts.append(segment)
-    return new_parts
-
-def write_hl7_message_to_s3(
-    s3_client: boto3.client,
-    s3_bucket_name: str,
-    output_s3_key: str,
-    hl7_message_parts: list,
-    context,
-    is_obr_missing_file: bool = False,
-    obr_sequence_counter: int = None   # <-- NEW ARG
-) -> None:
-    if not hl7_message_parts:
-        logger.warning(f"Skipping write to {output_s3_key}: hl7_message_parts is empty.")
-        return
-
-    # Only update MSH-10 if not missing OBR (OBRMISSING files can keep original)
-    if not is_obr_missing_file:
-        # Find original MSH-10 for reference
-        original_control_id = None
-        for seg in hl7_message_parts:
-            if seg.startswith('MSH'):
-                fields = seg.split('|')
-                if len(fields) > 9:
-                    original_control_id = fields[9]
-                break
-
-        # Create unique control ID
-        if original_control_id:
-            if obr_sequence_counter is not None:
-                new_control_id = f"{original_control_id}_{obr_sequence_counter}"
-            else:
-                # Fallback: short random ID if somehow no counter
-                new_control_id = f"{original_control_id}_{uuid.uuid4().hex[:6]}"
-            hl7_message_parts = update_msh10(hl7_message_parts, new_control_id)
-
-    hl7_message = '\n'.join(hl7_message_parts)
-
-    logger.info(f"Attempting to write HL7 message to S3. Key: {output_s3_key}, Bucket: {s3_bucket_name}.")
-    try:
-        s3_client.put_object(Bucket=s3_bucket_name, Key=output_s3_key, Body=hl7_message.encode('utf-8'))
-        logger.info(f"Successfully wrote HL7 message to {output_s3_key}")
-    except Exception as e:
-        error_message = (
-            f"CRITICAL ERROR: Failed to write HL7 message to {output_s3_key}. "
-            f"Error: {e}\n{traceback.format_exc()}"
-        )
-        report_error(error_message, context)
-        raise
+    field_separator = '|' if isinstance(content, str) else b'|'
+    field_start = start
+    for _ in range(9):
+        separator_pos = content.find(field_separator, field_start, end)
+        if separator_pos < 0:
+            return None
+        field_start = separator_pos + 1
+    field_end = content.find(field_separator, field_start, end)
+    if field_end < 0:
+        field_end = end
+    control_id = content[field_start:field_end]
+    if not isinstance(control_id, str):
+        control_id = control_id.decode('utf-8', 'surrogateescape')
+    return content[start:field_start], control_id, content[field_end:end]
+
+def _append_range(ranges: list, content: str, start: int, end: int) -> None:
+    """
+    Add the segment at content[start:end] to ranges. A segment that follows the
+    previous range with only a '\n' in between extends that range, so runs of
+    '\n'-separated segments are copied with a single slice.
+    """
+    if ranges and ranges[-1][1] + 1 == start and content[start - 1:start] in ('\n', b'\n'):
+        ranges[-1] = (ranges[-1][0], end)
+    else:
+        ranges.append((start, end))
 
-def process_hl7_segments_for_obr(
-    s3_client: boto3.client,
-    s3_bucket_name: str,
-    output_key_template: str,
-    content: str,
-    context
-) -> None:
+def build_hl7_message(content, head, *range_lists):
+    """
+    Join the (already rewritten) MSH and the segment ranges with '\n'. For bytes
+    content, pass a memoryview so the ranges are not copied before the join.
     """
-    Splits HL7 content by OBR segments. If no OBRs are found, writes base segments
-    to an "OBRMISSING" file.
+    pieces = [head]
+    for ranges in range_lists:
+        for start, end in ranges:
+            pieces.append(content[start:end])
+    return ('\n' if isinstance(content, str) else b'\n').join(pieces)
+
+def _preview(content, start: int, end: int) -> str:
+    """The first 50 characters of a segment, for log messages."""
+    text = content[start:min(end, start + 50)]
+    return text if isinstance(text, str) else text.decode('utf-8', 'replace')
+
+def iter_obr_messages(content, output_key_template: str):
     """
-    normalized_content = content.replace('\r\n', '\n').replace('\r', '\n')
-    segments = [s for s in normalized_content.strip().split('\n') if s.strip()]
+    Splits HL7 content by OBR segments, yielding (output_s3_key, hl7_message) for
+    each OBR group. If no OBRs are found, yields the base segments under an
+    "OBRMISSING" key instead.
 
-    current_base_segments = []
-    current_obr_group_segments = []
+    Segments are tracked as (start, end) offsets into content; each MSH is split
+    once around MSH-10, so every output is the MSH prefix, the new control ID,
+    the MSH suffix and slices of the original content.
+
+    content may be str, or the raw object bytes (bytes mode), in which case the
+    messages are yielded as bytes and only segment IDs and MSH-10 are decoded.
+    """
+    content_start, content_end = hl7_core.strip_bounds(content)
+    is_bytes = not isinstance(content, str)
+    slice_source = memoryview(content) if is_bytes else content
+
+    msh_range = None
+    msh_parts = None
+    current_base_ranges = []
+    current_obr_group_ranges = []
     obr_active_in_group = False
     obr_sequence_counter = 0
 
-    logger.debug(f"Starting HL7 segment processing for OBR splitting. Number of segments found: {len(segments)} for key template prefix: {output_key_template.rsplit('_obr_{}',1)[0] if '_obr_{}' in output_key_template else output_key_template}")
-    if not segments:
-        logger.info("No segments found in the content after normalization and stripping.")
-        return
-
-    for i, segment_stripped in enumerate(segments):
-        segment_prefix = segment_stripped[:3]
-        logger.debug(f"Processing segment {i+1}/{len(segments)}: Prefix='{segment_prefix}'.")
+    def flush_obr_group(reason):
+        current_output_s3_key = output_key_template.format(obr_sequence_counter)
+        logger.info(f"{reason} Flushing previous OBR group to {current_output_s3_key}.")
+        if msh_parts is not None:
+            # MSH-10 gets a unique control ID per output file
+            prefix, original_control_id, suffix = msh_parts
+            new_control_id = f"{original_control_id}_{obr_sequence_counter}"
+            if is_bytes:
+                head = b''.join((prefix, new_control_id.encode('utf-8', 'surrogateescape'), suffix))
+            else:
+                head = f"{prefix}{new_control_id}{suffix}"
+        else:
+            head = content[msh_range[0]:msh_range[1]]
+        return current_output_s3_key, build_hl7_message(slice_source, head, current_base_ranges, current_obr_group_ranges)
+
+    logger.debug(f"Starting HL7 segment processing for OBR splitting for key template prefix: {output_key_template.rsplit('_obr_{}',1)[0] if '_obr_{}' in output_key_template else output_key_template}")
+    # Per-segment debug messages are only formatted when DEBUG is on
+    debug_enabled = logger.isEnabledFor(logging.DEBUG)
+    segment_number = 0
+    for start, end in hl7_core.iter_segment_bounds(content, content_start, content_end):
+        if hl7_core.is_blank(content, start, end):
+            continue
+        segment_number += 1
+        segment_prefix = content[start:start + 3]
+        if is_bytes:
+            segment_prefix = segment_prefix.decode('latin-1')
+        if debug_enabled:
+            logger.debug(f"Processing segment {segment_number}: Prefix='{segment_prefix}'.")
 
         if segment_prefix == 'MSH':
-            if obr_active_in_group and current_base_segments:
+            if obr_active_in_group and msh_range:
                 obr_sequence_counter += 1
-                current_output_s3_key = output_key_template.format(obr_sequence_counter)
-                logger.info(f"MSH encountered. Flushing previous OBR group to {current_output_s3_key}.")
-                write_hl7_message_to_s3(
-                    s3_client, s3_bucket_name, current_output_s3_key,
-                    current_base_segments + current_obr_group_segments,
-                    context, is_obr_missing_file=False,
-                    obr_sequence_counter=obr_sequence_counter
-                )
-            current_base_segments = [segment_stripped]
-            current_obr_group_segments = []
+                yield flush_obr_group("MSH encountered.")
+            msh_range = (start, end)
+            msh_parts = split_msh_control_id(content, start, end)
+            if msh_parts is not None and not msh_parts[1]:
+                msh_parts = None  # no control ID to make unique
+            current_base_ranges = []
+            current_obr_group_ranges = []
             obr_active_in_group = False
-            logger.debug("MSH processed. Base segments reset.")
+            if debug_enabled:
+                logger.debug("MSH processed. Base segments reset.")
 
         elif segment_prefix == 'OBR':
-            if obr_active_in_group and current_base_segments:
+            if obr_active_in_group and msh_range:
                 obr_sequence_counter += 1
-                current_output_s3_key = output_key_template.format(obr_sequence_counter)
-                logger.info(f"New OBR encountered. Flushing previous OBR group to {current_output_s3_key}.")
-                write_hl7_message_to_s3(
-                    s3_client, s3_bucket_name, current_output_s3_key,
-                    current_base_segments + current_obr_group_segments,
-                    context, is_obr_missing_file=False,
-                    obr_sequence_counter=obr_sequence_counter
-                )
-            if current_base_segments:
-                current_obr_group_segments = [segment_stripped]
+                yield flush_obr_group("New OBR encountered.")
+            if msh_range:
+                current_obr_group_ranges = [(start, end)]
                 obr_active_in_group = True
-                logger.debug("OBR processed. New OBR group started.")
+                if debug_enabled:
+                    logger.debug("OBR processed. New OBR group started.")
             else:
-                logger.warning(f"OBR segment found but no MSH context. Discarding OBR: {segment_stripped[:50]}...")
-        
-        elif segment_prefix in HL7_BASE_SEGMENTS_PREFIXES and segment_prefix != 'MSH':
-            if current_base_segments:
-                current_base_segments.append(segment_stripped)
-                logger.debug(f"{segment_prefix} added to base_segments.")
+                logger.warning(f"OBR segment found but no MSH context. Discarding OBR: {_preview(content, start, end)}...")
+
+        elif segment_prefix in HL7_BASE_SEGMENTS_PREFIXES:
+            if msh_range:
+                _append_range(current_base_ranges, content, start, end)
+                if debug_enabled:
+                    logger.debug(f"{segment_prefix} added to base_segments.")
             else:
-                logger.warning(f"Segment '{segment_prefix}' found before MSH context. Discarding: {segment_stripped[:50]}...")
+                logger.warning(f"Segment '{segment_prefix}' found before MSH context. Discarding: {_preview(content, start, end)}...")
 
         else: # OBX, NTE, etc.
-            if obr_active_in_group and current_base_segments:
-                current_obr_group_segments.append(segment_stripped)
-                logger.debug(f"Segment '{segment_prefix}' added to current OBR group.")
+            if obr_active_in_group and msh_range:
+                _append_range(current_obr_group_ranges, content, start, end)
+                if debug_enabled:
+                    logger.debug(f"Segment '{segment_prefix}' added to current OBR group.")
             else:
-                if not current_base_segments:
-                     logger.warning(f"Segment '{segment_prefix}' found before MSH context. Discarding: {segment_stripped[:50]}...")
-                elif not obr_active_in_group:
-                     logger.debug(f"Segment '{segment_prefix}' found but no OBR is active. Discarding: {segment_stripped[:50]}...")
+                if not msh_range:
+                     logger.warning(f"Segment '{segment_prefix}' found before MSH context. Discarding: {_preview(content, start, end)}...")
+                elif not obr_active_in_group and debug_enabled:
+                     logger.debug(f"Segment '{segment_prefix}' found but no OBR is active. Discarding: {_preview(content, start, end)}...")
+
+    if segment_number == 0:
+        logger.info("No segments found in the content after normalization and stripping.")
+        return
 
     # After the loop
-    if obr_active_in_group and current_base_segments:
+    if obr_active_in_group and msh_range:
         obr_sequence_counter += 1
-        current_output_s3_key = output_key_template.format(obr_sequence_counter)
-        logger.info(f"End of segments. Flushing final OBR group to {current_output_s3_key}.")
-        write_hl7_message_to_s3(
-            s3_client, s3_bucket_name, current_output_s3_key,
-            current_base_segments + current_obr_group_segments,
-            context, is_obr_missing_file=False,
-            obr_sequence_counter=obr_sequence_counter
-        )
-    elif obr_sequence_counter == 0 and current_base_segments: # No OBRs were processed/written
+        yield flush_obr_group("End of segments.")
+    elif obr_sequence_counter == 0 and msh_range: # No OBRs were processed/written
         original_filename_part = output_key_template.split('_obr_{}')[0] if '_obr_{}' in output_key_template else output_key_template.rsplit('.',1)[0]
         extension = output_key_template.rsplit('.',1)[-1] if '.' in output_key_template else OUTPUT_FILE_EXTENSION
-        
+
         obr_missing_s3_key = f"{original_filename_part}_OBRMISSING.{extension}"
-        
+
+        # OBRMISSING files keep the original MSH-10
         logger.warning(f"No OBR segments found in message. Writing base segments to {obr_missing_s3_key}.")
-        write_hl7_message_to_s3(
-            s3_client, s3_bucket_name, obr_missing_s3_key,
-            current_base_segments, # Write only base segments
-            context, is_obr_missing_file=True, # Allow no OBR in this specific file
-            obr_sequence_counter=None
-        )
+        yield obr_missing_s3_key, build_hl7_message(slice_source, content[msh_range[0]:msh_range[1]], current_base_ranges)
     else:
-        logger.info(f"No OBR group to flush and no base segments to write as OBRMISSING. OBR sequence counter: {obr_sequence_counter}, Base segments present: {bool(current_base_segments)}")
+        logger.info(f"No OBR group to flush and no base segments to write as OBRMISSING. OBR sequence counter: {obr_sequence_counter}, Base segments present: {bool(msh_range)}")
+
+def process_hl7_segments_for_obr(
+    s3_client: boto3.client,
+    s3_bucket_name: str,
+    output_key_template: str,
+    content: str,
+    context,
+    max_in_flight: int = UPLOAD_CONCURRENCY
+) -> int:
+    """
+    Splits HL7 content by OBR segments and writes one file per OBR group. If no
+    OBRs are found, writes base segments to an "OBRMISSING" file.
+
+    Output keys are assigned in file order while splitting, and the writes are
+    handed to a BoundedS3Uploader so splitting carries on while earlier groups
+    upload. The first failed write is reported and re-raised, which stops the
+    split. Returns the number of messages written.
+    """
+    written_count = 0
+
+    def on_uploaded(tag, key):
+        nonlocal written_count
+        written_count += 1
+        logger.info(f"Successfully wrote HL7 message to {key}")
+
+    def on_upload_failed(tag, key, error):
+        formatted_traceback = ''.join(traceback.format_exception(type(error), error, error.__traceback__))
+        error_message = (
+            f"CRITICAL ERROR: Failed to write HL7 message to {key}. "
+            f"Error: {error}\n{formatted_traceback}"
+        )
+        report_error(error_message, context)
+        raise error
+
+    with BoundedS3Uploader(s3_client, s3_bucket_name, max_in_flight, on_uploaded, on_upload_failed) as uploader:
+        for output_s3_key, hl7_message in iter_obr_messages(content, output_key_template):
+            if not hl7_message:
+                logger.warning(f"Skipping write to {output_s3_key}: hl7_message is empty.")
+                continue
+            logger.info(f"Queueing HL7 message for S3. Key: {output_s3_key}, Bucket: {s3_bucket_name}.")
+            uploader.submit(output_s3_key, hl7_message if isinstance(hl7_message, bytes) else hl7_message.encode('utf-8'))
+    return written_count
 
 def lambda_handler(event, context):
     logger.info("Received event: %s", json.dumps(event))
-    s3_client = boto3.client('s3')
+    s3_client = boto3.client('s3', config=Config(max_pool_connections=UPLOAD_CONCURRENCY))
     allowed_source_parent_dirs = {INCOMING_DIR_NAME, PROCESSED_SUBDIRS[1]}
 
     for record in event['Records']:
+        started = utc_now()
         s3_bucket_name = record['s3']['bucket']['name']
         s3_object_key_encoded = record['s3']['object']['key']
         s3_object_key = urllib.parse.unquote_plus(s3_object_key_encoded)
@@ -272,16 +329,18 @@ def lambda_handler(event, context):
             continue
 
         try:
-            s3_object_content = get_s3_object_content(s3_client, s3_bucket_name, s3_object_key, context)
+            s3_object_content = get_s3_object_content(s3_client, s3_bucket_name, s3_object_key, context, decode=not BYTES_MODE_ENABLED)
         except RuntimeError:
             continue 
 
         try:
-            process_hl7_segments_for_obr(
+            message_count = process_hl7_segments_for_obr(
                 s3_client, s3_bucket_name, output_key_template,
                 s3_object_content, context
             )
             logger.info(f"Successfully completed OBR splitting process for {s3_object_key}")
+            site, publisher = incoming_site_and_publisher(s3_object_key)
+            processing_times.record(TIMING_STAGE, record, s3_object_key, site, publisher, started, message_count)
         except Exception as e:
             error_message = f"Failed during OBR splitting for {s3_object_key}: {e}\n{traceback.format_exc()}"
             report_error(error_message, context)
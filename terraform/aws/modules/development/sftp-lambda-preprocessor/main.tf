@@ -20,38 +20,49 @@ resource "aws_iam_policy" "lambda_policy" {
   name = "lambda_split_csv_policy"
   policy = jsonencode({
     Version = "2012-10-17",
-    Statement = [
-      {
-        Effect = "Allow",
-        Action = [
-          "logs:CreateLogGroup",
-          "logs:CreateLogStream",
-          "logs:PutLogEvents",
-          "cloudwatch:PutMetricData"
-        ],
-        Resource = "*"
-      },
-      {
-        Effect = "Allow",
-        Action = [
-          "s3:GetObject",
-          "s3:PutObject"
-        ],
-        Resource = "arn:aws:s3:::${var.sftp_bucket_name}/*"
-      },
-      {
-        Effect = "Allow",
-        Action = [
-          "s3:ListBucket"
-        ],
-        Resource = "arn:aws:s3:::${var.sftp_bucket_name}"
-      },
-      {
-        Effect   = "Allow",
-        Action   = "sns:Publish",
-        Resource = "*"
-      }
-    ]
+    Statement = concat(
+      [
+        {
+          Effect = "Allow",
+          Action = [
+            "logs:CreateLogGroup",
+            "logs:CreateLogStream",
+            "logs:PutLogEvents",
+            "cloudwatch:PutMetricData"
+          ],
+          Resource = "*"
+        },
+        {
+          Effect = "Allow",
+          Action = [
+            "s3:GetObject",
+            "s3:PutObject",
+            "s3:AbortMultipartUpload"
+          ],
+          Resource = "arn:aws:s3:::${var.sftp_bucket_name}/*"
+        },
+        {
+          Effect = "Allow",
+          Action = [
+            "s3:ListBucket"
+          ],
+          Resource = "arn:aws:s3:::${var.sftp_bucket_name}"
+        },
+        {
+          Effect   = "Allow",
+          Action   = "sns:Publish",
+          Resource = "*"
+        }
+      ],
+      # Timing records are opt-in: PutItem is only granted when a table is configured
+      var.timing_table_name == "" ? [] : [
+        {
+          Effect   = "Allow",
+          Action   = "dynamodb:PutItem",
+          Resource = "arn:aws:dynamodb:*:*:table/${var.timing_table_name}"
+        }
+      ]
+    )
   })
 }
 
@@ -137,6 +148,7 @@ resource "aws_lambda_function" "split_csv_lambda" {
     variables = {
       ERROR_TOPIC_ARN  = aws_sns_topic.split_csv_errors.arn
       BUCKET           = var.sftp_bucket_name
+      TIMING_TABLE     = var.timing_table_name
       SOFTWARE_VENDOR  = "CDW"
       SOFTWARE_PRODUCT = "CSV2HL7"
       SOFTWARE_VERSION = "7.10.3"
@@ -157,6 +169,7 @@ resource "aws_lambda_function" "split_dat_lambda" {
     variables = {
       ERROR_TOPIC_ARN = aws_sns_topic.split_dat_errors.arn
       BUCKET          = var.sftp_bucket_name
+      TIMING_TABLE    = var.timing_table_name
     }
   }
 }
@@ -173,6 +186,7 @@ resource "aws_lambda_function" "split_obr_lambda" {
     variables = {
       ERROR_TOPIC_ARN = aws_sns_topic.split_obr_errors.arn
       BUCKET          = var.sftp_bucket_name
+      TIMING_TABLE    = var.timing_table_name
     }
   }
 }
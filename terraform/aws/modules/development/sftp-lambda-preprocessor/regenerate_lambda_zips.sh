@@ -64,6 +64,7 @@ for LAMBDA_NAME in "${LAMBDAS[@]}"; do
 
   # Create the zip file. '-r' includes subdirectories (the libraries).
   # '.' means "zip everything in the current directory".
+  # Symlinks are followed, so shared modules linked from lambda/common/ are included.
   # We use the absolute $ZIP_PATH defined earlier.
   zip -r "$ZIP_PATH" .
 
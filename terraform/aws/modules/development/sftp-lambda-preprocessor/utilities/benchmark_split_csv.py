@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+"""
+Benchmark for the CSV -> HL7 conversion in lambda_split_csv.
+
+Generates synthetic CSV rows, checks that the precompiled template produces
+byte-for-byte the same messages as the reference generate_* functions (and
+that normalize_hl7_date() agrees with datetime_format_check()), then times
+both.
+
+It then writes the rows out as CSV text and compares the row engine
+(csv.DictReader) with the columnar engine: identical output, rows per second
+and peak traced memory.
+
+Usage: python3 benchmark_split_csv.py [--rows 20000] [--repeat 3] [--seed 1] [--chunk-rows 200]
+
+Needs boto3 importable (the lambda module imports it); no AWS access is made.
+"""
+import argparse
+import csv
+import importlib.util
+import io
+import os
+import random
+import sys
+import time
+import tracemalloc
+import types
+
+LAMBDA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lambda", "lambda_split_csv")
+LAMBDA_PATH = os.path.join(LAMBDA_DIR, "lambda_split_csv.py")
+
+
+def load_lambda_module():
+    # Shared modules (s3_uploader) are symlinked into the lambda directory
+    sys.path.insert(0, LAMBDA_DIR)
+    spec = importlib.util.spec_from_file_location("lambda_split_csv", LAMBDA_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def make_rows(module, count, seed):
+    """Rows shaped like csv.DictReader output, with repeated dates and some HL7 special characters."""
+    rng = random.Random(seed)
+    test_dates = [f"{rng.randint(1, 12):02d}/{rng.randint(1, 28):02d}/2025 {rng.randint(0, 23):02d}:{rng.randint(0, 59):02d}:00" for _ in range(40)]
+    collection_dates = [f"{rng.randint(1, 12):02d}/{rng.randint(1, 28):02d}/2025" for _ in range(40)]
+    odd_values = ["O'Brien & Sons", "A|B", "caret^value", "tilde~value", "back\\slash", "line\nbreak", "cr\rvalue", ""]
+    rows = []
+    for i in range(count):
+        row = {header: f"{header[:6]}{rng.randint(0, 500)}" for header in module.CSV_HEADERS}
+        row.update({
+            "Patient_ID": f"P{i:07d}",
+            "AccessionNumber": f"ACC{i // 3:07d}",
+            "DateOfBirth": rng.choice([f"{rng.randint(1, 12):02d}/{rng.randint(1, 28):02d}/{rng.randint(1930, 2020)}", "", "1999-01-01"]),
+            "Sex": rng.choice("MFU"),
+            "Ethnicity": rng.choice(["H", "N", "U", "x", ""]),
+            "PatientZipcode": rng.choice(["820", "00802", ""]),
+            "PatientPhoneNumber": "340-555-0100",
+            "OrderingFacilityPhone": "340-555-0199",
+            "SpecimenCollectionDate": rng.choice(collection_dates),
+            "SpecimenSite": rng.choice(["Nasal Swab", "BLOOD", "serum", "Other site", ""]),
+            "TestResult": rng.choice(["Positive", "NEGATIVE", "Indeterminate"]),
+            "TestDate": rng.choice(test_dates),
+            "Notes": rng.choice(["", "  ", "Repeat test requested", "see|notes"]),
+        })
+        if i % 7 == 0:
+            row[rng.choice(module.CSV_HEADERS)] = rng.choice(odd_values)
+        if i % 11 == 0:
+            row["SendingApplication"] = "LABAPP"
+        rows.append(row)
+    return rows
+
+
+def make_date_strings(count, seed):
+    """Canonical dates plus the odd forms strptime also accepts or rejects."""
+    rng = random.Random(seed)
+    fixed = ["", " ", "01/02/2024", " 01/02/2024 ", "1/2/2024", "01/02/2024 7:05:09", "01/02/2024  07:05:09",
+             "02/29/2024", "02/29/2023", "13/01/2024", "00/10/2024", "12/31/0999", "12/31/0000", "01/02/24",
+             "01/02/2024 24:00:00", "01/02/2024 23:59:60", "2024-01-02", "01/02/2024T10:00:00", "01/ 2/2024",
+             "\u0661\u0662/01/2024", "01/02/2024 10:00", "01/02/2024\n"]
+    generated = []
+    for _ in range(count):
+        date = f"{rng.randint(0, 13):02d}/{rng.randint(0, 32):02d}/{rng.choice([rng.randint(1900, 2030), rng.randint(0, 999)]):04d}"
+        if rng.random() < 0.5:
+            date += f" {rng.randint(0, 25):02d}:{rng.randint(0, 61):02d}:{rng.randint(0, 61):02d}"
+        generated.append(date)
+    return fixed + generated
+
+
+def time_conversion(label, convert, rows, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for i, row in enumerate(rows):
+            convert(row, f"MSG{i}")
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    print(f"{label:<12} {len(rows) / best:>12,.0f} rows/s  ({best * 1000:.1f} ms for {len(rows)} rows)")
+    return best
+
+
+def make_csv_text(module, rows):
+    """CSV text for the rows, with a few blank, short and long lines mixed in."""
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow(module.CSV_HEADERS)
+    for i, row in enumerate(rows):
+        values = [row[header] for header in module.CSV_HEADERS]
+        if i % 997 == 5:
+            output.write("\r\n")
+        if i % 499 == 7:
+            values = values[:30]
+        elif i % 499 == 8:
+            values = values + ["extra", "fields"]
+        writer.writerow(values)
+    return output.getvalue()
+
+
+def convert_csv(module, csv_text, engine, chunk_rows):
+    """Run one engine over the CSV lines, yielding comparable (row_number, row dict, message, error) tuples."""
+    csv_reader = csv.DictReader(iter(csv_text))
+    csv_reader.fieldnames = [name.strip() for name in csv_reader.fieldnames]
+    if engine == "columnar":
+        converted = module.iter_hl7_messages_by_column(csv_reader, chunk_rows)
+        row_to_dict = lambda row: module.csv_row_to_dict(csv_reader.fieldnames, row)
+    else:
+        converted = module.iter_hl7_messages_by_row(csv_reader)
+        row_to_dict = lambda row: row
+    for row_number, row, message, error in converted:
+        yield row_number, (row_to_dict(row) if error is not None else None), message, (str(error) if error is not None else None)
+
+
+def time_engine(module, csv_text, engine, chunk_rows, row_count, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in convert_csv(module, csv_text, engine, chunk_rows):
+            pass
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    tracemalloc.start()
+    for _ in convert_csv(module, csv_text, engine, chunk_rows):
+        pass
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{engine:<12} {row_count / best:>12,.0f} rows/s  ({best * 1000:.1f} ms)  peak {peak / 1024 / 1024:.1f} MiB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=20000)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--chunk-rows", type=int, default=200)
+    args = parser.parse_args()
+
+    module = load_lambda_module()
+    rows = make_rows(module, args.rows, args.seed)
+
+    def reference(row, message_id):
+        return module.generate_hl7_message_from_csv_row(row, message_id, "", module.GLOBAL_DEBUG_MODE)
+
+    def template(row, message_id):
+        return module.render_hl7_message_from_csv_row(row, message_id)
+
+    for date in make_date_strings(args.rows, args.seed):
+        for include_offset in (False, True):
+            expected = module.datetime_format_check(date, 0, include_offset=include_offset)
+            actual = module.normalize_hl7_date(date, include_offset=include_offset)
+            if expected != actual:
+                print(f"Date mismatch for {date!r} (include_offset={include_offset}): {expected!r} != {actual!r}")
+                return 1
+    print("Date parity OK")
+
+    for i, row in enumerate(rows):
+        expected, actual = reference(row, f"MSG{i}"), template(row, f"MSG{i}")
+        if expected != actual:
+            print(f"Mismatch on row {i + 1}:\n  reference: {expected!r}\n  template:  {actual!r}")
+            return 1
+    print(f"Parity OK: {len(rows)} rows identical")
+
+    reference_time = time_conversion("reference", reference, rows, args.repeat)
+    template_time = time_conversion("template", template, rows, args.repeat)
+    print(f"Speedup: {reference_time / template_time:.1f}x")
+
+    # Fixed clock so message IDs match between the two engines
+    module.time = types.SimpleNamespace(time=lambda: 1700000000.0)
+    # Pre-split lines, as iter_csv_lines() would stream them, so peak memory is the engine's own
+    csv_text = make_csv_text(module, rows).splitlines(keepends=True)
+    row_results = list(convert_csv(module, csv_text, "row", args.chunk_rows))
+    columnar_results = list(convert_csv(module, csv_text, "columnar", args.chunk_rows))
+    if row_results != columnar_results:
+        mismatch = next(i for i, pair in enumerate(zip(row_results, columnar_results)) if pair[0] != pair[1]) if len(row_results) == len(columnar_results) else None
+        print(f"Engine mismatch ({len(row_results)} vs {len(columnar_results)} rows), first differing row index: {mismatch}")
+        return 1
+    errors = sum(1 for result in row_results if result[3] is not None)
+    print(f"Engine parity OK: {len(row_results)} rows identical ({errors} row errors)")
+
+    time_engine(module, csv_text, "row", args.chunk_rows, len(row_results), args.repeat)
+    time_engine(module, csv_text, "columnar", args.chunk_rows, len(row_results), args.repeat)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+"""
+Parity check and benchmark for HL7 message cleaning in lambda_split_dat.
+
+Builds synthetic HL7 messages (including the edge cases clean_hl7_message
+touches), checks that hl7_core.iter_message_bounds() splits a batch of them
+back into the same messages (with \r, \n or \r\n between them and some MSH
+lines indented), checks that clean_hl7_message_fast() returns exactly what
+str(clean_hl7_message(hl7.parse(...))) does, or declines, then times both paths
+and reports peak traced memory.
+
+Usage: python3 benchmark_split_dat.py [--messages 5000] [--repeat 3] [--seed 1]
+
+Needs boto3 and hl7 importable (the lambda module imports them); no AWS access
+is made.
+"""
+import argparse
+import importlib.util
+import logging
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+LAMBDA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lambda", "lambda_split_dat")
+
+
+def load_lambda_module():
+    # The module creates its boto3 clients at import time
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+    sys.path.insert(0, LAMBDA_DIR)
+    spec = importlib.util.spec_from_file_location("lambda_split_dat", os.path.join(LAMBDA_DIR, "lambda_split_dat.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+RACES = ["2106-3^White^CDCREC", "2054-5^Black^HL70005", "9999-9^Bad^CDCREC", "2106-3\\S\\White\\S\\CDCREC",
+         "2106-3^White^CDCREC~2028-9^Asian^CDCREC", "UNK", "", "2106-3^White"]
+ETHNICITIES = ["2186-5^Not Hispanic^CDCREC", "2135-2^Hispanic^HL70189", "H^Hispanic^HL70189", "", "UNK^^CDCREC"]
+DATES = ["20240102", "20240102101112", "20240102101112-0500", "2024-01-02", "20241399", "", "20240102101112.1234"]
+
+
+def make_message(rng, i):
+    pid = ["PID", "1", "", f"P{i}^^^LAB^MR", "", rng.choice(["Doe^Jane", ""]), "", rng.choice(DATES), "F", "", rng.choice(RACES)]
+    pid += [""] * (21 - len(pid)) + [rng.choice(ETHNICITIES)]
+    if rng.random() < 0.5:
+        pid += [""] * (33 - len(pid)) + [rng.choice(DATES)]
+    if rng.random() < 0.2:
+        pid.append("")  # trailing empty field
+    segments = [
+        f"MSH|^~\\&|LAB|FAC|VIDOH|VI|{rng.choice(DATES)}||ORU^R01|MSG{i}|P|2.5.1",
+        "|".join(pid),
+        "ORC|RE|A1",
+    ]
+    for obr in range(rng.choice([0, 1, 1, 1, 2, 3])):
+        segments.append(f"OBR|{obr + 1}|A{i}||94500-6^SARS^LN|||20240102")
+        segments.append(f"OBX|1|CWE|94500-6^SARS^LN||260373001^Detected^SCT||||||F|||20240102|note MSH inside")
+    roll = rng.random()
+    if roll < 0.03:
+        segments[0] = segments[0].replace("MSH|^~\\&|", "MSH|^~\\&#|")  # non-standard encoding characters
+    elif roll < 0.05:
+        segments.insert(1, "PID")  # bare segment python-hl7 selects as the PID
+    elif roll < 0.08:
+        segments.insert(2, rng.choice(["", " "]))  # empty or blank segment
+    elif roll < 0.10:
+        del segments[1]  # no PID
+    return "\r".join(segments)
+
+
+def check_message_bounds(module, rng, messages):
+    separators = ["\r", "\n", "\r\n", "\r  ", "\n\t", "\r\n \t"]
+    batch = "\ufeff" + "".join(message + rng.choice(separators) for message in messages)
+    found = []
+    for start, end in module.hl7_core.iter_message_bounds(batch):
+        found.append(batch[slice(*module.hl7_core.strip_bounds(batch, start, end))])
+    if found != messages:
+        print(f"Split mismatch: expected {len(messages)} messages, got {len(found)}")
+        return False
+    print(f"Split OK: {len(found)} messages")
+    return True
+
+
+def reference_clean(module, message):
+    return str(module.clean_hl7_message(module.hl7.parse(message), "bench"))
+
+
+def fast_clean(module, message):
+    cleaned = module.clean_hl7_message_fast(message, module.hl7_core.Message.parse(message), "bench")
+    if cleaned is None:
+        return reference_clean(module, message)
+    return cleaned
+
+
+def measure(label, clean, module, messages, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for message in messages:
+            clean(module, message)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    tracemalloc.start()
+    for message in messages:
+        clean(module, message)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{label:<12} {len(messages) / best:>12,.0f} msgs/s  ({best * 1000:.1f} ms)  peak {peak / 1024:.0f} KiB")
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=5000)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    module = load_lambda_module()
+    logging.disable(logging.CRITICAL)
+    rng = random.Random(args.seed)
+    messages = [make_message(rng, i) for i in range(args.messages)]
+    if not check_message_bounds(module, rng, messages):
+        return 1
+
+    fallbacks = 0
+    for i, message in enumerate(messages):
+        cleaned = module.clean_hl7_message_fast(message, module.hl7_core.Message.parse(message), "bench")
+        if cleaned is None:
+            fallbacks += 1
+            continue
+        expected = reference_clean(module, message)
+        if cleaned != expected:
+            print(f"Mismatch on message {i}:\n  python-hl7: {expected!r}\n  fast path:  {cleaned!r}")
+            return 1
+    print(f"Parity OK: {len(messages) - fallbacks} messages identical, {fallbacks} fell back to python-hl7")
+
+    # The lambda logs and skips messages python-hl7 cannot parse; leave them out of the timings
+    timed = []
+    for message in messages:
+        try:
+            reference_clean(module, message)
+        except Exception:
+            continue
+        timed.append(message)
+    messages = timed
+
+    reference_time = measure("python-hl7", reference_clean, module, messages, args.repeat)
+    fast_time = measure("fast path", fast_clean, module, messages, args.repeat)
+    print(f"Speedup: {reference_time / fast_time:.1f}x")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
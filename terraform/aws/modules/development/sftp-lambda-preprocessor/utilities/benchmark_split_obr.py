@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+"""
+Benchmark for OBR splitting in lambda_split_obr.
+
+Builds a synthetic HL7 file with many OBR groups per message, checks that every
+output holds exactly one OBR, the MSH/PID/ORC base segments and a unique
+MSH-10, then times iter_obr_messages(). It compares str mode (decode the
+object, split, encode every output) with bytes mode (split the raw bytes):
+the outputs must be identical, also on a few edge cases (MLLP framing bytes,
+\x1c-\x1f and multi-byte whitespace); throughput and peak traced memory are shown.
+
+It then runs process_hl7_segments_for_obr() against a stub S3 client that
+sleeps --put-latency-ms per put_object. The first run writes one object at a
+time; the second uses the default UPLOAD_CONCURRENCY.
+
+Usage: python3 benchmark_split_obr.py [--messages 20] [--obrs 500] [--repeat 3] [--eol lf|cr|crlf] [--put-latency-ms 1]
+
+Needs boto3 importable (the lambda module imports it); no AWS access is made.
+"""
+import argparse
+import importlib.util
+import logging
+import os
+import sys
+import time
+import tracemalloc
+
+LAMBDA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lambda", "lambda_split_obr")
+LINE_ENDINGS = {"lf": "\n", "cr": "\r", "crlf": "\r\n"}
+
+
+def load_lambda_module():
+    sys.path.insert(0, LAMBDA_DIR)
+    spec = importlib.util.spec_from_file_location("lambda_split_obr", os.path.join(LAMBDA_DIR, "lambda_split_obr.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def make_content(message_count, obr_count, eol):
+    lines = []
+    for m in range(message_count):
+        lines += [f"MSH|^~\\&|LAB|FAC|VIDOH|VI|20240102||ORU^R01|CTRL{m}|P|2.5.1", "PID|1||P1^^^LAB^MR||Doe^Jane", "ORC|RE|A1"]
+        for o in range(obr_count):
+            lines.append(f"OBR|{o + 1}|A{m}-{o}||94500-6^SARS-CoV-2 RNA^LN|||20240102")
+            lines += [f"OBX|{k + 1}|CWE|94500-6^SARS^LN||260373001^Detected^SCT||||||F" for k in range(4)]
+            lines.append("NTE|1|L|Repeat test requested")
+    return eol.join(lines) + eol
+
+
+class StubS3Client:
+    """Records put_object calls after a fixed delay standing in for the network round trip."""
+
+    def __init__(self, latency_seconds):
+        self.latency_seconds = latency_seconds
+        self.keys = []
+
+    def put_object(self, Bucket, Key, Body):
+        time.sleep(self.latency_seconds)
+        self.keys.append(Key)
+
+
+class StubContext:
+    function_name = "benchmark_split_obr"
+
+
+def check_outputs(outputs, message_count, obr_count):
+    if len(outputs) != message_count * obr_count:
+        return f"expected {message_count * obr_count} outputs, got {len(outputs)}"
+    control_ids = set()
+    for key, message in outputs:
+        segments = message.split("\n")
+        if [segment[:3] for segment in segments[:3]] != ["MSH", "PID", "ORC"]:
+            return f"{key}: base segments missing"
+        if sum(1 for segment in segments if segment.startswith("OBR|")) != 1:
+            return f"{key}: expected one OBR"
+        control_ids.add(segments[0].split("|")[9])
+    if len(control_ids) != len(outputs):
+        return "MSH-10 control IDs are not unique"
+    return None
+
+
+# Edge cases for the str / bytes parity check: MLLP framing (\x0b ... \x1c\r), a
+# trailing \x1c\r on a file without OBRs, whitespace-only and \x1c-\x1f segments,
+# and multi-byte spaces, which both modes must trim with str.isspace() rules
+PARITY_CASES = [
+    "MSH|^~\\&|LAB|FAC|||20240102||ORU^R01|C1|P|2.5.1\rPID|1\rOBR|1|A\rOBX|1|ST|x\r\x1c\r",
+    "\x0bMSH|^~\\&|LAB|FAC|||20240102||ORU^R01|C1|P|2.5.1\rPID|1\rOBR|1|A\rOBR|2|B\x1c\r",
+    "MSH|^~\\&|LAB|FAC|||20240102||ORU^R01|C1|P|2.5.1\rPID|1\rORC|RE\x1c\r",
+    "MSH|^~\\&|LAB|FAC|||20240102||ORU^R01|C1|P|2.5.1\r\x1d\x1e \rPID|1\rOBR|1|A\r\x1f\rOBX|1|ST|x\u00a0\u3000\n",
+    "\u00a0\x1cMSH|^~\\&|LAB|FAC|||20240102||ORU^R01|C1|P|2.5.1\r\u2028\rOBR|1|A\r\x1c\x1c\r\n",
+]
+
+
+def split_object(module, raw, template, bytes_mode):
+    """What the handler does with one object: split it and produce the put_object bodies."""
+    content = raw if bytes_mode else raw.decode("utf-8")
+    for key, message in module.iter_obr_messages(content, template):
+        yield key, message if bytes_mode else message.encode("utf-8")
+
+
+def measure_mode(module, raw, template, bytes_mode, message_count, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in split_object(module, raw, template, bytes_mode):
+            pass
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    tracemalloc.start()
+    for _ in split_object(module, raw, template, bytes_mode):
+        pass
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    label = "bytes mode" if bytes_mode else "str mode"
+    print(f"{label:<17} {message_count / best:>12,.0f} msgs/s  ({best * 1000:.1f} ms)  peak {peak / 1024 / 1024:.2f} MiB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=20)
+    parser.add_argument("--obrs", type=int, default=500)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--eol", choices=sorted(LINE_ENDINGS), default="lf")
+    parser.add_argument("--put-latency-ms", type=float, default=1.0)
+    args = parser.parse_args()
+
+    module = load_lambda_module()
+    logging.disable(logging.CRITICAL)
+    content = make_content(args.messages, args.obrs, LINE_ENDINGS[args.eol])
+    template = "site/user/splitobr/user_bench_obr_{}.hl7"
+
+    problem = check_outputs(list(module.iter_obr_messages(content, template)), args.messages, args.obrs)
+    if problem:
+        print(f"Output check failed: {problem}")
+        return 1
+    print(f"Output check OK: {args.messages * args.obrs} messages from {len(content) / 1024 / 1024:.1f} MiB")
+
+    raw = content.encode("utf-8")
+    for case in [content] + PARITY_CASES:
+        case_raw = case.encode("utf-8")
+        if list(split_object(module, case_raw, template, False)) != list(split_object(module, case_raw, template, True)):
+            print(f"Output check failed: str and bytes mode differ on {case[:60]!r}")
+            return 1
+    print(f"Parity OK: str and bytes mode agree on the generated file and {len(PARITY_CASES)} edge cases")
+    message_count = args.messages * args.obrs
+    measure_mode(module, raw, template, False, message_count, args.repeat)
+    measure_mode(module, raw, template, True, message_count, args.repeat)
+
+    expected_keys = [key for key, _ in module.iter_obr_messages(content, template)]
+    for max_in_flight in (1, module.UPLOAD_CONCURRENCY):
+        client = StubS3Client(args.put_latency_ms / 1000)
+        start = time.perf_counter()
+        module.process_hl7_segments_for_obr(client, "bench", template, raw, StubContext(), max_in_flight=max_in_flight)
+        elapsed = time.perf_counter() - start
+        if sorted(client.keys) != sorted(expected_keys):
+            print(f"Upload check failed with {max_in_flight} in flight")
+            return 1
+        print(f"{max_in_flight:>3} in flight    {len(client.keys) / elapsed:>12,.0f} msgs/s  ({elapsed * 1000:.1f} ms wall clock)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
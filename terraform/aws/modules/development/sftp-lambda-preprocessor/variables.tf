@@ -15,3 +15,8 @@ variable "filter_prefix" {
   default     = "site/lab/incoming/" # Change as needed
 }
 
+variable "timing_table_name" {
+  description = "DynamoDB table for per-file processing timing records, e.g. the sftp module's dynamodb_processing_times_table_name output; empty (the default) disables them and their dynamodb:PutItem permission"
+  type        = string
+  default     = ""
+}
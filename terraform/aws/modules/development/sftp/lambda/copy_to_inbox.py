@@ -2,23 +2,54 @@ import boto3
 import os
 import urllib.parse
 from datetime import datetime
+from botocore.config import Config
 
-s3 = boto3.client("s3")
+import hl7_core  # shared HL7 tokenizer, symlinked from sftp-lambda-preprocessor/lambda/common/
+from s3_uploader import BoundedS3Uploader  # shared uploader, symlinked from sftp-lambda-preprocessor/lambda/common/
+from processing_times import ProcessingTimes, utc_now  # symlinked from sftp-lambda-preprocessor/lambda/common/
+
+UPLOAD_CONCURRENCY = max(int(os.environ.get("UPLOAD_CONCURRENCY", "16")), 1)  # max in-flight part uploads per file
+
+s3 = boto3.client("s3", config=Config(max_pool_connections=UPLOAD_CONCURRENCY))
 sns = boto3.client("sns")
 dynamo = boto3.resource("dynamodb")
 error_table = dynamo.Table("hl7-error-log")
+error_counts_table = dynamo.Table("hl7-error-counts")
+# hl7-processing-times table for per-file timing records; empty (the default) disables them
+processing_times = ProcessingTimes(os.environ.get("TIMING_TABLE", ""), dynamo)
+
+def site_and_publisher(file_name):
+    parts = file_name.split("/")
+    site = parts[1] if len(parts) > 1 else "unknown"
+    publisher = parts[2] if len(parts) > 2 else "unknown"
+    return site, publisher
+
+def error_count_key(timestamp, site, publisher):
+    """hl7-error-counts key for an ISO timestamp: the UTC day, then "<HH>#<site>#<publisher>"."""
+    return {"Day": timestamp[:10], "Slot": f"{timestamp[11:13]}#{site}#{publisher}"}
+
+def increment_error_count(timestamp, site, publisher):
+    # ADD is atomic, so concurrent invocations never lose a count
+    error_counts_table.update_item(
+        Key=error_count_key(timestamp, site, publisher),
+        UpdateExpression="ADD ErrorCount :one SET Site = :site, Publisher = :publisher",
+        ExpressionAttributeValues={":one": 1, ":site": site, ":publisher": publisher}
+    )
 
 def log_error(file_name, reason):
     timestamp = datetime.utcnow().isoformat()
     error_table.put_item(Item={
         "FileName": file_name,
+        "Day": timestamp[:10],  # DayIndex partition key
         "Timestamp": timestamp,
         "Reason": reason
     })
+    site, publisher = site_and_publisher(file_name)
+    try:
+        increment_error_count(timestamp, site, publisher)
+    except Exception as e:
+        print(f"Failed to update error counts: {e}")
     try:
-        parts = file_name.split("/")
-        site = parts[1] if len(parts) > 1 else "unknown"
-        publisher = parts[2] if len(parts) > 2 else "unknown"
         sns.publish(
             TopicArn=os.environ["ERROR_TOPIC_ARN"],
             Subject=f"HL7 Processing Error: {site}/{publisher}",
@@ -48,31 +79,57 @@ def log_success(file_name, count, site, publisher):
     except Exception as e:
         print(f"Failed to send SNS success: {e}")
 
-def split_obrs(hl7_text):
-    lines = hl7_text.strip().splitlines()
-    msh = next((l for l in lines if l.startswith("MSH|")), None)
-    pid = next((l for l in lines if l.startswith("PID|")), "")
-    if not msh:
-        return []
-
+def route_obr_messages(hl7_text):
+    """
+    Walk the file once and yield (test_code, obs_date, message) for every OBR
+    group (an OBR and the OBX segments after it).
+
+    Each MSH starts a new message, so batch files with many MSH/PID groups are
+    split per patient: a group is emitted with its own message's MSH and first
+    PID once that message ends. Test code and observation date are read from
+    the OBR segment while grouping.
+    """
+    msh = None
+    pid = None
     obr_groups = []
-    current_group = []
-    for line in lines:
-        if line.startswith("OBR|"):
+    current_group = None
+    for segment in hl7_core.iter_segments(hl7_text, *hl7_core.strip_bounds(hl7_text)):
+        if segment.startswith("OBR|"):
+            current_group = (segment, [segment.text()])
+            obr_groups.append(current_group)
+        elif segment.startswith("OBX|"):
             if current_group:
-                obr_groups.append(current_group)
-            current_group = [line]
-        elif line.startswith("OBX|") and current_group:
-            current_group.append(line)
-    if current_group:
-        obr_groups.append(current_group)
+                current_group[1].append(segment.text())
+        elif segment.startswith("MSH|"):
+            if msh is not None:
+                yield from _emit_obr_groups(msh, pid, obr_groups)
+                pid = None
+                obr_groups = []
+                current_group = None
+            msh = segment.text()
+        elif pid is None and segment.startswith("PID|"):
+            pid = segment.text()
+    if msh is not None:
+        yield from _emit_obr_groups(msh, pid, obr_groups)
+
+def _emit_obr_groups(msh, pid, obr_groups):
+    header = f"{msh}\n{pid or ''}\n"
+    for obr, lines in obr_groups:
+        test_code, obs_date = _testcode_and_date(obr)
+        yield test_code, obs_date, header + "\n".join(lines)
+
+def route_inbox_parts(hl7_text, site, publisher, filename):
+    """Yield (part_key, payload) for every OBR group in the file, numbered in file order."""
+    for i, (test_code, obs_date, msg) in enumerate(route_obr_messages(hl7_text), start=1):
+        part_key = f"sites/{site}/inbox/{publisher}/{filename}_OBR{i}_{test_code}_{obs_date}.hl7"
+        yield part_key, msg.encode("utf-8")
 
-    return [f"{msh}\n{pid}\n" + "\n".join(group) for group in obr_groups]
+def split_obrs(hl7_text):
+    return [msg for _, _, msg in route_obr_messages(hl7_text)]
 
-def extract_testcode_and_date(obr_line):
-    fields = obr_line.split("|")
-    test_code = fields[4].split("^")[0] if len(fields) > 4 else "UNKNOWN"
-    raw_date = fields[7] if len(fields) > 7 else ""
+def _testcode_and_date(obr):
+    test_code = obr.component(4, 0) if obr.has_field(4) else "UNKNOWN"
+    raw_date = obr.field(7)
     try:
         dt = datetime.strptime(raw_date[:12], "%Y%m%d%H%M")
         obs_date = dt.strftime("%Y%m%d%H%M")
@@ -80,8 +137,18 @@ def extract_testcode_and_date(obr_line):
         obs_date = "000000000000"
     return test_code, obs_date
 
+def extract_testcode_and_date(obr_line):
+    return _testcode_and_date(hl7_core.Segment(obr_line))
+
+def on_part_uploaded(tag, part_key):
+    pass
+
+def on_part_failed(tag, part_key, error):
+    log_error(part_key, f"Failed to write part: {error}")
+
 def lambda_handler(event, context):
     for record in event["Records"]:
+        started = utc_now()
         src_bucket = record["s3"]["bucket"]["name"]
         src_key = urllib.parse.unquote_plus(record["s3"]["object"]["key"])
         _, ext = os.path.splitext(src_key)
@@ -110,18 +177,16 @@ def lambda_handler(event, context):
         publisher = parts[2]
         filename = parts[-1].rsplit(".", 1)[0]
 
-        messages = split_obrs(content)
-        if not messages:
+        # Parts are uploaded while the rest of the file is still being routed
+        part_count = 0
+        with BoundedS3Uploader(s3, src_bucket, UPLOAD_CONCURRENCY, on_part_uploaded, on_part_failed) as uploader:
+            for part_key, payload in route_inbox_parts(content, site, publisher, filename):
+                uploader.submit(part_key, payload)
+                part_count += 1
+        if not part_count:
             log_error(src_key, "No OBR segments found")
             continue
 
-        for i, msg in enumerate(messages):
-            obr_line = next((l for l in msg.splitlines() if l.startswith("OBR|")), "")
-            test_code, obs_date = extract_testcode_and_date(obr_line)
-            part_key = f"sites/{site}/inbox/{publisher}/{filename}_OBR{i+1}_{test_code}_{obs_date}.hl7"
-            try:
-                s3.put_object(Bucket=src_bucket, Key=part_key, Body=msg.encode("utf-8"))
-            except Exception as e:
-                log_error(part_key, f"Failed to write part: {e}")
-
-        log_success(src_key, len(messages), site, publisher)
+        log_success(src_key, part_count, site, publisher)
+        processing_times.record("copy_to_inbox", record, src_key, site, publisher, started, part_count,
+                                obj.get("ContentLength"))
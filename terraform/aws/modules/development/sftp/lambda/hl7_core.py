@@ -0,0 +1 @@
+../../sftp-lambda-preprocessor/lambda/common/hl7_core.py
\ No newline at end of file
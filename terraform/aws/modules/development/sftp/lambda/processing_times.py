@@ -0,0 +1 @@
+../../sftp-lambda-preprocessor/lambda/common/processing_times.py
\ No newline at end of file
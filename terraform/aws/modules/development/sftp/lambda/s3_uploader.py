@@ -0,0 +1 @@
+../../sftp-lambda-preprocessor/lambda/common/s3_uploader.py
\ No newline at end of file
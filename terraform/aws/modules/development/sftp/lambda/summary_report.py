@@ -1,37 +1,280 @@
 import boto3
+import collections
+import itertools
+import math
 import os
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+from boto3.dynamodb.conditions import Attr, Key
 
 dynamodb = boto3.resource("dynamodb")
 sns = boto3.client("sns")
-table = dynamodb.Table("hl7-error-log")
+# Per-day, per-site, per-publisher counts kept by copy_to_inbox.log_error
+counts_table = dynamodb.Table("hl7-error-counts")
+# Error detail rows; DayIndex is keyed by Day ("YYYY-MM-DD") and Timestamp
+error_table = dynamodb.Table("hl7-error-log")
+ERROR_LOG_DAY_INDEX = "DayIndex"
+# Per-file timing records written by copy_to_inbox and the preprocessors (see processing_times.py);
+# with TIMING_TABLE unset the latency section is left out
+TIMING_TABLE = os.environ.get("TIMING_TABLE", "")
+timing_table = dynamodb.Table(TIMING_TABLE) if TIMING_TABLE else None
 SUMMARY_TOPIC_ARN = os.environ["SUMMARY_TOPIC_ARN"]
+DETAIL_ROWS_PER_PUBLISHER = max(int(os.environ.get("SUMMARY_DETAIL_ROWS", "10")), 0)  # detail lines listed per publisher
+BACKFILL_SEGMENTS = int(os.environ.get("BACKFILL_SEGMENTS", "4"))  # parallel scan segments for backfill_error_log_days
+LATENCY_SLO_MS = int(os.environ.get("LATENCY_SLO_MS", "0"))  # flag stages whose p95 latency exceeds this; 0 disables
+LATENCY_SKETCH_ACCURACY = 0.01  # relative error of the reported percentiles
+LATENCY_QUANTILES = (0.50, 0.95, 0.99)
 
-def lambda_handler(event, context):
-    now = datetime.utcnow()
+class LatencySketch:
+    """
+    Streaming quantile sketch with a fixed relative error (log-bucketed, as in
+    DDSketch). A value v > 0 is counted in bucket ceil(log_gamma(v)), so memory
+    grows with the spread of the values rather than their number, and any
+    quantile is within relative_accuracy of the exact one.
+    """
+
+    def __init__(self, relative_accuracy=LATENCY_SKETCH_ACCURACY):
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.buckets = {}
+        self.zero_count = 0
+        self.count = 0
+
+    def add(self, value):
+        self.count += 1
+        if value <= 0:
+            self.zero_count += 1
+            return
+        index = math.ceil(math.log(value) / self.log_gamma)
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+
+    def quantiles(self, qs):
+        """Return the estimates for the ascending quantiles qs (0..1), or Nones when empty."""
+        if not self.count:
+            return [None] * len(qs)
+        results = []
+        ranks = iter(q * (self.count - 1) for q in qs)
+        rank = next(ranks)
+        seen = self.zero_count
+        while rank is not None and rank < seen:
+            results.append(0.0)
+            rank = next(ranks, None)
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            while rank is not None and rank < seen:
+                # Midpoint (in relative terms) of the bucket (gamma^(index-1), gamma^index]
+                results.append(2 * self.gamma ** index / (self.gamma + 1))
+                rank = next(ranks, None)
+        return results
+
+class ErrorDetails:
+    """The latest DETAIL_ROWS_PER_PUBLISHER error items for one site / publisher, and how many there were."""
+
+    def __init__(self):
+        self.latest = collections.deque(maxlen=DETAIL_ROWS_PER_PUBLISHER)
+        self.count = 0
+
+    def add(self, item):
+        self.latest.append(item)
+        self.count += 1
+
+class StageTimings:
+    """Latency sketch and throughput totals for one site / publisher / stage."""
+
+    def __init__(self):
+        self.latency = LatencySketch()
+        self.files = 0
+        self.messages = 0
+        self.bytes = 0
+        self.busy_ms = 0
+
+    def add(self, item):
+        self.latency.add(int(item["LatencyMs"]))
+        self.files += 1
+        self.messages += int(item.get("Messages", 0))
+        self.bytes += int(item.get("Bytes", 0))
+        self.busy_ms += int(item.get("DurationMs", 0))
+
+def query_error_counts(day, min_slot=None):
+    """Yield the hl7-error-counts items for one UTC day, optionally only from hour slot min_slot on."""
+    condition = Key("Day").eq(day)
+    if min_slot is not None:
+        condition = condition & Key("Slot").gte(min_slot)
+    kwargs = {"KeyConditionExpression": condition}
+    while True:
+        response = counts_table.query(**kwargs)
+        yield from response.get("Items", [])
+        if "LastEvaluatedKey" not in response:
+            break
+        kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+def query_error_details(day, since_timestamp=None):
+    """Yield hl7-error-log items for one UTC day in timestamp order, one DayIndex page at a time."""
+    condition = Key("Day").eq(day)
+    if since_timestamp is not None:
+        condition = condition & Key("Timestamp").gte(since_timestamp)
+    kwargs = {"IndexName": ERROR_LOG_DAY_INDEX, "KeyConditionExpression": condition}
+    while True:
+        response = error_table.query(**kwargs)
+        yield from response.get("Items", [])
+        if "LastEvaluatedKey" not in response:
+            break
+        kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+def query_processing_times(day, since_timestamp=None):
+    """Yield hl7-processing-times items for one UTC day, optionally only those finished from since_timestamp on."""
+    condition = Key("Day").eq(day)
+    if since_timestamp is not None:
+        condition = condition & Key("Slot").gte(since_timestamp)
+    kwargs = {"KeyConditionExpression": condition}
+    while True:
+        response = timing_table.query(**kwargs)
+        yield from response.get("Items", [])
+        if "LastEvaluatedKey" not in response:
+            break
+        kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+def iter_error_details(now):
+    """Yield the hl7-error-log items from the 24 hours before now, oldest first."""
     since = now - timedelta(days=1)
+    yield from query_error_details(since.strftime("%Y-%m-%d"), since_timestamp=since.isoformat())
+    yield from query_error_details(now.strftime("%Y-%m-%d"))
+
+def _backfill_segment(segment, total_segments):
+    """Set Day on the items of one parallel scan segment that were logged before DayIndex existed."""
+    # boto3 resources are not thread-safe, so each worker thread uses its own session
+    table = boto3.session.Session().resource("dynamodb").Table(error_table.name)
+    kwargs = {
+        "Segment": segment,
+        "TotalSegments": total_segments,
+        "FilterExpression": Attr("Day").not_exists() & Attr("Timestamp").exists(),
+        "ProjectionExpression": "FileName, #ts",
+        "ExpressionAttributeNames": {"#ts": "Timestamp"},
+    }
+    updated = 0
+    while True:
+        response = table.scan(**kwargs)
+        for item in response.get("Items", []):
+            table.update_item(
+                Key={"FileName": item["FileName"]},
+                UpdateExpression="SET #day = :day",
+                ExpressionAttributeNames={"#day": "Day"},
+                ExpressionAttributeValues={":day": item["Timestamp"][:10]}
+            )
+            updated += 1
+        if "LastEvaluatedKey" not in response:
+            return updated
+        kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
 
-    response = table.scan()
-    items = response.get("Items", [])
+def backfill_error_log_days(total_segments=BACKFILL_SEGMENTS):
+    """
+    One-off backfill of the Day attribute for errors logged before DayIndex
+    existed, using a parallel scan with one worker per segment. Returns the
+    number of items updated.
+    """
+    with ThreadPoolExecutor(max_workers=total_segments) as executor:
+        return sum(executor.map(_backfill_segment, range(total_segments), [total_segments] * total_segments))
+
+def summarize_error_counts(now):
+    """
+    Return {site: {publisher: error_count}} for the 24 hours before now, to the
+    hour: today's partition plus yesterday's from the same hour on.
+    """
+    since = now - timedelta(days=1)
+    items = list(query_error_counts(now.strftime("%Y-%m-%d")))
+    items += query_error_counts(since.strftime("%Y-%m-%d"), min_slot=f"{since.hour:02d}#")
 
     summary = {}
     for item in items:
-        ts = datetime.fromisoformat(item["Timestamp"])
-        if ts < since:
-            continue
-        file = item["FileName"]
-        parts = file.split("/")
+        publishers = summary.setdefault(item["Site"], {})
+        publishers[item["Publisher"]] = publishers.get(item["Publisher"], 0) + int(item["ErrorCount"])
+    return summary
+
+def collect_error_details(now):
+    """
+    Return {site: {publisher: ErrorDetails}} for the 24 hours before now. Items
+    arrive oldest first, so only the latest few per publisher are kept.
+    """
+    details = {}
+    for item in iter_error_details(now):
+        parts = item["FileName"].split("/")
         site = parts[1] if len(parts) > 1 else "unknown"
         publisher = parts[2] if len(parts) > 2 else "unknown"
-        summary.setdefault(site, {}).setdefault(publisher, []).append(item["Reason"])
+        details.setdefault(site, {}).setdefault(publisher, ErrorDetails()).add(item)
+    return details
+
+def summarize_processing_times(now):
+    """
+    Return {site: {publisher: {stage: StageTimings}}} for files finished in the
+    24 hours before now. Items stream through the sketches, so memory does not
+    grow with the number of files.
+    """
+    if timing_table is None:
+        return {}
+    since = now - timedelta(days=1)
+    items = itertools.chain(
+        query_processing_times(since.strftime("%Y-%m-%d"), since_timestamp=since.isoformat()),
+        query_processing_times(now.strftime("%Y-%m-%d")),
+    )
+    timings = {}
+    for item in items:
+        stages = timings.setdefault(item["Site"], {}).setdefault(item["Publisher"], {})
+        stages.setdefault(item["Stage"], StageTimings()).add(item)
+    return timings
+
+def _format_ms(ms):
+    return f"{ms:,.0f} ms" if ms < 1000 else f"{ms / 1000:,.1f} s"
+
+def format_stage_timings(stage, timings):
+    p50, p95, p99 = timings.latency.quantiles(LATENCY_QUANTILES)
+    line = (
+        f"    {stage}: p50 {_format_ms(p50)} · p95 {_format_ms(p95)} · p99 {_format_ms(p99)}"
+        f" — {timings.files} file(s), {timings.messages} msg(s)"
+    )
+    if timings.busy_ms:
+        busy_seconds = timings.busy_ms / 1000
+        line += f", {timings.messages / busy_seconds:,.1f} msgs/s, {timings.bytes / busy_seconds / 1024:,.1f} KiB/s"
+    if LATENCY_SLO_MS and p95 > LATENCY_SLO_MS:
+        line += f" ⚠️ p95 over {_format_ms(LATENCY_SLO_MS)} SLO"
+    return line
+
+def lambda_handler(event, context):
+    if event and event.get("backfill_error_log_days"):
+        updated = backfill_error_log_days(int(event.get("total_segments", BACKFILL_SEGMENTS)))
+        print(f"Backfilled Day on {updated} hl7-error-log item(s)")
+        return {"updated": updated}
+
+    now = datetime.utcnow()
+    summary = summarize_error_counts(now)
+    details = collect_error_details(now)
+    # Errors logged before the counters existed only show up in the detail rows
+    for site, pub_details in details.items():
+        for pub, pub_errors in pub_details.items():
+            summary.setdefault(site, {}).setdefault(pub, pub_errors.count)
 
     message_lines = [f"📊 HL7 Summary (last 24h):\n"]
     for site, pub_data in summary.items():
         message_lines.append(f"Site: {site}")
-        for pub, errors in pub_data.items():
-            message_lines.append(f"  Publisher: {pub} — ❌ {len(errors)} error(s)")
+        for pub, error_count in pub_data.items():
+            message_lines.append(f"  Publisher: {pub} — ❌ {error_count} error(s)")
+            pub_errors = details.get(site, {}).get(pub, ErrorDetails())
+            for item in pub_errors.latest:
+                message_lines.append(f"    {item['Timestamp']} {item['FileName']}: {item['Reason']}")
+            if pub_errors.count > len(pub_errors.latest):
+                message_lines.append(f"    … and {pub_errors.count - len(pub_errors.latest)} earlier")
         message_lines.append("")
 
+    timings = summarize_processing_times(now)
+    if timings:
+        message_lines.append("⏱ Processing latency (S3 upload to output written) and throughput:\n")
+        for site, pub_timings in timings.items():
+            message_lines.append(f"Site: {site}")
+            for pub, stages in pub_timings.items():
+                message_lines.append(f"  Publisher: {pub}")
+                for stage, stage_timings in sorted(stages.items()):
+                    message_lines.append(format_stage_timings(stage, stage_timings))
+            message_lines.append("")
+
     sns.publish(
         TopicArn=SUMMARY_TOPIC_ARN,
         Subject="Daily HL7 Summary Report",
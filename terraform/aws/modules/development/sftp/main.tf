@@ -48,10 +48,24 @@ resource "aws_dynamodb_table" "hl7_errors" {
     type = "S"
   }
 
-  #attribute {
-  #  name = "Timestamp"
-  #  type = "S"
-  #}
+  attribute {
+    name = "Day"
+    type = "S"
+  }
+
+  attribute {
+    name = "Timestamp"
+    type = "S"
+  }
+
+  # Day bucket (UTC "YYYY-MM-DD") + timestamp, so detail reports Query one
+  # partition per day instead of scanning the whole error history.
+  global_secondary_index {
+    name            = "DayIndex"
+    hash_key        = "Day"
+    range_key       = "Timestamp"
+    projection_type = "ALL"
+  }
 
   ttl {
     attribute_name = "TTL"
@@ -59,6 +73,53 @@ resource "aws_dynamodb_table" "hl7_errors" {
   }
 }
 
+# Error counts per UTC day, written by copy_to_inbox with atomic increments so
+# summary_report reads a couple of small partitions instead of the error log.
+# Slot is "<HH>#<site>#<publisher>".
+resource "aws_dynamodb_table" "hl7_error_counts" {
+  name         = "hl7-error-counts"
+  billing_mode = "PAY_PER_REQUEST"
+  hash_key     = "Day"
+  range_key    = "Slot"
+
+  attribute {
+    name = "Day"
+    type = "S"
+  }
+
+  attribute {
+    name = "Slot"
+    type = "S"
+  }
+}
+
+# Per-file timing records (S3 event time, start, end, bytes, message count)
+# written by copy_to_inbox and the sftp-lambda-preprocessor lambdas, read by
+# summary_report for its latency percentiles. Slot is
+# "<finished timestamp>#<stage>#<object key>"; items expire after
+# TIMING_RETENTION_DAYS (default 30).
+resource "aws_dynamodb_table" "hl7_processing_times" {
+  name         = "hl7-processing-times"
+  billing_mode = "PAY_PER_REQUEST"
+  hash_key     = "Day"
+  range_key    = "Slot"
+
+  attribute {
+    name = "Day"
+    type = "S"
+  }
+
+  attribute {
+    name = "Slot"
+    type = "S"
+  }
+
+  ttl {
+    attribute_name = "TTL"
+    enabled        = true
+  }
+}
+
 resource "aws_sns_topic" "error" {
   name = "hl7-error-topic"
 }
@@ -9,6 +9,16 @@ output "dynamodb_table_name" {
   value       = aws_dynamodb_table.hl7_errors.name
 }
 
+output "dynamodb_error_counts_table_name" {
+  description = "The name of the DynamoDB table holding per-day, per-site, per-publisher error counts"
+  value       = aws_dynamodb_table.hl7_error_counts.name
+}
+
+output "dynamodb_processing_times_table_name" {
+  description = "The name of the DynamoDB table holding per-file processing timing records"
+  value       = aws_dynamodb_table.hl7_processing_times.name
+}
+
 output "sns_error_topic_arn" {
   value = aws_sns_topic.error.arn
 }
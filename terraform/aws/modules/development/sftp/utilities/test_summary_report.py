@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+"""
+Tests for the hl7-error-counts counters (copy_to_inbox.increment_error_count,
+read back by summary_report), the per-publisher error detail rows and the
+parallel Day backfill in lambda/summary_report.py, run against moto's in-memory DynamoDB; no AWS access
+is made.
+
+Usage: python3 -m pytest utilities/test_summary_report.py
+   or: python3 utilities/test_summary_report.py
+
+Needs boto3 and moto importable; the tests are skipped without moto.
+"""
+import importlib.util
+import os
+import sys
+import threading
+import unittest
+from datetime import datetime
+from unittest import mock
+
+import boto3
+
+try:
+    from moto import mock_aws
+except ImportError:
+    mock_aws = None
+
+LAMBDA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lambda")
+
+
+def load_lambda_module(name):
+    # copy_to_inbox imports the shared modules symlinked into the lambda directory
+    if LAMBDA_DIR not in sys.path:
+        sys.path.insert(0, LAMBDA_DIR)
+    spec = importlib.util.spec_from_file_location(name, os.path.join(LAMBDA_DIR, f"{name}.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def create_error_log_table():
+    # Same keys as aws_dynamodb_table.hl7_errors in main.tf
+    boto3.client("dynamodb").create_table(
+        TableName="hl7-error-log",
+        AttributeDefinitions=[
+            {"AttributeName": "FileName", "AttributeType": "S"},
+            {"AttributeName": "Day", "AttributeType": "S"},
+            {"AttributeName": "Timestamp", "AttributeType": "S"},
+        ],
+        KeySchema=[{"AttributeName": "FileName", "KeyType": "HASH"}],
+        GlobalSecondaryIndexes=[{
+            "IndexName": "DayIndex",
+            "KeySchema": [{"AttributeName": "Day", "KeyType": "HASH"}, {"AttributeName": "Timestamp", "KeyType": "RANGE"}],
+            "Projection": {"ProjectionType": "ALL"},
+        }],
+        BillingMode="PAY_PER_REQUEST",
+    )
+    return boto3.resource("dynamodb").Table("hl7-error-log")
+
+
+def create_error_counts_table():
+    # Same keys as aws_dynamodb_table.hl7_error_counts in main.tf
+    boto3.client("dynamodb").create_table(
+        TableName="hl7-error-counts",
+        AttributeDefinitions=[
+            {"AttributeName": "Day", "AttributeType": "S"},
+            {"AttributeName": "Slot", "AttributeType": "S"},
+        ],
+        KeySchema=[{"AttributeName": "Day", "KeyType": "HASH"}, {"AttributeName": "Slot", "KeyType": "RANGE"}],
+        BillingMode="PAY_PER_REQUEST",
+    )
+    return boto3.resource("dynamodb").Table("hl7-error-counts")
+
+
+class MotoTestCase(unittest.TestCase):
+    """Starts moto with the hl7-error-log and hl7-error-counts tables and loads summary_report."""
+
+    def setUp(self):
+        env = {
+            "AWS_DEFAULT_REGION": "us-east-1",
+            "AWS_ACCESS_KEY_ID": "testing",
+            "AWS_SECRET_ACCESS_KEY": "testing",
+            "SUMMARY_TOPIC_ARN": "arn:aws:sns:us-east-1:123456789012:summary",
+        }
+        patcher = mock.patch.dict(os.environ, env)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.aws = mock_aws()
+        self.aws.start()
+        self.addCleanup(self.aws.stop)
+        self.table = create_error_log_table()
+        self.counts_table = create_error_counts_table()
+        self.summary_report = load_lambda_module("summary_report")
+
+    def run_report(self, now):
+        """Run the daily report as of now and return the published message lines."""
+        class FixedDatetime(datetime):
+            @classmethod
+            def utcnow(cls):
+                return now
+
+        with mock.patch.object(self.summary_report, "datetime", FixedDatetime), \
+                mock.patch.object(self.summary_report.sns, "publish") as publish:
+            self.summary_report.lambda_handler({}, None)
+        return publish.call_args.kwargs["Message"].splitlines()
+
+
+@unittest.skipIf(mock_aws is None, "moto is not installed")
+class ErrorCountsTest(MotoTestCase):
+    # The report runs at 10:30 UTC, so it covers 2025-03-02 and 2025-03-01 from the 10:00 slot on
+    now = datetime(2025, 3, 2, 10, 30)
+    increments = [
+        ("2025-03-01T09:59:59.999999", "siteA", "pubX"),  # before the 24h window's first hour
+        ("2025-03-01T10:00:00.000000", "siteA", "pubX"),  # first hour of the window
+        ("2025-03-01T23:59:59.999999", "siteA", "pubX"),
+        ("2025-03-02T00:00:00.000000", "siteA", "pubX"),  # day boundary
+        ("2025-03-02T00:10:00.000000", "siteA", "pubX"),
+        ("2025-03-02T09:59:59.999999", "siteB", "pubY"),  # hour boundary
+        ("2025-03-02T10:00:00.000000", "siteB", "pubY"),
+        ("2025-03-02T10:00:00.000000", "siteA", "pubZ"),
+    ]
+
+    def setUp(self):
+        super().setUp()
+        self.copy_to_inbox = load_lambda_module("copy_to_inbox")
+        for timestamp, site, publisher in self.increments:
+            self.copy_to_inbox.increment_error_count(timestamp, site, publisher)
+
+    def test_increments_one_slot_per_hour_site_and_publisher(self):
+        items = {(item["Day"], item["Slot"]): item for item in self.counts_table.scan()["Items"]}
+        self.assertEqual(
+            {key: int(item["ErrorCount"]) for key, item in items.items()},
+            {
+                ("2025-03-01", "09#siteA#pubX"): 1,
+                ("2025-03-01", "10#siteA#pubX"): 1,
+                ("2025-03-01", "23#siteA#pubX"): 1,
+                ("2025-03-02", "00#siteA#pubX"): 2,
+                ("2025-03-02", "09#siteB#pubY"): 1,
+                ("2025-03-02", "10#siteB#pubY"): 1,
+                ("2025-03-02", "10#siteA#pubZ"): 1,
+            },
+        )
+        self.assertEqual((items["2025-03-02", "00#siteA#pubX"]["Site"], items["2025-03-02", "00#siteA#pubX"]["Publisher"]),
+                         ("siteA", "pubX"))
+
+    def test_summarizes_the_last_24_hours_to_the_hour(self):
+        self.assertEqual(self.summary_report.summarize_error_counts(self.now),
+                         {"siteA": {"pubX": 4, "pubZ": 1}, "siteB": {"pubY": 2}})
+        self.assertEqual(len(list(self.summary_report.query_error_counts("2025-03-01", min_slot="10#"))), 2)
+
+    def test_report_prints_the_24_hour_totals(self):
+        message = self.run_report(self.now)
+        self.assertIn("  Publisher: pubX — ❌ 4 error(s)", message)
+        self.assertIn("  Publisher: pubZ — ❌ 1 error(s)", message)
+        self.assertIn("  Publisher: pubY — ❌ 2 error(s)", message)
+
+
+@unittest.skipIf(mock_aws is None, "moto is not installed")
+class ErrorDetailsTest(MotoTestCase):
+    now = datetime(2025, 3, 2, 10, 30)
+
+    def setUp(self):
+        super().setUp()
+        # 13 errors in the window (from 2025-03-01T22:00, across midnight) and one before it
+        timestamps = [f"2025-03-01T{hour:02d}:00:00.000000" for hour in (9, 22, 23)]
+        timestamps += [f"2025-03-02T{hour:02d}:00:00.000000" for hour in range(11)]
+        with self.table.batch_writer() as batch:
+            for i, timestamp in enumerate(timestamps):
+                batch.put_item(Item={"FileName": f"sites/siteA/pubX/incoming/f{i:02d}.hl7", "Day": timestamp[:10],
+                                     "Timestamp": timestamp, "Reason": f"reason {i}"})
+
+    def test_keeps_only_the_latest_rows_per_publisher(self):
+        details = self.summary_report.collect_error_details(self.now)["siteA"]["pubX"]
+        self.assertEqual(details.count, 13)
+        self.assertEqual([item["FileName"][-7:-4] for item in details.latest], [f"f{i:02d}" for i in range(4, 14)])
+
+    def test_report_lists_the_latest_rows_and_counts_the_rest(self):
+        message = self.run_report(self.now)
+        publisher_line = message.index("  Publisher: pubX — ❌ 13 error(s)")
+        self.assertEqual(message[publisher_line + 1], "    2025-03-02T01:00:00.000000 sites/siteA/pubX/incoming/f04.hl7: reason 4")
+        self.assertEqual(message[publisher_line + 10], "    2025-03-02T10:00:00.000000 sites/siteA/pubX/incoming/f13.hl7: reason 13")
+        self.assertEqual(message[publisher_line + 11], "    … and 3 earlier")
+
+
+@unittest.skipIf(mock_aws is None, "moto is not installed")
+class BackfillErrorLogDaysTest(MotoTestCase):
+
+    def put_errors(self, count, with_day):
+        with self.table.batch_writer() as batch:
+            for i in range(count):
+                timestamp = f"2025-01-{i % 28 + 1:02d}T10:00:00.000000"
+                item = {"FileName": f"sites/s/p/incoming/{with_day}-{i}.hl7", "Timestamp": timestamp, "Reason": "bad"}
+                if with_day:
+                    item["Day"] = "2024-12-31"
+                batch.put_item(Item=item)
+
+    def test_sets_day_from_timestamp_on_every_segment(self):
+        self.put_errors(60, with_day=False)
+        self.put_errors(5, with_day=True)
+
+        self.assertEqual(self.summary_report.backfill_error_log_days(total_segments=4), 60)
+
+        items = self.table.scan()["Items"]
+        self.assertEqual(len(items), 65)
+        for item in items:
+            expected = "2024-12-31" if item["FileName"].split("/")[-1].startswith("True") else item["Timestamp"][:10]
+            self.assertEqual(item["Day"], expected)
+        # A second run finds nothing left to backfill
+        self.assertEqual(self.summary_report.backfill_error_log_days(total_segments=4), 0)
+
+    def test_each_worker_thread_uses_its_own_session(self):
+        self.put_errors(20, with_day=False)
+        threads = []
+        real_session = boto3.session.Session
+
+        def session_on_worker(*args, **kwargs):
+            threads.append(threading.get_ident())
+            return real_session(*args, **kwargs)
+
+        with mock.patch.object(boto3.session, "Session", side_effect=session_on_worker):
+            self.assertEqual(self.summary_report.backfill_error_log_days(total_segments=3), 20)
+
+        self.assertEqual(len(threads), 3)
+        self.assertNotIn(threading.get_ident(), threads)
+
+
+if __name__ == "__main__":
+    unittest.main()